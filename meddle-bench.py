@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" load generator and benchmark for meddle-server.py
+
+    starts a server on localhost (or uses a running one), lets a number of
+    simulated pymeddle clients run a mix of requests against it and writes
+    throughput, latency percentiles per request and publish-to-delivery
+    latency to a JSON file which can be compared between commits
+
+    with --tokenizer it instead times the message tokenizer against the
+    text handling it replaced, on all messages in the channel logs of a
+    server directory
+"""
+
+import glob
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+from threading import Thread, Lock
+
+import pymeddle
+import pymeddle_common
+import pymeddle_index
+import pymeddle_logs
+
+_operations = ('publish', 'ping', 'get_log', 'get_log_page', 'get_channels',
+               'search')
+
+
+class headless_handler:
+    """ implements the meddle_on_* callbacks of pymeddle.base without UI and
+        measures how long published benchmark messages took to arrive """
+
+    def __init__(self, recorder):
+        self._recorder = recorder
+
+    def meddle_on_message(self, channel, name, text):
+        if text.startswith('bench '):
+            try:
+                _sent = float(text.split(' ')[1])
+            except (IndexError, ValueError):
+                return
+            self._recorder.record('delivery', time.time() - _sent)
+
+    def meddle_on_search_result(self, search_result):
+        self._recorder.count('search_result_frames')
+
+    def meddle_on_search_done(self, search_id, info):
+        self._recorder.count('searches_done')
+
+    def meddle_on_connection_established(self, status):
+        pass
+
+    def meddle_on_version_check(self, success, v_server, v_own, message):
+        logging.error("server (%s) does not accept client (%s)", v_server, v_own)
+
+    def meddle_on_joined_channel(self, channel):
+        pass
+
+    def meddle_on_leave_channel(self, channel):
+        pass
+
+    def meddle_on_tag_notification(self, tag, channel, user, text):
+        pass
+
+    def meddle_on_channels_update(self, channels):
+        pass
+
+    def meddle_on_user_update(self, users):
+        pass
+
+    def meddle_on_tags_update(self, tags):
+        pass
+
+
+class recorder:
+    """ thread safe collection of latency samples and counters """
+
+    def __init__(self):
+        self._mutex = Lock()
+        self._samples = {}  # {name: [seconds, ..]}
+        self._counters = {}
+        self._enabled = False
+
+    def enable(self, enabled):
+        self._enabled = enabled
+
+    def record(self, name, duration):
+        if not self._enabled:
+            return
+        with self._mutex:
+            self._samples.setdefault(name, []).append(duration)
+
+    def count(self, name):
+        if not self._enabled:
+            return
+        with self._mutex:
+            self._counters[name] = self._counters.get(name, 0) + 1
+
+    def results(self, duration):
+        _result = {'counters': dict(self._counters), 'latency': {}}
+        for name, samples in self._samples.items():
+            _result['latency'][name] = summary(samples, duration)
+        return _result
+
+
+def percentile(sorted_samples, p):
+    if not sorted_samples:
+        return None
+    _index = min(len(sorted_samples) - 1, int(len(sorted_samples) * p))
+    return sorted_samples[_index]
+
+def summary(samples, duration):
+    """ count, throughput and latency percentiles in milliseconds """
+    _sorted = sorted(samples)
+    return {'count':      len(_sorted),
+            'throughput': len(_sorted) / duration,
+            'mean_ms':    1000. * sum(_sorted) / len(_sorted),
+            'p50_ms':     1000. * percentile(_sorted, .50),
+            'p99_ms':     1000. * percentile(_sorted, .99),
+            'p999_ms':    1000. * percentile(_sorted, .999),
+            'max_ms':     1000. * _sorted[-1]}
+
+def parse_mix(mix):
+    """ 'publish=60,ping=20' -> [('publish', 60), ('ping', 20)] """
+    _result = []
+    for item in mix.split(','):
+        _name, _weight = item.split('=')
+        if _name not in _operations:
+            raise ValueError("unknown operation '%s'" % _name)
+        _result.append((_name, float(_weight)))
+    return _result
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=pymeddle_common.meddle_directory()).decode().strip()
+    except Exception:
+        return None
+
+
+class simulated_client:
+
+    def __init__(self, name, server, port, recorder, mix, think_time):
+        self._recorder = recorder
+        self._mix = mix
+        self._think_time = think_time
+        self._channels = []
+        self.base = pymeddle.base(headless_handler(recorder),
+                                  ['-u', name, '-s', server, '-p', str(port)])
+
+    def connect(self, timeout=10):
+        self.base.connect()
+        _end = time.time() + timeout
+        while not self.base.get_connection_status():
+            if time.time() > _end:
+                raise RuntimeError("could not connect to server")
+            time.sleep(.05)
+
+    def join(self, channels):
+        self._channels = list(channels)
+        for c in self._channels:
+            self.base.join_channel(c)
+
+    def run(self, end_time):
+        _names = [n for n, _ in self._mix]
+        _weights = [w for _, w in self._mix]
+        while time.time() < end_time:
+            _operation = random.choices(_names, _weights)[0]
+            _channel = random.choice(self._channels)
+            _start = time.time()
+            try:
+                self._execute(_operation, _channel)
+            except Exception as ex:
+                logging.warning("%s failed: %s", _operation, ex)
+                self._recorder.count('errors_%s' % _operation)
+                continue
+            self._recorder.record(_operation, time.time() - _start)
+            if self._think_time:
+                time.sleep(self._think_time)
+
+    def _execute(self, operation, channel):
+        if operation == 'publish':
+            self.base.publish(channel, 'bench %f #bench some text to search for'
+                              % time.time())
+        elif operation == 'ping':
+            self.base.ping()
+        elif operation == 'get_log':
+            self.base.get_log(channel)
+        elif operation == 'get_log_page':
+            self.base.get_log_page(channel, limit=50)
+        elif operation == 'get_channels':
+            self.base.get_channels()
+        elif operation == 'search':
+            self.base.search('search')
+
+
+def start_server(port, directory, extra_args):
+    _script = os.path.join(pymeddle_common.meddle_directory(), 'meddle-server.py')
+    _log = open(os.path.join(directory, 'server.log'), 'w')
+    logging.info("start server in %s", directory)
+    return subprocess.Popen(
+        [sys.executable, _script, '--port', str(port)] + extra_args,
+        cwd=directory, stdout=_log, stderr=subprocess.STDOUT)
+
+def run_benchmark(options):
+    _recorder = recorder()
+    _mix = parse_mix(options.mix)
+    _server_process = None
+    _directory = None
+    if options.server is None:
+        _directory = tempfile.mkdtemp(prefix='meddle-bench-')
+        _server_process = start_server(
+            options.port, _directory,
+            options.server_args.split() if options.server_args else [])
+    _server = options.server or 'localhost'
+
+    try:
+        _clients = [simulated_client('bench%d' % i, _server, options.port,
+                                     _recorder, _mix, options.think_time / 1000.)
+                    for i in range(options.clients)]
+        for c in _clients:
+            c.connect()
+        _channels = [_clients[0].base.create_channel([])
+                     for _ in range(options.channels)]
+        for c in _clients:
+            c.join(_channels)
+        # let subscriptions settle before measuring
+        time.sleep(1)
+
+        _recorder.enable(True)
+        _start = time.time()
+        _threads = [Thread(target=c.run, args=(_start + options.duration,))
+                    for c in _clients]
+        for t in _threads:
+            t.daemon = True
+            t.start()
+        # clients block forever on a dead server - so watch it
+        while any(t.is_alive() for t in _threads):
+            if _server_process and _server_process.poll() is not None:
+                raise RuntimeError("server died with exit code %d" %
+                                   _server_process.returncode)
+            if time.time() > _start + options.duration + 30:
+                raise RuntimeError("clients did not finish - server hangs")
+            time.sleep(.1)
+        _duration = time.time() - _start
+        # wait for outstanding deliveries
+        time.sleep(.5)
+        _recorder.enable(False)
+        try:
+            _server_stats = _clients[0].base.get_server_stats()
+        except Exception as ex:
+            logging.warning("could not get server statistics: %s", ex)
+            _server_stats = None
+    finally:
+        if _server_process:
+            _server_process.terminate()
+            _server_process.wait()
+        if _directory and not options.keep:
+            shutil.rmtree(_directory, ignore_errors=True)
+
+    _results = _recorder.results(_duration)
+    _requests = sum(v['count'] for k, v in _results['latency'].items()
+                    if k in _operations)
+    return {'revision':   git_revision(),
+            'time':       time.time(),
+            'config':     {'clients':     options.clients,
+                           'channels':    options.channels,
+                           'duration':    options.duration,
+                           'mix':         options.mix,
+                           'think_time':  options.think_time,
+                           'server_args': options.server_args},
+            'duration':   _duration,
+            'throughput': _requests / _duration,
+            'counters':   _results['counters'],
+            'latency':    _results['latency'],
+            'server':     _server_stats}
+
+def tokenizer_corpus(directory):
+    """ returns the texts of all messages in the channel logs '_*.log' in
+        @directory """
+    _texts = []
+    for filename in sorted(glob.glob(os.path.join(directory, '_*.log'))):
+        with open(filename, 'rb') as f:
+            _texts.extend(x for _, _, x in pymeddle_logs.parse_lines(f.read()))
+    return _texts
+
+def legacy_tokens(text):
+    """ tags and words like ingest and indexing found them before
+        pymeddle_index.tokenize() - kept as reference """
+    _text = text
+    for c in '.,;?!:\'"':
+        _text = _text.replace(c, ' ')
+    return ([x.lower() for x in _text.split(' ') if len(x) > 1 and x[0] == '#'],
+            pymeddle_index.words(text))
+
+def run_tokenizer_benchmark(options):
+    _texts = tokenizer_corpus(options.tokenizer)
+    if not _texts:
+        raise RuntimeError("no messages in %s" % os.path.join(options.tokenizer, '_*.log'))
+    _functions = (('legacy', legacy_tokens),
+                  ('tokenize', pymeddle_index.tokenize),
+                  ('extract_tags', pymeddle_index.extract_tags))
+    _timings = {}
+    for name, function in _functions:
+        _best = None
+        for _ in range(options.tokenizer_rounds):
+            _start = time.time()
+            for x in _texts:
+                function(x)
+            _duration = time.time() - _start
+            _best = _duration if _best is None else min(_best, _duration)
+        _timings[name] = {'total_s':         _best,
+                          'us_per_message':  1000000. * _best / len(_texts),
+                          'messages_per_s':  len(_texts) / _best}
+    _tokens = [pymeddle_index.tokenize(x) for x in _texts]
+    return {'revision':  git_revision(),
+            'time':      time.time(),
+            'config':    {'corpus':   os.path.abspath(options.tokenizer),
+                          'messages': len(_texts),
+                          'bytes':    sum(len(x.encode('utf-8')) for x in _texts),
+                          'rounds':   options.tokenizer_rounds},
+            'tokenizer': _timings,
+            'tokens':    {k: sum(len(getattr(t, k)) for t in _tokens)
+                          for k in pymeddle_index.message_tokens._fields}}
+
+def print_tokenizer_results(results):
+    print("%d messages, %d bytes (revision %s)" % (
+        results['config']['messages'], results['config']['bytes'],
+        results['revision']))
+    print("%-14s %10s %12s" % ('function', 'us/msg', 'msgs/s'))
+    for name, t in sorted(results['tokenizer'].items()):
+        print("%-14s %10.2f %12d" % (name, t['us_per_message'], t['messages_per_s']))
+    for name, c in sorted(results['tokens'].items()):
+        print("%-14s %10d" % (name, c))
+
+def print_results(results):
+    print("%d requests/s over %.1fs (revision %s)" % (
+        results['throughput'], results['duration'], results['revision']))
+    print("%-14s %8s %9s %9s %9s %9s" % (
+        'operation', 'count', 'p50 ms', 'p99 ms', 'p999 ms', 'max ms'))
+    for name, l in sorted(results['latency'].items()):
+        print("%-14s %8d %9.2f %9.2f %9.2f %9.2f" % (
+            name, l['count'], l['p50_ms'], l['p99_ms'], l['p999_ms'], l['max_ms']))
+    for name, c in sorted(results['counters'].items()):
+        print("%-14s %8d" % (name, c))
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-n", "--clients", dest="clients", type="int", default=10,
+                      help="number of simulated clients")
+    parser.add_option("-c", "--channels", dest="channels", type="int", default=4,
+                      help="number of channels all clients talk on")
+    parser.add_option("-d", "--duration", dest="duration", type="float", default=10.,
+                      metavar="SECONDS", help="how long to measure")
+    parser.add_option("-m", "--mix", dest="mix",
+                      default="publish=50,ping=20,get_log_page=15,get_channels=10,search=5",
+                      help="weighted operations, choose from %s" % ", ".join(_operations))
+    parser.add_option("-t", "--think-time", dest="think_time", type="float",
+                      default=0., metavar="MS",
+                      help="pause of every client between two requests")
+    parser.add_option("-s", "--server", dest="server", metavar="SERVER-IP",
+                      help="use a running server instead of starting one")
+    parser.add_option("-p", "--port", dest="port", type="int", default=32200,
+                      metavar="PORT-NR", help="server port")
+    parser.add_option("--server-args", dest="server_args",
+                      help="additional arguments for the started server")
+    parser.add_option("-k", "--keep", dest="keep", action="store_true", default=False,
+                      help="keep the working directory of the started server")
+    parser.add_option("-o", "--output", dest="output", metavar="FILE",
+                      help="JSON file to write the results to")
+    parser.add_option("--tokenizer", dest="tokenizer", metavar="DIRECTORY",
+                      help="only time the message tokenizer on the channel "
+                           "logs in DIRECTORY")
+    parser.add_option("--tokenizer-rounds", dest="tokenizer_rounds", type="int",
+                      default=5, metavar="COUNT",
+                      help="run the tokenizer COUNT times over the logs and "
+                           "take the fastest")
+    (options, args) = parser.parse_args()
+
+    if options.tokenizer:
+        _results = run_tokenizer_benchmark(options)
+        print_tokenizer_results(_results)
+    else:
+        _results = run_benchmark(options)
+        print_results(_results)
+    _output = options.output or 'bench-%s.json' % time.strftime('%Y%m%d-%H%M%S')
+    with open(_output, 'w') as f:
+        json.dump(_results, f, indent=4, sort_keys=True)
+    print("results written to %s" % _output)
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s (%(thread)d) %(levelname)s %(message)s",
+        datefmt="%y%m%d-%H%M%S",
+        level=logging.WARNING)
+    logging.addLevelName(logging.CRITICAL, "(CRITICAL)")
+    logging.addLevelName(logging.ERROR,    "(EE)")
+    logging.addLevelName(logging.WARNING,  "(WW)")
+    logging.addLevelName(logging.INFO,     "(II)")
+    logging.addLevelName(logging.DEBUG,    "(DD)")
+    logging.addLevelName(logging.NOTSET,   "(NA)")
+
+    main()
@@ -0,0 +1,667 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" distributes the channels of a meddle server over several server
+    processes ("shards") and looks like a single server to clients, e.g.
+
+        meddle-broker.py --shards 4 --port 32100
+
+    every shard is a meddle-server.py started with --shard in its own
+    directory shard-<number>. A channel lives on the shard
+    pymeddle_common.shard_of() gives for its id and requests about the
+    channel go there. Users belong to the first shard - the broker tells the
+    other shards about everybody saying hello. Requests about all channels
+    (channel lists, tags, searches, statistics) go to all shards and the
+    answers are merged
+
+    whatever the shards publish is forwarded through XSUB/XPUB sockets
+    together with the subscriptions of the clients. Tag deltas and search
+    ids get renumbered on the way so they look like coming from one server
+"""
+
+import collections
+import heapq
+import json
+import logging
+import os
+import shlex
+import signal
+import subprocess
+import sys
+import time
+import zlib
+from optparse import OptionParser
+
+import zmq
+
+import pymeddle_common
+
+# requests answered by the first shard which owns the users
+user_opcodes = ('ping', 'get_users', 'get_user_names')
+# texts published on a channel which are commands for the server
+admin_commands = ('persist', 'server shutdown', 'rebuild index')
+
+
+def merge_tag_summaries(summaries):
+    """ adds up the get_active_tags answers of several shards """
+    _result = {}
+    for s in summaries:
+        for tag, c in s.items():
+            if tag not in _result:
+                _result[tag] = c
+                continue
+            _merged = _result[tag]
+            _merged['count'] += c['count']
+            for key in ('channels', 'users'):
+                for n, count in c[key].items():
+                    _merged[key][n] = _merged[key].get(n, 0) + count
+            for key in ('hours', 'days'):
+                _merged[key] = [a + b for a, b in zip(_merged[key], c[key])]
+    return _result
+
+
+class shard:
+    """ a meddle-server.py process and the sockets we talk to it with """
+
+    def __init__(self, context, number, count, port, directory, server_args):
+        self.number = number
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        _server = os.path.join(pymeddle_common.meddle_directory(),
+                               'meddle-server.py')
+        self.process = subprocess.Popen(
+            [sys.executable, _server, '--port', str(port),
+             '--shard', '%d/%d' % (number, count)] + server_args,
+            cwd=directory)
+        logging.info("started shard %d (pid %d) on port %d in '%s'",
+                     number, self.process.pid, port, directory)
+
+        self.rpc = context.socket(zmq.DEALER)
+        self.rpc.connect("tcp://127.0.0.1:%d" % port)
+        self.sub = context.socket(zmq.XSUB)
+        self.sub.connect("tcp://127.0.0.1:%d" % (port + 1))
+        self.heartbeat = context.socket(zmq.PUSH)
+        self.heartbeat.setsockopt(zmq.SNDHWM, 100)
+        self.heartbeat.setsockopt(zmq.LINGER, 0)
+        self.heartbeat.connect("tcp://127.0.0.1:%d" % (port + 2))
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+        self.process.wait()
+
+
+class tag_merger:
+    """ sums up the tag counts of all shards and numbers the changes like a
+        single server would (see tag_versions in meddle-server.py). A shard
+        we missed a delta of is loaded again - with a new generation so the
+        clients load everything again, too """
+
+    def __init__(self, count):
+        self.generation = int(time.time())
+        self.version = 0
+        self._shards = [{'generation': None, 'version': None, 'counts': {},
+                         'loading': True, 'deltas': []} for _ in range(count)]
+
+    def snapshot(self):
+        _counts = {}
+        for s in self._shards:
+            for t, c in s['counts'].items():
+                _counts[t] = _counts.get(t, 0) + c
+        return {'generation': self.generation,
+                'version': self.version,
+                'tags': _counts}
+
+    def loaded(self, number, snapshot):
+        """ takes the get_tag_counts answer of shard @number """
+        _shard = self._shards[number]
+        _shard.update(generation=snapshot['generation'],
+                      version=snapshot['version'],
+                      counts=snapshot['tags'],
+                      loading=False)
+        _deltas, _shard['deltas'] = _shard['deltas'], []
+        for d in _deltas:
+            self._apply(_shard, d)
+        self.generation += 1
+        self.version = 0
+
+    def delta(self, number, delta):
+        """ returns (delta to publish or None, whether shard @number has to
+            be loaded again) """
+        _shard = self._shards[number]
+        if _shard['loading']:
+            _shard['deltas'].append(delta)
+            return None, False
+        _result = self._apply(_shard, delta)
+        if _result == 'gap':
+            _shard['loading'] = True
+            _shard['deltas'] = [delta]
+            return None, True
+        if _result == 'old':
+            return None, False
+        self.version += 1
+        return {'generation': self.generation,
+                'version': self.version,
+                'tags': delta['tags']}, False
+
+    def _apply(self, shard, delta):
+        """ returns 'new', 'old' if @delta is contained in the counts of
+            @shard already or 'gap' if we missed deltas before it """
+        if (delta['generation'] != shard['generation'] or
+                delta['version'] > shard['version'] + 1):
+            return 'gap'
+        if delta['version'] <= shard['version']:
+            return 'old'
+        for t, c in delta['tags'].items():
+            shard['counts'][t] = shard['counts'].get(t, 0) + c
+        shard['version'] = delta['version']
+        return 'new'
+
+
+class search_merger:
+    """ gives every search one id for all shards it runs on and merges the
+        results the shards publish. Every shard sends its results newest
+        first, so a result is passed on as soon as every shard still running
+        has sent one at least as old - the limit then keeps the newest
+        results of all shards. Shards always stream - results for old
+        clients are collected and sent as one 'search_result' at the end """
+
+    def __init__(self):
+        self._last_id = 0
+        self._searches = {}     # {id: {'user', 'stream', 'limit', 'running',
+                                #       'buffered', 'count', 'truncated',
+                                #       'results'}}
+        self._ids = {}          # {(shard, shard search id): id}
+        self._answered = {}     # {shard: highest shard search id we know}
+        self._early = {}        # {(shard, shard search id): [notifications]}
+
+    def __len__(self):
+        return len(self._searches)
+
+    def start(self, user, stream, limit, shard_ids):
+        """ registers a search running on {shard: shard search id} - returns
+            its id and the notifications to publish which arrived before """
+        self._last_id += 1
+        self._searches[self._last_id] = {
+            'user': user, 'stream': stream, 'limit': limit,
+            'running': dict(shard_ids),
+            'buffered': {n: collections.deque() for n in shard_ids},
+            'count': 0, 'truncated': False, 'results': []}
+        _published = []
+        for n, i in shard_ids.items():
+            self._ids[(n, i)] = self._last_id
+            self._answered[n] = max(self._answered.get(n, 0), i)
+        for n, i in shard_ids.items():
+            for frames in self._early.pop((n, i), ()):
+                _published.extend(self.notification(n, frames))
+        return self._last_id, _published
+
+    def partial(self, search_id):
+        """ not all shards accepted search @search_id """
+        self._searches[search_id]['truncated'] = True
+
+    def cancel(self, user, search_id):
+        """ returns {shard: shard search id} to cancel or None """
+        _search = self._searches.get(search_id)
+        if _search is None or _search['user'] != user:
+            return None
+        del self._searches[search_id]
+        for n, i in _search['running'].items():
+            del self._ids[(n, i)]
+        return _search['running']
+
+    def notification(self, number, frames):
+        """ takes 'search_chunk' or 'search_done' @frames published by
+            shard @number and returns the notifications to publish instead """
+        _key = (number, int(frames[2]))
+        if _key not in self._ids:
+            if _key[1] > self._answered.get(number, 0):
+                # published before we got the answer to the search request
+                self._early.setdefault(_key, []).append(frames)
+            return []
+        _id = self._ids[_key]
+        _search = self._searches[_id]
+        _topic = frames[0]
+        _published = []
+        if frames[1] == b'search_chunk':
+            _search['buffered'][number].extend(
+                json.loads(frames[3].decode('utf-8')))
+        else:
+            _info = json.loads(frames[3].decode('utf-8'))
+            _search['truncated'] |= _info['truncated']
+            del self._ids[_key]
+            del _search['running'][number]
+
+        _results = self._merge(_search)
+        _search['count'] += len(_results)
+        if not _search['stream']:
+            _search['results'].extend(_results)
+        elif _results:
+            _published.append([_topic, b'search_chunk', str(_id).encode(),
+                               json.dumps(_results).encode()])
+        if _search['running']:
+            return _published
+        del self._searches[_id]
+        if _search['stream']:
+            _published.append([_topic, b'search_done', str(_id).encode(),
+                               json.dumps({'count': _search['count'],
+                                           'truncated': _search['truncated']}
+                                          ).encode()])
+        else:
+            _published.append([_topic, b'search_result',
+                               json.dumps(_search['results']).encode()])
+        return _published
+
+    @staticmethod
+    def _merge(search):
+        """ takes the buffered results of @search which can't be preceded by
+            any result still to come, newest first and up to the limit """
+        _buffered = search['buffered']
+        _room = search['limit'] - search['count']
+        _results = []
+        while len(_results) < _room:
+            if any(not _buffered[n] for n in search['running']):
+                break
+            _ready = [n for n, b in _buffered.items() if b]
+            if not _ready:
+                break
+            # results are [cuid, time, position, user, text]
+            _newest = max(_ready, key=lambda n: _buffered[n][0][1])
+            _results.append(_buffered[_newest].popleft())
+        if len(_results) == _room and any(_buffered.values()):
+            search['truncated'] = True
+            for b in _buffered.values():
+                b.clear()
+        return _results
+
+
+class broker:
+
+    def __init__(self, context, options):
+        self._port_rpc = options.port
+        self._port_pub = options.port + 1
+        self._port_heartbeat = options.port + 2
+
+        self._rpc_socket = context.socket(zmq.ROUTER)
+        self._rpc_socket.bind("tcp://*:%d" % self._port_rpc)
+        self._pub_socket = context.socket(zmq.XPUB)
+        self._pub_socket.bind("tcp://*:%d" % self._port_pub)
+        self._heartbeat_socket = context.socket(zmq.PULL)
+        self._heartbeat_socket.bind("tcp://*:%d" % self._port_heartbeat)
+
+        _server_args = shlex.split(options.server_args or '')
+        self._shards = [
+            shard(context, n, options.shards,
+                  options.shard_port + 3 * n,
+                  os.path.join(options.directory, 'shard-%d' % n),
+                  _server_args)
+            for n in range(options.shards)]
+
+        self._poller = zmq.Poller()
+        for s in (self._rpc_socket, self._pub_socket, self._heartbeat_socket):
+            self._poller.register(s, zmq.POLLIN)
+        for s in self._shards:
+            self._poller.register(s.rpc, zmq.POLLIN)
+            self._poller.register(s.sub, zmq.POLLIN)
+            # we need the tag deltas even if no client wants them
+            s.sub.send(b'\x01tags_delta')
+
+        self._last_token = 0
+        self._pending = {}      # {token: {'answers', 'missing', 'merge'}}
+        self._next_shard = 0    # gets the next new channel
+        self._tags = tag_merger(options.shards)
+        self._searches = search_merger()
+        self._requests = {}     # {opcode: count}
+        self._shutdown = False
+        for n in range(options.shards):
+            self._load_tags(n)
+
+    def run(self):
+        while True:
+            _events = dict(self._poller.poll(1000))
+            if self._rpc_socket in _events:
+                self._handle_request(self._rpc_socket.recv_multipart())
+            if self._heartbeat_socket in _events:
+                self._forward_heartbeats()
+            if self._pub_socket in _events:
+                self._forward_subscriptions()
+            for s in self._shards:
+                if s.rpc in _events:
+                    self._handle_answer(s.number, s.rpc.recv_multipart())
+                if s.sub in _events:
+                    self._forward_publications(s.number)
+            if self._check_shards():
+                return
+
+    def statistics(self):
+        return {'shards':   len(self._shards),
+                'requests': dict(self._requests),
+                'pending':  len(self._pending),
+                'searches': len(self._searches),
+                'tags':     {'generation': self._tags.generation,
+                             'version': self._tags.version}}
+
+    def stop(self):
+        for s in self._shards:
+            s.stop()
+
+    def _check_shards(self):
+        """ returns True when all shards are gone after a shutdown """
+        _running = [s for s in self._shards if s.process.poll() is None]
+        if self._shutdown:
+            return not _running
+        if len(_running) < len(self._shards):
+            raise RuntimeError("shard(s) %s terminated" % [
+                s.number for s in self._shards if s not in _running])
+        return False
+
+    def _send(self, number, token, frames):
+        self._shards[number].rpc.send_multipart(
+            [b'broker', token, b''] + [
+                f if isinstance(f, bytes) else f.encode('utf-8')
+                for f in frames])
+
+    def _ask(self, requests, merge, envelope=None):
+        """ sends {shard: frames} and calls @merge([answer, ..]) with the
+            answers ordered like the shard numbers when all arrived. What
+            @merge returns is the answer for @envelope """
+        if not requests:
+            self._answer(envelope, merge([]))
+            return
+        self._last_token += 1
+        _token = str(self._last_token).encode()
+        self._pending[_token] = {'envelope': envelope,
+                                 'answers': {},
+                                 'missing': set(requests),
+                                 'merge': merge}
+        for n, frames in requests.items():
+            self._send(n, _token, frames)
+
+    def _tell(self, number, frames):
+        """ sends a request whose answer we don't care about - its token
+            starts with '-' so _handle_answer() drops the answer """
+        self._last_token += 1
+        self._send(number, ('-%d' % self._last_token).encode(), frames)
+
+    def _answer(self, envelope, answer):
+        if envelope is None or answer is None:
+            return
+        self._rpc_socket.send_multipart(envelope + [
+            answer if isinstance(answer, bytes) else answer.encode('utf-8')])
+
+    def _forward(self, number, frames):
+        self._shards[number].rpc.send_multipart(frames)
+
+    def _handle_answer(self, number, frames):
+        if frames[0] != b'broker':
+            # answer to a forwarded request
+            self._rpc_socket.send_multipart(frames)
+            return
+        if frames[1].startswith(b'-'):
+            return
+        _pending = self._pending.get(frames[1])
+        if _pending is None:
+            logging.warning("got answer of unknown request %s", frames[1])
+            return
+        _pending['answers'][number] = frames[3]
+        _pending['missing'].discard(number)
+        if _pending['missing']:
+            return
+        del self._pending[frames[1]]
+        _answers = [a.decode('utf-8') for _, a in
+                    sorted(_pending['answers'].items())]
+        try:
+            _answer = _pending['merge'](_answers)
+        except Exception as ex:
+            logging.error("could not merge answers %s: %s", _answers, ex)
+            _answer = 'nok'
+        self._answer(_pending['envelope'], _answer)
+
+    def _handle_request(self, frames):
+        try:
+            _delimiter = frames.index(b'')
+            _envelope = frames[:_delimiter + 1]
+            _opcode = frames[_delimiter + 1].decode('utf-8')
+            _args = [f.decode('utf-8') for f in frames[_delimiter + 2:]]
+        except (ValueError, IndexError):
+            logging.warning("got malformed request with %d frames", len(frames))
+            return
+        self._requests[_opcode] = self._requests.get(_opcode, 0) + 1
+        try:
+            self._dispatch(frames, _envelope, _opcode, _args)
+        except Exception as ex:
+            logging.error("could not handle request '%s': %s", _opcode, ex)
+            self._answer(_envelope, 'nok')
+
+    def _dispatch(self, frames, envelope, opcode, args):
+        _all = range(len(self._shards))
+        _count = len(self._shards)
+
+        if opcode == 'hello':
+            _name = json.loads(args[0]).get('name')
+            self._ask({0: [opcode] + args},
+                      lambda a, n=_name: self._hello_answered(n, a), envelope)
+
+        elif opcode in user_opcodes:
+            self._forward(0, frames)
+
+        elif opcode in ('get_log', 'get_log_page'):
+            self._forward(pymeddle_common.shard_of(args[0], _count), frames)
+
+        elif opcode == 'rename_channel':
+            _cuid = json.loads(args[0]).get('cuid', '')
+            self._forward(pymeddle_common.shard_of(_cuid, _count), frames)
+
+        elif opcode == 'publish':
+            if args[2] in admin_commands:
+                self._ask({n: [opcode] + args for n in _all},
+                          lambda a, c=args[2]: self._admin_done(c, a),
+                          envelope)
+            else:
+                self._forward(pymeddle_common.shard_of(args[1], _count), frames)
+
+        elif opcode == 'create_channel':
+            self._forward(self._next_shard, frames)
+            self._next_shard = (self._next_shard + 1) % _count
+
+        elif opcode == 'get_channels':
+            _hint = json.loads(args[0])
+            _shard_hint = dict(_hint, versioned=False)
+            _shard_hint.pop('version', None)
+            self._ask({n: [opcode, json.dumps(_shard_hint)] for n in _all},
+                      lambda a, h=_hint: self._merge_channels(h, a), envelope)
+
+        elif opcode == 'get_channel_info':
+            _requests = {}
+            for c in json.loads(args[0])['channels']:
+                _requests.setdefault(pymeddle_common.shard_of(c, _count),
+                                     []).append(c)
+            self._ask({n: [opcode, json.dumps({'channels': c})]
+                       for n, c in _requests.items()},
+                      self._merge_channel_info, envelope)
+
+        elif opcode == 'get_active_tags':
+            self._ask({n: [opcode] for n in _all},
+                      lambda a: json.dumps(merge_tag_summaries(
+                          json.loads(x) for x in a)), envelope)
+
+        elif opcode == 'get_tag_counts':
+            self._answer(envelope, json.dumps(self._tags.snapshot()))
+
+        elif opcode in ('stats', 'log_writer_stats'):
+            self._ask({n: [opcode] for n in _all},
+                      lambda a: json.dumps({'broker': self.statistics(),
+                                            'shards': [json.loads(x) for x in a]}),
+                      envelope)
+
+        elif opcode == 'search':
+            _spec = json.loads(args[0])
+            _shard_spec = dict(_spec, stream=True)
+            self._ask({n: [opcode, json.dumps(_shard_spec)] for n in _all},
+                      lambda a, s=_spec: self._search_started(s, a), envelope)
+
+        elif opcode == 'cancel_search':
+            _cancel = json.loads(args[0])
+            _running = self._searches.cancel(_cancel['user'], _cancel['id'])
+            for n, i in (_running or {}).items():
+                self._tell(n, [opcode, json.dumps({'user': _cancel['user'],
+                                                   'id': i})])
+            self._answer(envelope, json.dumps({'ok': str(_running is not None)}))
+
+        else:
+            # let the server tell what it thinks about it
+            self._forward(0, frames)
+
+    def _hello_answered(self, name, answers):
+        _answer = json.loads(answers[0])
+        if _answer.get('accepted'):
+            _answer['sub_port'] = self._port_pub
+            _answer['heartbeat_port'] = self._port_heartbeat
+            # the request goes out before the client can publish anything
+            _mirrored = json.dumps({'id': _answer['id'], 'name': name})
+            for n in range(1, len(self._shards)):
+                self._tell(n, ['shard_user', _mirrored])
+        return json.dumps(_answer)
+
+    def _admin_done(self, command, answers):
+        if command == 'server shutdown':
+            logging.info("shards are shutting down")
+            self._shutdown = True
+        return 'ok' if all(a == 'ok' for a in answers) else 'nok'
+
+    def _merge_channels(self, hint, answers):
+        _channels = {}
+        for a in answers:
+            _channels.update(json.loads(a))
+        _channels = dict(heapq.nlargest(hint['count'], _channels.items(),
+                                        key=lambda x: x[1]))
+        if not hint.get('versioned'):
+            return json.dumps(_channels)
+        _version = zlib.crc32(
+            json.dumps(_channels, sort_keys=True).encode('utf-8')) & 0xffffffff
+        if hint.get('version') == _version:
+            return json.dumps({'version': _version})
+        return json.dumps({'version': _version, 'channels': _channels})
+
+    def _merge_channel_info(self, answers):
+        _result = []
+        for a in answers:
+            _info = json.loads(a)
+            if not isinstance(_info, list):
+                # one shard failed - like the server does when it fails
+                return json.dumps({})
+            _result.extend(_info)
+        return json.dumps(_result)
+
+    def _search_started(self, spec, answers):
+        _ids = {}
+        for n, a in enumerate(answers):
+            _answer = json.loads(a)
+            if _answer.get('ok') == 'True':
+                _ids[n] = _answer['id']
+        if not _ids:
+            return answers[0]
+        _id, _published = self._searches.start(
+            spec['user'], bool(spec.get('stream')),
+            spec.get('limit') or sys.maxsize, _ids)
+        if len(_ids) < len(answers):
+            logging.warning("search %d only runs on shards %s", _id, list(_ids))
+            self._searches.partial(_id)
+        for frames in _published:
+            self._pub_socket.send_multipart(frames)
+        return json.dumps({'ok': 'True', 'id': _id})
+
+    def _load_tags(self, number):
+        self._ask({number: ['get_tag_counts']},
+                  lambda a, n=number: self._tags.loaded(n, json.loads(a[0])))
+
+    def _forward_publications(self, number):
+        _socket = self._shards[number].sub
+        while _socket.poll(0):
+            _frames = _socket.recv_multipart()
+            _topic = _frames[0]
+            if _topic == b'server_alive':
+                if number != 0:
+                    continue
+            elif _topic == b'tags_delta':
+                _delta, _reload = self._tags.delta(
+                    number, json.loads(_frames[1].decode('utf-8')))
+                if _reload:
+                    logging.warning("missed tag delta of shard %d", number)
+                    self._load_tags(number)
+                if _delta is None:
+                    continue
+                _frames = [_topic, json.dumps(_delta).encode()]
+            elif (_topic.startswith(b'notify') and len(_frames) > 3 and
+                  _frames[1] in (b'search_chunk', b'search_done')):
+                for frames in self._searches.notification(number, _frames):
+                    self._pub_socket.send_multipart(frames)
+                continue
+            self._pub_socket.send_multipart(_frames)
+
+    def _forward_subscriptions(self):
+        while self._pub_socket.poll(0):
+            _subscription = self._pub_socket.recv()
+            if _subscription == b'\x00tags_delta':
+                # we still need them
+                continue
+            for s in self._shards:
+                s.sub.send(_subscription)
+
+    def _forward_heartbeats(self):
+        while self._heartbeat_socket.poll(0):
+            _heartbeat = self._heartbeat_socket.recv()
+            for s in self._shards:
+                try:
+                    s.heartbeat.send(_heartbeat, zmq.NOBLOCK)
+                except zmq.Again:
+                    pass
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-p", "--port", dest="port", type="int", default=32100,
+                      help="port clients connect to - like meddle-server.py "
+                           "the next two ports are used, too")
+    parser.add_option("-n", "--shards", dest="shards", type="int",
+                      default=os.cpu_count() or 1,
+                      help="number of server processes (default: number of CPUs)")
+    parser.add_option("--shard-port", dest="shard_port", type="int",
+                      help="first port of the shards - each one uses three "
+                           "(default: --port + 10)")
+    parser.add_option("-d", "--directory", dest="directory", default=".",
+                      help="directory containing the shard-<number> directories")
+    parser.add_option("--server-args", dest="server_args", metavar="ARGS",
+                      help="additional arguments for meddle-server.py, e.g. "
+                           "'--storage sqlite'")
+    (options, args) = parser.parse_args()
+    if options.shards < 1:
+        parser.error("need at least one shard")
+    if options.shard_port is None:
+        options.shard_port = options.port + 10
+
+    # make sure the shards get stopped
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+    _context = zmq.Context()
+    _broker = broker(_context, options)
+    logging.info("meddle broker listening on port %d with %d shards",
+                 options.port, options.shards)
+    try:
+        _broker.run()
+    finally:
+        _broker.stop()
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s (%(thread)d) %(levelname)s %(message)s",
+        datefmt="%y%m%d-%H%M%S",
+        level=logging.INFO)
+    logging.addLevelName(logging.CRITICAL, "(CRITICAL)")
+    logging.addLevelName(logging.ERROR,    "(EE)")
+    logging.addLevelName(logging.WARNING,  "(WW)")
+    logging.addLevelName(logging.INFO,     "(II)")
+    logging.addLevelName(logging.DEBUG,    "(DD)")
+    logging.addLevelName(logging.NOTSET,   "(NA)")
+
+    main()
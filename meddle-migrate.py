@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" copies the messages and the persisted state of a meddle server from one
+    storage backend to another, e.g.
+
+        meddle-migrate.py --from files --to sqlite
+
+    run it in the directory of the server while the server is stopped
+"""
+
+import logging
+import sys
+from optparse import OptionParser
+
+import pymeddle_storage
+
+
+def up_to_date(storage):
+    """ tells whether the persisted state contains all stored messages """
+    _checkpoint = storage.load_state('checkpoint') or {}
+    for c in storage.channel_ids():
+        if c not in _checkpoint:
+            return False
+        _messages, _friendlyname = storage.replay(c, _checkpoint[c])
+        if _messages or _friendlyname is not None:
+            return False
+    return True
+
+def migrate(source, target):
+    _complete = up_to_date(source)
+    _count = 0
+    for c in source.channel_ids():
+        for event in source.events(c):
+            if event[0] == 'name':
+                target.append_friendly_name(c, event[1])
+            else:
+                _, _timestamp, _user, _text = event
+                target.append_message(_timestamp, c, _user, _text)
+                _count += 1
+        target.flush()
+        logging.info("copied channel '%s'", c)
+
+    # channels, tags and index are derived from the messages and can be
+    # rebuilt - the users can not
+    for name in ('user', 'channels', 'tags', 'index'):
+        if name != 'user' and not _complete:
+            continue
+        _data = source.load_state(name)
+        if _data is not None:
+            target.save_state(name, _data)
+    if _complete:
+        target.save_state('checkpoint', target.checkpoint())
+    else:
+        logging.warning("the persisted state does not contain all messages - "
+                        "start the server once with --rebuild")
+    return _count
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--from", dest="source", default="files",
+                      type="choice", choices=pymeddle_storage.backends,
+                      help="backend to read from: files or sqlite")
+    parser.add_option("--to", dest="target", default="sqlite",
+                      type="choice", choices=pymeddle_storage.backends,
+                      help="backend to write to: files or sqlite")
+    parser.add_option("--database", dest="database", default="server.sqlite",
+                      metavar="FILE", help="database file of the sqlite backend")
+    parser.add_option("-f", "--force", dest="force", action="store_true",
+                      default=False,
+                      help="write even if the target already contains messages")
+    (options, args) = parser.parse_args()
+
+    if options.source == options.target:
+        parser.error("source and target backend are the same")
+
+    _source = pymeddle_storage.create_storage(options.source, options.database)
+    _target = pymeddle_storage.create_storage(options.target, options.database,
+                                              policy='idle')
+    if _target.channel_ids() and not options.force:
+        logging.error("target already contains messages - use --force to "
+                      "append anyway")
+        sys.exit(1)
+
+    _source.prepare()
+    _count = migrate(_source, _target)
+    _target.close()
+    _source.close()
+    logging.info("copied %d messages from %s to %s", _count,
+                 options.source, options.target)
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s (%(thread)d) %(levelname)s %(message)s",
+        datefmt="%y%m%d-%H%M%S",
+        level=logging.INFO)
+    logging.addLevelName(logging.CRITICAL, "(CRITICAL)")
+    logging.addLevelName(logging.ERROR,    "(EE)")
+    logging.addLevelName(logging.WARNING,  "(WW)")
+    logging.addLevelName(logging.INFO,     "(II)")
+    logging.addLevelName(logging.DEBUG,    "(DD)")
+    logging.addLevelName(logging.NOTSET,   "(NA)")
+
+    main()
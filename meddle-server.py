@@ -8,71 +8,61 @@ import logging
 import json
 import time
 import os
+import signal
+import socket
 import sys
-import glob
 import datetime
+import heapq
+import functools
+import tempfile
+import math
 import pymeddle_common
-from threading import Thread
+import pymeddle_index
+import pymeddle_logs
+import pymeddle_stats
+import pymeddle_storage
+import pymeddle_tags
+import pymeddle_wire
+from optparse import OptionParser
+from threading import Thread, Lock
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
 
 try:
     FileNotFoundError
 except NameError:
     FileNotFoundError = IOError
 
-def timestamp_str():
-    return datetime.datetime.fromtimestamp(time.time()).strftime('%Y%m%d%H%M%S%f')
+def timestamp_str(t=None):
+    return datetime.datetime.fromtimestamp(
+        time.time() if t is None else t).strftime('%Y%m%d%H%M%S%f')
 
-def from_timestamp(time_string):
-    try:
-        x = time.strptime(time_string,'%Y%m%d%H%M%S%f')
-        return time.mktime(x)
-    except:
-        return 0
-
-def publish(socket, timestamp, participant, channel, text):
+def publish(socket, t, participant, participant_id, channel, text, seq,
+            encodings=('json',)):
+    """ publishes a message once for every encoding in @encodings somebody
+        subscribed to - with @seq, its position in the channel, as sequence
+        number. Returns the timestamp string to store it with """
     logging.debug("%s publishes to '%s': '%s'" % (participant, channel, text))
     # socket.send_multipart([(channel + text).encode(), participant.encode()])
+    _timestamp = timestamp_str(t)
 
-    socket.send_multipart(
-        tuple(str(x).encode()
-              for x in (channel, json.dumps(
-                  {'user':participant,
-                   'time':timestamp,
-                   'text':text}))))
-
-    with open('_%s.log' % channel, 'a') as f:
-        f.write("%s: %s: %s: %s\n" % (timestamp, channel, participant, text))
-
-def find_logs():
-    _ret = []
-    for i in glob.glob('_*.log'):
-        _ret.append(i[1:-4])
-    return _ret
-
-def get_log(channel, friendlyname=None):
-    _return = []
-    _friendlyname = None
-    try:
-        _filename = '_%s.log' % channel
-        for l in open(_filename).readlines():
-            if l.startswith('friendlyname='):
-                _friendlyname = l[len('friendlyname='):]
-                continue
-            _t = from_timestamp(l[: l.find(':')].strip())
-            l = l[l.find(':')+1:]
-            _c = l[: l.find(':')].strip()
-            l = l[l.find(':')+1:]
-            _p = l[: l.find(':')].strip()
-            _x = l[l.find(':')+1:].strip()
-            _l = (_t, _p, _x)
-            _return.append(_l)
-    except Exception as ex:
-        logging.warning("could not open '%s' %s", _filename, ex)
-    
-    if friendlyname is not None and _friendlyname is not None:
-        friendlyname[0] = _friendlyname
-
-    return _return
+    if 'json' in encodings and socket.wanted(channel.encode('utf-8')):
+        socket.send_multipart(
+            tuple(str(x).encode()
+                  for x in (channel, json.dumps(
+                      {'user':participant,
+                       'time':_timestamp,
+                       'text':text,
+                       'seq':seq}))))
+    _topic = pymeddle_wire.binary_topic(channel)
+    if 'binary' in encodings and socket.wanted(_topic):
+        socket.send_multipart(
+            (_topic,
+             pymeddle_wire.pack_message(seq, participant_id, t, text)))
+    return _timestamp
 
 def random_string(N, chars=None):
     if not chars:
@@ -81,64 +71,87 @@ def random_string(N, chars=None):
         random.choice(chars)
         for _ in range(N))
 
-def create_uid():
-    """ creates a 16 digit uid with 9 time based and 7 random characters """
-    return random_string(5, string.hexdigits.lower())
+def create_uid(shard=None):
+    """ creates a 16 digit uid with 9 time based and 7 random characters.
+        With @shard=(number, count) only uids living on that shard """
+    while True:
+        _uid = random_string(5, string.hexdigits.lower())
+        if shard is None or pymeddle_common.shard_of(_uid, shard[1]) == shard[0]:
+            return _uid
     # return ("%x" % (int(time.time()) * 0x10 % 0x1000000000)
     #         + random_string(7, string.hexdigits.lower()))
 
-def replace(in_str, src_characters, tgt_characters=' '):
-    for c in src_characters:
-        in_str = in_str.replace(c, tgt_characters)
-    return in_str
-
-def extract_tags(text):
-    return [x.lower() for x in replace(text, '.,;?!:\'"').split(' ')
-            if len(x) > 1 and x[0] == '#']
-
 def handle_tags(socket, channel, user, text):
-    _contained_tags = extract_tags(text)
+    _contained_tags = pymeddle_index.extract_tags(text)
     logging.info("tags mentioned: %s", _contained_tags)
     for t in _contained_tags:
+        if not socket.wanted(("tag%s" % t).encode('utf-8')):
+            continue
         socket.send_multipart(
             tuple(str(x).encode()
                   for x in ("tag%s" % t, channel, user, text)))
 
     return _contained_tags
 
-def store_tags(all_tags, tags, channel, user):
-    """ 0: no changes,
-        1<<2: minor tagging (same channel and user),
-        1<<4: new tag on user,
-        1<<6: new tag this day,
-        1<<8: new tag on channel,
-        1<<16: new tag """
-    _result = 0
-    if tags == []:
-        return False
-    for t in tags:
-        if t not in all_tags:
-            _result += 1<<16
-            all_tags[t] = []
-        all_tags[t].append((time.time(), channel, user))
-        _result += 1<<2
-    return _result
-
 def publish_user_list(socket, users):
+    if not socket.wanted(b"user_update"):
+        return
     socket.send_multipart(
             ["user_update".encode(),
              json.dumps(users.users_online()).encode()])
 
 def publish_channel_list(socket, channels):
+    if not socket.wanted(b"channels_update"):
+        return
     socket.send_multipart(
             ["channels_update".encode(),
              json.dumps(
                  {x:list(y.participants) for x, y in channels.items()}).encode()])
 
-def publish_tags(socket, all_tags):
+class tag_versions:
+    """ numbers the changes of the tag statistics so clients can apply
+        incremental updates and detect when they missed one. The generation
+        changes with every server start """
+
+    def __init__(self):
+        self.generation = int(time.time())
+        self.version = 0
+
+    def snapshot(self, counts):
+        return {'generation': self.generation,
+                'version': self.version,
+                'tags': counts}
+
+    def delta(self, tags):
+        self.version += 1
+        return {'generation': self.generation,
+                'version': self.version,
+                'tags': {t: tags.count(t) for t in set(tags)}}
+
+def publish_tags_delta(socket, delta):
+    if not socket.wanted(b"tags_delta"):
+        return
     socket.send_multipart(
-            ["tags_update".encode(),
-             json.dumps(all_tags).encode()])
+            ["tags_delta".encode(),
+             json.dumps(delta).encode()])
+
+def publish_alive(socket):
+    socket.send_multipart(["server_alive".encode()])
+
+def handle_heartbeats(socket, pub_socket, users):
+    """ reads all heartbeats waiting on @socket and refreshes their senders
+        in one go. Senders we consider offline get asked to say hello """
+    _ids = set()
+    while socket.poll(0):
+        _ids.add(socket.recv())
+    for i in _ids:
+        try:
+            _id = int(i)
+        except ValueError:
+            continue
+        if not users.refresh(_id):
+            logging.warning("user with id %d marked offline but sending", _id)
+            notify_user(pub_socket, _id, 'hello_again')
 
 def notify_user(socket, user_id, msg):
     if type(msg) in (list, tuple):
@@ -148,107 +161,362 @@ def notify_user(socket, user_id, msg):
     else:
         socket.send_multipart((("notify%d" % user_id).encode(), msg.encode()))
 
-def start_search(socket, search_spec):
-    _result = []
-    _term = search_spec['term'].lower()
-    for _cuid in find_logs():
-        for l, (t, u, x) in enumerate(get_log(_cuid)):
-            if _term in x.lower():
-                print(x)
-                _result.append((_cuid, t, l, u, x))
-    print(search_spec)
-    notify_user(socket, search_spec['user'], ('search_result',
-                                              json.dumps(_result)))
-
-def load_channels(filename):
+search_chunk_size = 100
+
+def resolve_channels(channels, names):
+    """ returns the ids of the channels with an id or friendly name in
+        @names - or of all channels if there are no @names """
+    if not names:
+        return list(channels.keys())
+    return [c for c, i in channels.items() if c in names or i.friendly_name in names]
+
+def matches(query, t, user, text):
+    return ((query['since'] is None or t >= query['since']) and
+            (query['until'] is None or t <= query['until']) and
+            (not query['users'] or user in query['users']) and
+            query['text'] in text.lower() and
+            (not query['tags'] or
+             set(query['tags']) <= set(pymeddle_index.extract_tags(text))))
+
+def channel_hits(storage, cuid, positions, query):
+    """ yields (cuid, time, position, user, text) for the messages of @cuid
+        matching @query, newest first. Only @positions are read - or all
+        messages in the time range of @query if @positions is None """
+    _first, _end = storage.time_positions(cuid, query['since'], query['until'])
+    if positions is None:
+        while _end > _first:
+            _start = max(_first, _end - search_chunk_size)
+            _, _messages = storage.read_messages(cuid, _start, _end)
+            for l, t, u, x in reversed(_messages):
+                if matches(query, t, u, x):
+                    yield (cuid, t, l, u, x)
+            _end = _start
+        return
+    _positions = sorted((p for p in positions if _first <= p < _end), reverse=True)
+    for i in range(0, len(_positions), search_chunk_size):
+        for l, t, u, x in reversed(storage.read_positions(
+                cuid, _positions[i:i + search_chunk_size])):
+            if matches(query, t, u, x):
+                yield (cuid, t, l, u, x)
+
+def search_messages(storage, candidates, query, channels):
+    """ yields (cuid, time, position, user, text) for all messages in
+        @channels matching @query, newest first. The @candidates
+        [(cuid, position), ..] the index found (None if it can't tell) narrow
+        down the messages to read, the time range of @query the positions """
+    _candidates = candidates
+    if _candidates is None:
+        _streams = [channel_hits(storage, c, None, query) for c in channels]
+    else:
+        _channels = set(channels)
+        _hits = {}
+        for _cuid, _pos in _candidates:
+            if _cuid in _channels:
+                _hits.setdefault(_cuid, []).append(_pos)
+        _streams = [channel_hits(storage, c, p, query) for c, p in _hits.items()]
+    return heapq.merge(*_streams, key=lambda x: x[1], reverse=True)
+
+def get_log_page(storage, channel, page):
+    try:
+        _size, _messages = storage.read_messages(
+            channel, page.get('since'), page.get('before'), page.get('limit'))
+    except Exception as ex:
+        logging.error("exception in get_log_page(): %s", ex)
+        _size, _messages = 0, []
+    if page.get('encoding') == 'binary':
+        return pymeddle_wire.pack_page(_size, _messages)
+    return json.dumps({'size': _size, 'messages': _messages})
+
+def load_channels(storage):
     try:
         _res = {}
-        _data = json.load(open(filename))
+        _data = storage.load_state('channels') or {}
         for n, c in _data.items():
             _res[n] = channel(n, c)
         return _res
-    except FileNotFoundError:
-        logging.debug("file '%s' was not found - start with empty channel db",
-                      filename)
-        return {}
     except KeyError:
-        logging.debug("missing content in file '%s' - start with empty channel db",
-                      filename)
+        logging.debug("missing content in stored channels - start with empty channel db")
         return {}
 
-def load_tags(filename):
-    try:
-        _res = {}
-        _data = json.load(open(filename))
-        for c, t in _data.items():
-            _res[c] = [(_a, _b, _c) for _a, _b, _c in t ]
-        return _res
-    except FileNotFoundError:
-        return {}
-
-def persist(users, channels, tags):
-    logging.info("write persistent data..")
-
-    users.save('server-user.db')
-    assert users == user_container().load('server-user.db')
-
-    json.dump({n:c.to_JSON() for n, c in channels.items()},
-              open('server-channels.db', 'w'))
-    assert channels == load_channels('server-channels.db')
+def channel_sizes(storage):
+    """ returns {cuid: number of stored messages} - the position the next
+        message of each channel gets """
+    return {c: storage.read_messages(c, limit=0)[0] for c in storage.channel_ids()}
+
+# persisted states in the order they get written - the checkpoint comes last
+# so it is never ahead of the other states
+snapshot_names = ('user', 'channels', 'tags', 'index', 'checkpoint')
+
+def snapshot_states(users, channels):
+    """ returns [(state name, data), ..] of what the main loop persists -
+        the stages add the rest """
+    return [('user', users.snapshot()),
+            ('channels', {n:c.to_JSON() for n, c in channels.items()})]
+
+
+class snapshot_writer:
+    """ writes the persistent data in the background. In mode 'fork' a child
+        process serializes and writes the states, so they don't compete with
+        the rest of the persistence stage for the interpreter - in mode
+        'thread' a thread does. There is only one snapshot written at a time """
+
+    modes = ('fork', 'thread')
+
+    def __init__(self, storage, mode='fork'):
+        if mode == 'fork' and not hasattr(os, 'fork'):
+            logging.warning("fork() is not available - write snapshots on a thread")
+            mode = 'thread'
+        self.mode = mode
+        self._storage = storage
+        self._thread = None
+        self._counters = {'written': 0, 'failed': 0, 'skipped': 0}
+        self._last = None
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, states):
+        """ starts writing [(state name, data), ..] unless the last snapshot
+            is still being written - returns whether it did. Nobody else may
+            touch @states afterwards """
+        if self.running():
+            logging.info("last snapshot still being written - skip this one")
+            self._counters['skipped'] += 1
+            return False
+        logging.info("write persistent data..")
+        if self.mode == 'fork':
+            _target = self._wait_for_child
+            _args = self._fork(states)
+        else:
+            _target = self._write
+            _args = (states,)
+        self._thread = Thread(target=_target, args=_args)
+        self._thread.daemon = True
+        self._thread.start()
+        return True
 
-    json.dump(tags, open('server-tags.db', 'w'))
-    t = load_tags('server-tags.db')
-    assert tags == t
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    def statistics(self):
+        return dict(self._counters, mode=self.mode, running=self.running(),
+                    last=self._last)
+
+    def _fork(self, states):
+        """ returns (pid, pipe) of the writing child process """
+        _read, _write = os.pipe()
+        _pid = os.fork()
+        if _pid != 0:
+            os.close(_write)
+            return _pid, _read
+        # the child must never return into the main loop and must not log:
+        # the logging lock might have been held by a thread which is gone
+        _code = 1
+        try:
+            os.close(_read)
+            self._storage.after_fork()
+            _result = {'size': self._storage.save_states(states)}
+            _code = 0
+        except BaseException as ex:
+            _result = {'error': str(ex)}
+        try:
+            os.write(_write, json.dumps(_result).encode('utf-8'))
+        finally:
+            os._exit(_code)
+
+    def _wait_for_child(self, pid, pipe):
+        _start = time.time()
+        with os.fdopen(pipe, 'rb') as f:
+            _data = f.read()
+        os.waitpid(pid, 0)
+        try:
+            _result = json.loads(_data.decode('utf-8'))
+        except ValueError:
+            _result = {'error': "snapshot process %d died" % pid}
+        self._finished(_result, time.time() - _start)
 
+    def _write(self, states):
+        _start = time.time()
+        try:
+            _result = {'size': self._storage.save_states(states)}
+        except Exception as ex:
+            _result = {'error': str(ex)}
+        self._finished(_result, time.time() - _start)
+
+    def _finished(self, result, duration):
+        if 'error' in result:
+            self._counters['failed'] += 1
+            logging.error("writing snapshot failed: %s", result['error'])
+            return
+        self._counters['written'] += 1
+        self._last = {'time': time.time(), 'duration_s': duration,
+                      'size': result['size']}
+        logging.info("wrote snapshot of %d bytes in %.2fs", result['size'], duration)
+
+
+def apply_messages(channels, all_tags, index, cuid, messages, friendlyname=None,
+                   with_index=True):
+    """ applies @messages [(time, user, text), ..] of channel @cuid """
+    if cuid not in channels:
+        channels[cuid] = channel(cuid)
+    if with_index:
+        index.add_channel(cuid, [])
+    for t, u, x in messages:
+        _tokens = pymeddle_index.tokenize(x)
+        channels[cuid].add_participant(u, t)
+        channels[cuid].add_tags(_tokens.tags)
+        all_tags.add(_tokens.tags, cuid, u, t, record=False)
+        if with_index:
+            index.add(cuid, u, _tokens)
+    if friendlyname is not None:
+        channels[cuid].friendly_name = friendlyname
+    return len(messages)
+
+def refresh_channel_information(storage, channels, all_tags, index, checkpoint,
+                                force=False):
+    """ brings the loaded state up to date with the stored messages. Only
+        messages written after the last checkpoint get replayed - unless
+        @force demands a full rebuild """
+    storage.prepare()
+    _available_channels = storage.channel_ids()
+
+    if force:
+        logging.info("rebuild all channel information from stored messages")
+        channels.clear()
+        all_tags.clear()
+        index.clear()
+        checkpoint = {}
 
-def refresh_channel_information(channels, all_tags, force=False):
-    _available_channels = find_logs()
-    _information_complete = not force
-    if _information_complete:
-        for c in _available_channels:
-            if not c in channels:
-                logging.info("missing information about channel '%s' - rebuild db", c)
-                _information_complete = False
-                break
-    if _information_complete:
-        return
+    for c in _available_channels:
+        _indexed = index.knows_channels([c])
+        if not _indexed:
+            # the index alone can always be rebuilt from scratch
+            index.add_channel(c, storage.get_log(c))
+        if c not in checkpoint:
+            if c in channels:
+                # state written before checkpoints existed
+                continue
+            logging.info("    load channel '%s'", c)
+            apply_messages(channels, all_tags, index, c,
+                           *storage.replay(c, None), with_index=False)
+            continue
+        _messages, _friendlyname = storage.replay(c, checkpoint[c])
+        _count = apply_messages(channels, all_tags, index, c, _messages,
+                                _friendlyname, _indexed)
+        if _count > 0:
+            logging.info("    replayed %d new messages of channel '%s'", _count, c)
+
+class channel_ranking:
+    """ keeps track of which channels can score for a user or a tag so
+        get_channels only has to look at those instead of every channel.
+        A channel scores for a user who is among its last contributors
+        (more the more recent) or a participant and for every hinted tag
+        mentioned in it """
 
-    channels.clear()
-    all_tags.clear()
+    def __init__(self):
+        self._contributed = {}      # {user: set(cuid)}
+        self._participating = {}    # {user: set(cuid)}
+        self._tagged = {}           # {tag: set(cuid)}
+        self._user_versions = {}    # {user: number of changes}
+        self._tag_versions = {}     # {tag: number of changes}
+        self._channel_count = 0
+        self._cache = {}            # {(user, tags, count): (version, result)}
+
+    def rebuild(self, channels):
+        for d in (self._contributed, self._participating, self._tagged,
+                  self._user_versions, self._tag_versions, self._cache):
+            d.clear()
+        self._channel_count = 0
+        for n, c in channels.items():
+            self._channel_count += 1
+            for u in c.last_contributors:
+                self._contributed.setdefault(u, set()).add(n)
+            for u in c.participants:
+                self._participating.setdefault(u, set()).add(n)
+            for t in c.tags:
+                self._tagged.setdefault(t, set()).add(n)
+
+    def add_channel(self, channels, cuid, creator):
+        channels[cuid] = channel(cuid)
+        channels[cuid].participants.add(creator)
+        self._channel_count += 1
+        self._participating.setdefault(creator, set()).add(cuid)
+        self._touch_user(creator)
+
+    def add_participant(self, channels, cuid, name, time):
+        _channel = channels[cuid]
+        _before = set(_channel.last_contributors)
+        _result = _channel.add_participant(name, time)
+        for u in _before - set(_channel.last_contributors):
+            self._contributed[u].discard(cuid)
+            self._touch_user(u)
+        self._contributed.setdefault(name, set()).add(cuid)
+        self._participating.setdefault(name, set()).add(cuid)
+        self._touch_user(name)
+        return _result
 
-    for c in _available_channels:
-        logging.info("    load channel '%s'", c)
-        channels[c] = channel(c)
-        _fn_ptr = [None]
-        _logs = get_log(c, _fn_ptr)
-        for t, u, x in _logs:
-            _tags = extract_tags(x)
-            channels[c].add_participant(u, t)
-            channels[c].add_tags(_tags)
-            store_tags(all_tags, _tags, c, u)
-        if _fn_ptr[0] is not None:
-            channels[c].friendly_name = _fn_ptr[0]
-            
-def filter_channels(channels, all_tags, user, hint):
-    _channel_list = [[n, c, 0] for n, c in channels.items()]
-    _count = hint['count']
-    for i, t in enumerate(_channel_list):
-        if user in t[1].last_contributors:
-            _since = (int(time.time()) - t[1].last_contributors[user])/3600.
-            t[2] += max(0, int(100 - _since))
-        if user in t[1].participants:
-            t[2] += 5
-        for tag in hint['tags']:
-            if tag not in t[1].tags: continue
-            t[2] += t[1].tags[tag] * 1
-
-    _channel_list = sorted(_channel_list, key=lambda x: x[2], reverse=True)[:_count]
-    _channel_list = [(n, s) for n, _, s in _channel_list]
-
-    print('hint:  %s' % hint)
-    for n, s in _channel_list:
-        print('   - %d: %s' % (s, n))
-    return _channel_list
+    def add_tags(self, channels, cuid, tags):
+        channels[cuid].add_tags(tags)
+        for t in tags:
+            self._tagged.setdefault(t, set()).add(cuid)
+            self._tag_versions[t] = self._tag_versions.get(t, 0) + 1
+
+    def version(self, user, tags, hour):
+        """ changes whenever the result for @user and @tags could change -
+            recency scores count whole hours, so they only change with
+            @hour (hours since the epoch) """
+        return "%d.%d.%d.%d" % (
+            self._user_versions.get(user, 0),
+            sum(self._tag_versions.get(t, 0) for t in tags),
+            self._channel_count,
+            hour)
+
+    def filter_channels(self, channels, user, hint):
+        """ returns (version, [(cuid, score), ..]) for the hint['count']
+            channels with the highest score """
+        _count = hint['count']
+        _tags = tuple(sorted(set(hint['tags'])))
+        _hour = int(time.time()) // 3600
+        _version = self.version(user, _tags, _hour)
+        _key = (user, _tags, _count)
+        if _key in self._cache and self._cache[_key][0] == _version:
+            return self._cache[_key]
+
+        _candidates = set(self._contributed.get(user, ()))
+        _candidates.update(self._participating.get(user, ()))
+        for t in _tags:
+            _candidates.update(self._tagged.get(t, ()))
+
+        def score(n):
+            c = channels[n]
+            _score = 0
+            if user in c.last_contributors:
+                _since = _hour - c.last_contributors[user] // 3600
+                _score += max(0, 100 - _since)
+            if user in c.participants:
+                _score += 5
+            for tag in _tags:
+                _score += c.tags.get(tag, 0)
+            return _score
+
+        _channel_list = heapq.nlargest(
+            _count, ((n, score(n)) for n in _candidates), key=lambda x: x[1])
+        if len(_channel_list) < _count:
+            # fill up with channels which do not score at all
+            for n in channels:
+                if len(_channel_list) >= _count:
+                    break
+                if n not in _candidates:
+                    _channel_list.append((n, 0))
+
+        if len(self._cache) > 1000:
+            self._cache.clear()
+        self._cache[_key] = (_version, _channel_list)
+        return _version, _channel_list
+
+    def _touch_user(self, user):
+        self._user_versions[user] = self._user_versions.get(user, 0) + 1
 
 class channel(object):
 
@@ -302,40 +570,42 @@ class user:
 
 class user_container:
 
-    def __init__(self):
+    def __init__(self, timeout=5):
         #[item for item in a if item[0] == 1]
         #[(id, item) for id, item in a.items() if item[1] == 'user2']
         # users (id, name, user)
         self._next_id = 0
         self._users_online = {}     # {id: (name, user)}
         self._associated_ids = {}   # {name: id}, permanent
+        # timer wheel with one slot per second: a user who has not pinged
+        # for more than @timeout seconds expires in the slot of second
+        # int(last_ping + timeout) + 1
+        self._timeout = timeout
+        self._wheel = [set() for _ in range(int(math.ceil(timeout)) + 2)]
+        self._deadlines = {}        # {id: second of expiry}
+        self._wheel_time = int(time.time())  # last second already expired
 
     def __eq__(self, other):
         return (self._next_id == other._next_id and
                 self._associated_ids == other._associated_ids)
 
-    def load(self, filename):
+    def load(self, storage):
         try:
-            with open(filename) as f:
-                _data = json.loads(f.read())
+            _data = storage.load_state('user')
+            if _data is not None:
                 self._next_id = _data['next_id']
                 self._associated_ids = _data['user_data']
-                return self
         except Exception as ex:
             print(ex)
+        return self
 
-    def save(self, filename):
-        #try:
-            #print(json.dumps(data))
-        #except Exception as ex:
-            #print(ex)
+    def snapshot(self):
+        """ returns the JSON compatible state saved by save() """
+        return {'next_id': self._next_id,
+                'user_data': self._associated_ids}
 
-        try:
-            with open(filename, 'w') as f:
-                f.write(self.to_JSON())
-
-        except Exception as ex:
-            print(ex)
+    def save(self, storage):
+        storage.save_state('user', self.snapshot())
 
     def to_JSON(self):
         return json.dumps(
@@ -363,6 +633,7 @@ class user_container:
         _new_user = False
         if _id not in self._users_online:
             self._users_online[_id] = (name, user())
+            self._schedule(_id)
             _new_user = True
         _, _user = self._users_online[_id]
         return (_new_user, _id, _user)
@@ -374,10 +645,25 @@ class user_container:
         return None
 
     def get_id(self, name):
-        return self._associated_ids[name]['id']
+        """ returns the id of user @name or None if we don't know him """
+        return self._associated_ids.get(name, {}).get('id')
+
+    def mirror(self, user_id, name):
+        """ takes over a user who said hello to the first shard """
+        self._associated_ids[name] = {'id': user_id}
+        if user_id not in self._users_online:
+            self._users_online[user_id] = (name, user())
+        self.refresh(user_id)
+
+    def get_names(self, user_ids):
+        """ returns {id: name} for all known @user_ids """
+        _names = {v['id']: n for n, v in self._associated_ids.items()}
+        return {i: _names[i] for i in user_ids if i in _names}
 
     def set_offline(self, user_ids):
-        for i in user_ids: del self._users_online[i]
+        for i in user_ids:
+            del self._users_online[i]
+            self._unschedule(i)
 
     def users_online(self):
         return [self._users_online[u][0] for u in self._users_online]
@@ -386,205 +672,1346 @@ class user_container:
         if not user_id in self._users_online:
             return False
         self._users_online[user_id][1].last_ping = time.time()
+        self._schedule(user_id)
         return True
 
     def find_dead(self):
+        """ returns the ids of all users which timed out. Only the wheel
+            slots of the seconds passed since the last call are visited """
         _result = []
-        _now = time.time()
-        for _id, _user in self._users_online.items():
-            if _now - _user[1].last_ping > 5:
+        _now = int(time.time())
+        _size = len(self._wheel)
+        _first = max(self._wheel_time + 1, _now - _size + 1)
+        for _second in range(_first, _now + 1):
+            _slot = self._wheel[_second % _size]
+            for _id in [i for i in _slot if self._deadlines[i] <= _now]:
+                _slot.discard(_id)
+                del self._deadlines[_id]
                 _result.append(_id)
+        self._wheel_time = max(self._wheel_time, _now)
         if len(_result) > 0:
             logging.info("users %s timeouted" % _result)
         return _result
 
+    def next_expiry(self):
+        """ returns the seconds until find_dead() can find somebody or None """
+        if not self._deadlines:
+            return None
+        _size = len(self._wheel)
+        for _second in range(self._wheel_time + 1, self._wheel_time + _size + 1):
+            if self._wheel[_second % _size]:
+                return max(0., _second - time.time())
+        return None
+
+    def _schedule(self, user_id):
+        self._unschedule(user_id)
+        _deadline = int(self._users_online[user_id][1].last_ping + self._timeout) + 1
+        self._deadlines[user_id] = _deadline
+        self._wheel[_deadline % len(self._wheel)].add(user_id)
+
+    def _unschedule(self, user_id):
+        if user_id in self._deadlines:
+            _deadline = self._deadlines.pop(user_id)
+            self._wheel[_deadline % len(self._wheel)].discard(user_id)
+
+
+class rpc_request:
+    """ a request received on the ROUTER socket. Reading the request frames
+        and answering works like on the REP socket we used before """
+
+    def __init__(self, socket, frames, stats=None):
+        _delimiter = frames.index(b'')
+        self.envelope = frames[:_delimiter + 1]
+        self._frames = frames[_delimiter + 1:]
+        self._socket = socket
+        self._stats = stats
+        self.received = time.time()
+        self.opcode = None
+
+    def recv_string(self):
+        if not self._frames:
+            raise ValueError("request is missing a frame")
+        return self._frames.pop(0).decode('utf-8')
+
+    def more(self):
+        """ tells whether there are frames left to read """
+        return len(self._frames) > 0
+
+    def remaining(self):
+        """ returns the frames not read yet """
+        _frames, self._frames = self._frames, []
+        return _frames
+
+    def send_string(self, text):
+        self.send(text.encode('utf-8'))
+
+    def send(self, data):
+        self._socket.send_multipart(self.envelope + [data])
+        if self._stats is not None:
+            self._stats.answered(self.opcode, time.time() - self.received,
+                                 len(data))
+
+
+class worker_pool:
+    """ answers expensive read-only requests on a number of threads. Workers
+        never touch the ROUTER socket - the answers go through an inproc socket
+        back to the main loop which forwards them """
+
+    def __init__(self, context, count):
+        self._context = context
+        self._jobs = Queue()
+        # clients choose their envelopes - so they are no unique keys
+        self._last_job = 0
+        self._requests = {}     # {job id: rpc_request} waiting for an answer
+        self.results = context.socket(zmq.PULL)
+        self.results.bind('inproc://rpc-results')
+        for _ in range(count):
+            _thread = Thread(target=self._run)
+            _thread.daemon = True
+            _thread.start()
+
+    def submit(self, request, function):
+        """ @function() is run on a worker and returns the answer string
+            (or bytes) """
+        self._last_job += 1
+        self._requests[self._last_job] = request
+        self._jobs.put((self._last_job, function))
+
+    def statistics(self):
+        return {'queued': self._jobs.qsize(),
+                'pending': len(self._requests)}
+
+    def forward_results(self):
+        while self.results.poll(0):
+            _job, _answer = self.results.recv_multipart()
+            _request = self._requests.pop(int(_job), None)
+            if _request is None:
+                logging.warning("got answer of unknown job %s", _job)
+                continue
+            _request.send(_answer)
+
+    def _run(self):
+        _socket = self._context.socket(zmq.PUSH)
+        _socket.connect('inproc://rpc-results')
+        while True:
+            _job, _function = self._jobs.get()
+            try:
+                _answer = _function()
+            except Exception as ex:
+                logging.error("exception in worker: %s", ex)
+                _answer = 'nok'
+            if not isinstance(_answer, bytes):
+                _answer = _answer.encode('utf-8')
+            _socket.send_multipart([str(_job).encode(), _answer])
+
+
+class search_executor:
+    """ runs searches on a fixed number of threads and refuses new ones if
+        too many are waiting. Identical searches share one execution, each
+        search can be cancelled by its id. Workers never touch the PUB
+        socket - notifications go through an inproc socket back to the loop
+        which publishes them
+
+        results are published to the searching user as 'search_chunk's of
+        at most search_chunk_size results followed by 'search_done' or, for
+        old clients, as one 'search_result' """
+
+    def __init__(self, context, count, queue_size, storage, stats):
+        self._context = context
+        self._max_pending = count + queue_size
+        self._storage = storage
+        self._stats = stats
+        self._mutex = Lock()
+        self._jobs = Queue()
+        self._pending = {}      # {key: job} queued or running
+        self._searches = {}     # {search id: job}
+        self._counters = {'executed': 0, 'shared': 0, 'cancelled': 0,
+                          'rejected': 0}
+        self.results = context.socket(zmq.PULL)
+        self.results.bind('inproc://search-results')
+        for _ in range(count):
+            _thread = Thread(target=self._run)
+            _thread.daemon = True
+            _thread.start()
+
+    def submit(self, search):
+        """ queues @search (see the 'search' request and index_stage) -
+            returns False if there are too many searches already """
+        _key = json.dumps([search['query'], sorted(search['channels']),
+                           search['limit']], sort_keys=True)
+        with self._mutex:
+            _job = self._pending.get(_key)
+            if _job is None:
+                if len(self._pending) >= self._max_pending:
+                    self._counters['rejected'] += 1
+                    return False
+                _job = {'key': _key, 'search': search, 'results': [],
+                        'truncated': False, 'cancelled': False,
+                        'searchers': {}}    # {search id: {'user', 'stream', 'sent'}}
+                self._pending[_key] = _job
+                self._jobs.put(_job)
+            else:
+                self._counters['shared'] += 1
+            _job['searchers'][search['id']] = {'user': search['user'],
+                                               'stream': search['stream'],
+                                               'sent': 0}
+            self._searches[search['id']] = _job
+        return True
+
+    def cancel(self, user, search_id):
+        """ stops sending results of search @search_id to @user - and
+            stops the search if nobody else waits for it """
+        with self._mutex:
+            _job = self._searches.get(search_id)
+            if _job is None or _job['searchers'][search_id]['user'] != user:
+                return False
+            del _job['searchers'][search_id]
+            del self._searches[search_id]
+            self._counters['cancelled'] += 1
+            if not _job['searchers']:
+                _job['cancelled'] = True
+                if self._pending.get(_job['key']) is _job:
+                    del self._pending[_job['key']]
+        return True
+
+    def statistics(self):
+        with self._mutex:
+            return dict(self._counters,
+                        queued=self._jobs.qsize(),
+                        pending=len(self._pending),
+                        searches=len(self._searches))
+
+    def publish_results(self, socket):
+        while self.results.poll(0):
+            socket.send_multipart(self.results.recv_multipart())
+
+    def _run(self):
+        _socket = self._context.socket(zmq.PUSH)
+        _socket.connect('inproc://search-results')
+        while True:
+            _job = self._jobs.get()
+            if _job['cancelled']:
+                continue
+            with self._stats.running('search'):
+                try:
+                    self._execute(_socket, _job)
+                except Exception as ex:
+                    logging.error("exception in search: %s", ex)
+                    _job['truncated'] = True
+            self._finish(_socket, _job)
+
+    def _execute(self, socket, job):
+        _search = job['search']
+        for r in search_messages(self._storage, _search['candidates'],
+                                 _search['query'], _search['channels']):
+            if job['cancelled']:
+                return
+            if len(job['results']) >= _search['limit']:
+                job['truncated'] = True
+                break
+            job['results'].append(r)
+            if len(job['results']) % search_chunk_size == 0:
+                self._send(socket, self._chunks(job))
+
+    def _chunks(self, job):
+        """ returns the notifications with all results not yet sent to the
+            streaming searchers of @job - searchers which joined late get
+            everything found so far """
+        _notifications = []
+        _results = job['results']
+        with self._mutex:
+            for i, s in job['searchers'].items():
+                if not s['stream']:
+                    continue
+                for n in range(s['sent'], len(_results), search_chunk_size):
+                    _notifications.append((s['user'], (
+                        'search_chunk', i,
+                        json.dumps(_results[n:n + search_chunk_size]))))
+                s['sent'] = len(_results)
+        return _notifications
+
+    def _finish(self, socket, job):
+        _notifications = self._chunks(job)
+        with self._mutex:
+            if self._pending.get(job['key']) is job:
+                del self._pending[job['key']]
+            for i, s in job['searchers'].items():
+                del self._searches[i]
+                if s['stream']:
+                    _notifications.append((s['user'], (
+                        'search_done', i,
+                        json.dumps({'count': len(job['results']),
+                                    'truncated': job['truncated']}))))
+                else:
+                    _notifications.append((s['user'], (
+                        'search_result', json.dumps(job['results']))))
+            if not job['cancelled']:
+                self._counters['executed'] += 1
+        # never block on a full socket while holding the mutex
+        self._send(socket, _notifications)
+        logging.info("search for %s found %d messages",
+                     job['key'], len(job['results']))
+
+    def _send(self, socket, notifications):
+        for user, message in notifications:
+            notify_user(socket, user, message)
+
+
+def stage_addresses(mode, port, names):
+    """ returns {name: address} of the inputs of the stages @names and the
+        'results' socket of the main loop - ipc:// addresses are unique per
+        server process, stages of a server which just died might still
+        be around """
+    if mode == 'thread':
+        return {n: 'inproc://meddle-%s' % n for n in names + ('results',)}
+    return {n: 'ipc://%s' % os.path.join(tempfile.gettempdir(),
+                                         'meddle-%d-%d-%s' % (port, os.getpid(), n))
+            for n in names + ('results',)}
+
+def unavailable_port(ports):
+    """ returns the first of the tcp @ports we can't listen on - or None.
+        The stages get forked before there is a ZeroMQ context to bind
+        with, so we look before """
+    for p in ports:
+        _socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            _socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            _socket.bind(('', p))
+        except socket.error:
+            return p
+        finally:
+            _socket.close()
+    return None
+
+def remove_ipc_file(address):
+    if address.startswith('ipc://'):
+        try:
+            os.remove(address[len('ipc://'):])
+        except OSError:
+            pass
+
+
+class stage:
+    """ a step of the message pipeline behind the main loop. A stage owns
+        its part of the server state and gets messages and queries in order
+        through its input socket - a query is answered after everything
+        sent before it has been handled. Answers, notifications and progress
+        reports go back through the 'results' socket of the main loop.
+
+        In mode 'process' a stage is a forked process connected via ipc://
+        which has to be started before the server creates its ZeroMQ
+        context, in mode 'thread' it is a thread connected via inproc:// """
+
+    modes = ('process', 'thread')
+    name = None
+    # input which comes from other stages instead of the main loop
+    stage_kinds = ()
+    report_interval = .5
+
+    def __init__(self):
+        self.mode = None
+        self.pid = None
+        self._thread = None
+        self._running = True
+        self._processed = 0
+        self._busy = 0.
+        self._outputs = {}
+
+    def start(self, mode, addresses, context=None):
+        self.mode = mode
+        self._addresses = addresses
+        if mode == 'thread':
+            self._thread = Thread(target=self._main, args=(context,))
+            self._thread.daemon = True
+            self._thread.start()
+            return
+        self.pid = os.fork()
+        if self.pid != 0:
+            return
+        _code = 1
+        try:
+            _context = zmq.Context()
+            self._main(_context)
+            # os._exit() would drop what is still queued for other stages
+            _context.destroy(linger=1000)
+            _code = 0
+        except BaseException as ex:
+            logging.error("stage '%s' failed: %s", self.name, ex)
+        finally:
+            os._exit(_code)
+
+    def alive(self):
+        if self.mode == 'thread':
+            return self._thread.is_alive()
+        try:
+            return os.waitpid(self.pid, os.WNOHANG)[0] == 0
+        except OSError:
+            return False
+
+    def stop(self):
+        """ ends a stage which will never get its 'shutdown', e.g. because
+            the server could not start """
+        if self.mode == 'thread':
+            self._running = False
+            return
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except OSError:
+            pass
+        remove_ipc_file(self._addresses[self.name])
+
+    def join(self):
+        if self.mode == 'thread':
+            self._thread.join(5)
+            return
+        try:
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+
+    def send_multipart(self, frames):
+        """ publishes @frames through the PUB socket of the main loop - so
+            code publishing notifications can take a stage as socket """
+        self._results.send_multipart([b'publish'] + list(frames))
+
+    def request(self, frames):
+        """ returns a rpc_request answered through the main loop for the
+            @frames of a forwarded request - they start with the token the
+            pipeline gave it """
+        return rpc_request(self._results, [b'answer'] + frames)
+
+    def forward(self, name, kind, frames):
+        """ sends @frames to the input of stage @name """
+        if name not in self._outputs:
+            self._outputs[name] = self._context.socket(zmq.PUSH)
+            self._outputs[name].connect(self._addresses[name])
+        self._outputs[name].send_multipart([kind.encode()] + frames)
+
+    # to be implemented by the stages
+
+    def setup(self, context):
+        pass
+
+    def sockets(self):
+        """ sockets the loop waits for besides the input """
+        return []
+
+    def handle(self, kind, frames):
+        raise NotImplementedError
+
+    def timeout(self):
+        return None
+
+    def tick(self, events):
+        pass
+
+    def finish(self):
+        pass
+
+    def statistics(self):
+        return {}
+
+    def _main(self, context):
+        self._context = context
+        self._input = context.socket(zmq.PULL)
+        self._input.bind(self._addresses[self.name])
+        self._results = context.socket(zmq.PUSH)
+        self._results.connect(self._addresses['results'])
+        self._parent = os.getppid()
+        self._started = time.time()
+        self.setup(context)
+        _poller = zmq.Poller()
+        _poller.register(self._input, zmq.POLLIN)
+        for s in self.sockets():
+            _poller.register(s, zmq.POLLIN)
+        _last_report = 0
+        logging.info("stage '%s' running as %s", self.name,
+                     "process %d" % os.getpid() if self.mode == 'process'
+                     else 'thread')
+        try:
+            while self._running:
+                _timeout = min([_last_report + self.report_interval - time.time()] +
+                               [t for t in (self.timeout(),) if t is not None])
+                _events = dict(_poller.poll(max(0, int(_timeout * 1000)) + 1))
+                _start = time.time()
+                while self._running and self._input.poll(0):
+                    _frames = self._input.recv_multipart()
+                    _kind = _frames[0].decode('utf-8')
+                    if _kind not in self.stage_kinds:
+                        self._processed += 1
+                    self.handle(_kind, _frames[1:])
+                self.tick(_events)
+                self._busy += time.time() - _start
+                if time.time() - _last_report >= self.report_interval:
+                    self._report()
+                    _last_report = time.time()
+                    if self.mode == 'process' and os.getppid() != self._parent:
+                        logging.error("server is gone - stop stage '%s'", self.name)
+                        remove_ipc_file(self._addresses['results'])
+                        break
+        finally:
+            self.finish()
+        self._report()
+        remove_ipc_file(self._addresses[self.name])
+
+    def _report(self):
+        _uptime = max(time.time() - self._started, 1e-6)
+        self._results.send_multipart([
+            b'progress', self.name.encode(), json.dumps(
+                dict(self.statistics(),
+                     processed=self._processed,
+                     busy_ratio=self._busy / _uptime)).encode()])
+
+
+class persistence_stage(stage):
+    """ writes the channel logs and answers everything which reads them -
+        log pages and searches. Puts together the snapshots of all stages
+        and writes them """
+
+    name = 'persist'
+    stage_kinds = ('state', 'search', 'cancel_search')
+
+    def __init__(self, create_storage, workers, search_threads, search_queue,
+                 snapshot_mode):
+        stage.__init__(self)
+        self._create_storage = create_storage
+        self._worker_count = workers
+        self._search_threads = search_threads
+        self._search_queue = search_queue
+        self._snapshot_mode = snapshot_mode
+        self._pending = {}      # {snapshot id: {'states', 'checkpoint', 'final'}}
+        self._shutdown = None   # token frames of the shutdown request
+
+    def setup(self, context):
+        self._storage = self._create_storage()
+        self._stats = pymeddle_stats.server_statistics()
+        self._workers = worker_pool(context, self._worker_count)
+        self._searcher = search_executor(context, self._search_threads,
+                                         self._search_queue, self._storage,
+                                         self._stats)
+        self._snapshots = snapshot_writer(self._storage, self._snapshot_mode)
+
+    def sockets(self):
+        return [self._workers.results, self._searcher.results]
+
+    def timeout(self):
+        return self._storage.timeout()
+
+    def tick(self, events):
+        self._storage.tick(idle=not events)
+        if self._workers.results in events:
+            self._workers.forward_results()
+        if self._searcher.results in events:
+            self._searcher.publish_results(self)
+        if self._shutdown is not None and not self._pending:
+            self._snapshots.wait()
+            self._storage.close()
+            self._results.send_multipart([b'shutdown'] + self._shutdown + [b'ok'])
+            self._running = False
+
+    def finish(self):
+        if self._shutdown is None:
+            self._storage.close()
+
+    def statistics(self):
+        return {'storage':   self._storage.statistics(),
+                'workers':   self._workers.statistics(),
+                'searches':  self._searcher.statistics(),
+                'snapshots': self._snapshots.statistics(),
+                'jobs':      self._stats.snapshot()['jobs']}
+
+    def handle(self, kind, frames):
+        if kind == 'message':
+            _m = json.loads(frames[0].decode('utf-8'))
+            _pos = self._storage.append_message(
+                _m['timestamp'], _m['channel'], _m['user'], _m['text'])
+            if _pos != _m['seq']:
+                logging.warning("message %d of channel '%s' got stored as %d",
+                                _m['seq'], _m['channel'], _pos)
+
+        elif kind == 'rename':
+            _m = json.loads(frames[0].decode('utf-8'))
+            self._storage.append_friendly_name(_m['channel'], _m['name'])
+
+        elif kind == 'query':
+            _request = self.request(frames)
+            _request.opcode = _request.recv_string()
+            if _request.opcode == 'get_log_page':
+                _channel = _request.recv_string()
+                _page = json.loads(_request.recv_string())
+                self._storage.flush(_channel)
+                self._workers.submit(_request, lambda c=_channel, p=_page: get_log_page(
+                    self._storage, c, p))
+            elif _request.opcode == 'get_log':
+                _channel = _request.recv_string()
+                _range = json.loads(_request.recv_string()) if _request.more() else {}
+                self._storage.flush(_channel)
+                self._workers.submit(_request, lambda c=_channel, r=_range: json.dumps(
+                    self._storage.get_log(c, r.get('since_time'), r.get('until_time'))))
+            elif _request.opcode == 'log_writer_stats':
+                _request.send_string(json.dumps(self._storage.statistics()))
+            else:
+                _request.send_string('nok')
+
+        elif kind == 'search':
+            _request = self.request(frames)
+            _search = json.loads(_request.recv_string())
+            self._storage.flush()
+            if not self._searcher.submit(_search):
+                logging.warning("too many searches - refuse search %d",
+                                _search['id'])
+                _request.send_string(json.dumps(
+                    {'ok':'False', 'error':'too many searches'}))
+            else:
+                _request.send_string(json.dumps({'ok':'True', 'id':_search['id']}))
+
+        elif kind == 'cancel_search':
+            _request = self.request(frames)
+            _cancel = json.loads(_request.recv_string())
+            _cancelled = self._searcher.cancel(_cancel['user'], _cancel['id'])
+            _request.send_string(json.dumps({'ok':str(_cancelled)}))
+
+        elif kind == 'snapshot':
+            # everything sent before the snapshot is stored now
+            _m = json.loads(frames[0].decode('utf-8'))
+            self._storage.flush()
+            _snapshot = self._pending.setdefault(_m['id'], {'states': {}})
+            _snapshot['states'].update(_m['states'])
+            _snapshot['states']['checkpoint'] = self._storage.checkpoint()
+            _snapshot['final'] = _m['final']
+            self._write_snapshot(_m['id'])
+
+        elif kind == 'state':
+            _m = json.loads(frames[0].decode('utf-8'))
+            _snapshot = self._pending.setdefault(_m['id'], {'states': {}})
+            _snapshot['states'][_m['name']] = _m['data']
+            self._write_snapshot(_m['id'])
+
+        elif kind == 'rebuild':
+            logging.info("rebuild search index")
+            self._storage.flush()
+            self.forward('index', 'reindex', [json.dumps({'clear': True}).encode()])
+            for c in self._storage.channel_ids():
+                self.forward('index', 'reindex', [json.dumps(
+                    {'channel': c, 'log': self._storage.get_log(c)}).encode()])
+            self.forward('index', 'reindex', [json.dumps({'done': True}).encode()])
+
+        elif kind == 'shutdown':
+            self._shutdown = frames
+
+    def _write_snapshot(self, snapshot_id):
+        _snapshot = self._pending[snapshot_id]
+        if 'final' not in _snapshot or set(_snapshot['states']) != set(snapshot_names):
+            return
+        del self._pending[snapshot_id]
+        if _snapshot['final']:
+            self._snapshots.wait()
+        self._snapshots.start([(n, _snapshot['states'][n]) for n in snapshot_names])
+
+
+class tag_stage(stage):
+    """ keeps the tag statistics """
+
+    name = 'tags'
+
+    def __init__(self, all_tags):
+        stage.__init__(self)
+        self._tags = all_tags
+
+    def statistics(self):
+        return {'tags': len(self._tags)}
+
+    def finish(self):
+        self._tags.flush()
+
+    def handle(self, kind, frames):
+        if kind == 'message':
+            _m = json.loads(frames[0].decode('utf-8'))
+            self._tags.add(_m['tags'], _m['channel'], _m['user'], _m['time'])
+
+        elif kind == 'query':
+            _request = self.request(frames)
+            _request.opcode = _request.recv_string()
+            if _request.opcode == 'get_active_tags':
+                _request.send_string(json.dumps(self._tags.summary()))
+            else:
+                _request.send_string('nok')
+
+        elif kind == 'snapshot':
+            _m = json.loads(frames[0].decode('utf-8'))
+            self._tags.flush()
+            self.forward('persist', 'state', [json.dumps(
+                {'id': _m['id'], 'name': 'tags',
+                 'data': self._tags.snapshot()}).encode()])
+
+        elif kind == 'shutdown':
+            self._running = False
+
+
+class index_stage(stage):
+    """ keeps the search index. Searches pass by to get the positions of
+        their candidates before the persistence stage reads them
+
+        rebuilding the index: the persistence stage reads all logs when the
+        'rebuild' marker of the main loop reaches it and sends them as
+        'reindex'. Messages which arrive here before the marker are in these
+        logs already, the ones after it wait until the index is rebuilt """
+
+    name = 'index'
+    stage_kinds = ('reindex',)
+
+    def __init__(self, index):
+        stage.__init__(self)
+        self._index = index
+        self._rebuild = None    # {'marker', 'done', 'waiting'} while rebuilding
+
+    def statistics(self):
+        return {'rebuilding': self._rebuild is not None}
+
+    def handle(self, kind, frames):
+        if kind == 'message':
+            _m = json.loads(frames[0].decode('utf-8'))
+            if self._rebuild is None:
+                self._index.add(_m['channel'], _m['user'],
+                                pymeddle_index.tokenize(_m['text']))
+            elif self._rebuild['marker']:
+                self._rebuild['waiting'].append(_m)
+
+        elif kind == 'search':
+            _search = json.loads(frames[-1].decode('utf-8'))
+            _candidates = self._index.candidates(_search['query'])
+            _search['candidates'] = (None if _candidates is None
+                                     else sorted(_candidates))
+            self.forward('persist', 'search',
+                         frames[:-1] + [json.dumps(_search).encode()])
+
+        elif kind == 'cancel_search':
+            # takes the same way as the search it cancels
+            self.forward('persist', kind, frames)
+
+        elif kind == 'snapshot':
+            _m = json.loads(frames[0].decode('utf-8'))
+            self.forward('persist', 'state', [json.dumps(
+                {'id': _m['id'], 'name': 'index',
+                 'data': self._index.snapshot()}).encode()])
+
+        elif kind == 'rebuild':
+            self._rebuilding().update(marker=True)
+            self._rebuilt()
+
+        elif kind == 'reindex':
+            _m = json.loads(frames[0].decode('utf-8'))
+            if _m.get('clear'):
+                self._rebuilding()
+                self._index.clear()
+            elif _m.get('done'):
+                self._rebuilding().update(done=True)
+                self._rebuilt()
+            else:
+                self._index.add_channel(_m['channel'], _m['log'])
+
+        elif kind == 'shutdown':
+            self._running = False
+
+    def _rebuilding(self):
+        if self._rebuild is None:
+            self._rebuild = {'marker': False, 'done': False, 'waiting': []}
+        return self._rebuild
+
+    def _rebuilt(self):
+        if not (self._rebuild['marker'] and self._rebuild['done']):
+            return
+        for m in self._rebuild['waiting']:
+            self._index.add(m['channel'], m['user'],
+                            pymeddle_index.tokenize(m['text']))
+        logging.info("rebuilt search index")
+        self._rebuild = None
+
+
+class pipeline:
+    """ connects the main loop with the stages behind it (see stage) and
+        keeps track of how many messages wait in front of every stage """
+
+    def __init__(self, context, stages, addresses):
+        self.results = context.socket(zmq.PULL)
+        self.results.bind(addresses['results'])
+        self._results_address = addresses['results']
+        self._stages = stages
+        self._inputs = {}
+        for s in stages:
+            self._inputs[s.name] = context.socket(zmq.PUSH)
+            self._inputs[s.name].connect(addresses[s.name])
+        self._last_request = 0
+        self._requests = {}     # {token: rpc_request} waiting for an answer
+        self._sent = {s.name: 0 for s in stages}
+        self._progress = {s.name: {} for s in stages}
+        self._max_depth = {s.name: 0 for s in stages}
+        self._last_snapshot_id = 0
+        self._stopping = False
+
+    def send(self, name, kind, data):
+        self._inputs[name].send_multipart([kind.encode(), json.dumps(data).encode()])
+        self._sent[name] += 1
+
+    def forward(self, name, kind, request, frames):
+        """ passes @request with @frames to stage @name which answers it.
+            Instead of the envelope of the client, which needn't be unique,
+            the request travels with a token of its own """
+        self._last_request += 1
+        _token = str(self._last_request).encode()
+        self._requests[_token] = request
+        self._inputs[name].send_multipart(
+            [kind.encode(), _token, b''] +
+            [f if isinstance(f, bytes) else f.encode('utf-8') for f in frames])
+        self._sent[name] += 1
+
+    def snapshot(self, states, final=False):
+        """ starts a snapshot with the @states of the main loop - the other
+            stages add theirs """
+        self._last_snapshot_id += 1
+        for s in self._stages:
+            self.send(s.name, 'snapshot',
+                      {'id': self._last_snapshot_id, 'final': final,
+                       'states': dict(states) if s.name == 'persist' else {}})
+
+    def shutdown(self, request):
+        """ stops all stages - @request gets answered when everything is
+            written """
+        self._stopping = True
+        for s in self._stages:
+            if s.name == 'persist':
+                self.forward(s.name, 'shutdown', request, [])
+            else:
+                self.send(s.name, 'shutdown', {})
+
+    def handle_results(self, pub_socket):
+        """ forwards answers and notifications of the stages - returns True
+            when the persistence stage confirmed the shutdown """
+        while self.results.poll(0):
+            _frames = self.results.recv_multipart()
+            _kind = _frames[0]
+            if _kind in (b'answer', b'shutdown'):
+                _request = self._requests.pop(_frames[1], None)
+                if _request is None:
+                    logging.warning("got answer of unknown request %s", _frames[1])
+                else:
+                    _request.send(_frames[-1])
+                if _kind == b'shutdown':
+                    return True
+            elif _kind == b'publish':
+                pub_socket.send_multipart(_frames[1:])
+            elif _kind == b'progress':
+                _name = _frames[1].decode('utf-8')
+                self._progress[_name] = json.loads(_frames[2].decode('utf-8'))
+                self._max_depth[_name] = max(self._max_depth[_name],
+                                             self._depth(_name))
+        return False
+
+    def check(self):
+        if self._stopping:
+            return
+        for s in self._stages:
+            if not s.alive():
+                raise RuntimeError("stage '%s' is gone" % s.name)
+
+    def join(self):
+        for s in self._stages:
+            s.join()
+        remove_ipc_file(self._results_address)
+
+    def statistics(self):
+        """ the queue depths are sampled whenever a stage reports """
+        return {s.name: dict(self._progress[s.name],
+                             mode=s.mode,
+                             sent=self._sent[s.name],
+                             depth=self._depth(s.name),
+                             max_depth=self._max_depth[s.name])
+                for s in self._stages}
+
+    def _depth(self, name):
+        return self._sent[name] - self._progress[name].get('processed', 0)
+
 
 def main():
 
+    parser = OptionParser()
+    parser.add_option("-p", "--port", dest="port", type="int", default=32100,
+                      metavar="PORT-NR",
+                      help="tcp port for requests, PORT-NR+1 is used for "
+                           "publishing and PORT-NR+2 for heartbeats")
+    parser.add_option("-w", "--workers", dest="workers", type="int",
+                      default=4, metavar="COUNT",
+                      help="number of threads of the persistence stage "
+                           "answering expensive requests")
+    parser.add_option("--storage", dest="storage", default="files",
+                      type="choice", choices=pymeddle_storage.backends,
+                      help="where to keep messages and state: files or sqlite")
+    parser.add_option("--database", dest="database", default="server.sqlite",
+                      metavar="FILE", help="database file for --storage=sqlite")
+    parser.add_option("--log-flush", dest="log_flush", default="interval",
+                      type="choice", choices=pymeddle_logs.log_writer.policies,
+                      help="when to write logs to disk: always, interval or idle")
+    parser.add_option("--log-flush-interval", dest="log_flush_interval",
+                      type="int", default=50, metavar="MS",
+                      help="maximum delay for writing logs with --log-flush=interval")
+    parser.add_option("--log-max-open", dest="log_max_open", type="int",
+                      default=64, metavar="COUNT",
+                      help="number of channel logs to keep open")
+    parser.add_option("--log-rotate-size", dest="log_rotate_size", type="float",
+                      default=4., metavar="MB",
+                      help="rotate channel logs bigger than MB into compressed "
+                           "segments (0 disables)")
+    parser.add_option("--log-rotate-age", dest="log_rotate_age", type="float",
+                      default=0., metavar="HOURS",
+                      help="rotate channel logs older than HOURS (0 disables)")
+    parser.add_option("--log-compression", dest="log_compression", default="zlib",
+                      type="choice", choices=pymeddle_logs.compressions,
+                      help="compression of rotated log segments: zlib or lzma")
+    parser.add_option("--log-fsync", dest="log_fsync", action="store_true",
+                      default=False, help="fsync the logs (or the database) on every flush")
+    parser.add_option("--user-timeout", dest="user_timeout", type="float",
+                      default=5., metavar="SECONDS",
+                      help="users are offline after SECONDS without a ping")
+    parser.add_option("--rebuild", dest="rebuild", action="store_true",
+                      default=False,
+                      help="rebuild channel information, tags and index from the "
+                           "stored messages")
+    parser.add_option("--tag-events", dest="tag_events", metavar="FILE",
+                      help="additionally log every single tag mention to FILE")
+    parser.add_option("--search-limit", dest="search_limit", type="int",
+                      default=1000, metavar="COUNT",
+                      help="maximum number of results of a search")
+    parser.add_option("--search-threads", dest="search_threads", type="int",
+                      default=2, metavar="COUNT",
+                      help="number of threads running searches")
+    parser.add_option("--search-queue", dest="search_queue", type="int",
+                      default=16, metavar="COUNT",
+                      help="number of searches waiting for a thread before "
+                           "new ones get refused")
+    parser.add_option("--snapshot-interval", dest="snapshot_interval",
+                      type="float", default=300., metavar="SECONDS",
+                      help="how often to write the persistent data (0 only "
+                           "writes on request and on shutdown)")
+    parser.add_option("--snapshot-mode", dest="snapshot_mode", default="fork",
+                      type="choice", choices=snapshot_writer.modes,
+                      help="write snapshots from a forked process (fork) or "
+                           "from a copy of the data on a thread (thread)")
+    parser.add_option("--stage-mode", dest="stage_mode", default="process",
+                      type="choice", choices=stage.modes,
+                      help="run the persistence, tag and index stages as "
+                           "processes (process) or threads (thread)")
+    parser.add_option("--stats-file", dest="stats_file", metavar="FILE",
+                      help="regularly append runtime statistics to FILE")
+    parser.add_option("--stats-interval", dest="stats_interval", type="float",
+                      default=60., metavar="SECONDS",
+                      help="how often to write to --stats-file")
+    parser.add_option("--shard", dest="shard", metavar="NUMBER/COUNT",
+                      help="run as shard NUMBER of COUNT behind meddle-broker.py")
+    (options, args) = parser.parse_args()
+
+    _shard = None
+    if options.shard:
+        try:
+            _shard = tuple(int(x) for x in options.shard.split('/'))
+            assert len(_shard) == 2 and 0 <= _shard[0] < _shard[1]
+        except (ValueError, AssertionError):
+            parser.error("--shard expects NUMBER/COUNT, e.g. 0/4")
+    # only the first shard knows all users and tells about them
+    _owns_users = _shard is None or _shard[0] == 0
+    _unavailable = unavailable_port((options.port, options.port + 1,
+                                     options.port + 2))
+    if _unavailable is not None:
+        logging.error("can't listen on port %d - is another server running?",
+                      _unavailable)
+        sys.exit(1)
+    _stage_mode = options.stage_mode
+    if _stage_mode == 'process' and not hasattr(os, 'fork'):
+        logging.warning("no fork() here - run the stages as threads")
+        _stage_mode = 'thread'
+
+    _create_storage = functools.partial(
+        pymeddle_storage.create_storage,
+        options.storage,
+        database=options.database,
+        policy=options.log_flush,
+        interval=options.log_flush_interval / 1000.,
+        max_open=options.log_max_open,
+        sync=options.log_fsync,
+        rotate_size=int(options.log_rotate_size * 1024 * 1024),
+        rotate_age=options.log_rotate_age * 3600,
+        compression=options.log_compression)
+
+    _storage = _create_storage()
+    _channels = load_channels(_storage)
+    _all_tags = pymeddle_tags.tag_statistics(options.tag_events).load(_storage)
+    _users = user_container(options.user_timeout)
+    _users.load(_storage)
+    _index = pymeddle_index.search_index().load(_storage)
+    _tag_versions = tag_versions()
+
+    refresh_channel_information(_storage, _channels, _all_tags, _index,
+                                _storage.load_state('checkpoint') or {},
+                                options.rebuild)
+    # the main loop numbers the messages - the persistence stage stores them
+    # in this order
+    _positions = channel_sizes(_storage)
+    _tag_counts = _all_tags.counts()
+    _storage.close()
+
+    _stages = [persistence_stage(_create_storage, options.workers,
+                                 options.search_threads, options.search_queue,
+                                 options.snapshot_mode),
+               tag_stage(_all_tags),
+               index_stage(_index)]
+    _addresses = stage_addresses(_stage_mode, options.port,
+                                 tuple(s.name for s in _stages))
+    if _stage_mode == 'process':
+        # fork before there is a ZeroMQ context - it does not survive fork()
+        for s in _stages:
+            s.start(_stage_mode, _addresses)
+        # the stages own them now
+        _all_tags = _index = None
+
     _context = zmq.Context()
 
     _own_version = pymeddle_common.get_version()
-    _port_rpc = 32100
-    _port_pub = 32101
-
-    _rpc_socket = _context.socket(zmq.REP)
-    _rpc_socket.bind("tcp://*:%d" % _port_rpc)
-
-    _pub_socket = _context.socket(zmq.PUB)
-    _pub_socket.bind("tcp://*:%d" % _port_pub)
+    _port_rpc = options.port
+    _port_pub = options.port + 1
+    _port_heartbeat = options.port + 2
+
+    _stats = pymeddle_stats.server_statistics()
+
+    _rpc_socket = _context.socket(zmq.ROUTER)
+    # XPUB tells us what is subscribed - nobody needs the rest
+    _xpub_socket = _context.socket(zmq.XPUB)
+    _xpub_socket.setsockopt(zmq.XPUB_VERBOSER, 1)
+    _pub_socket = pymeddle_stats.counting_socket(_xpub_socket, _stats)
+    _heartbeat_socket = _context.socket(zmq.PULL)
+    try:
+        # somebody might have taken a port since we looked
+        _rpc_socket.bind("tcp://*:%d" % _port_rpc)
+        _pub_socket.bind("tcp://*:%d" % _port_pub)
+        _heartbeat_socket.bind("tcp://*:%d" % _port_heartbeat)
+        _pipeline = pipeline(_context, _stages, _addresses)
+    except zmq.ZMQError as ex:
+        logging.error("could not start: %s", ex)
+        if _stage_mode == 'process':
+            for s in _stages:
+                s.stop()
+                s.join()
+            remove_ipc_file(_addresses['results'])
+        sys.exit(1)
+
+    if _stage_mode == 'thread':
+        for s in _stages:
+            s.start(_stage_mode, _addresses, _context)
+    _stats.add_source('pipeline', _pipeline.statistics)
+    _stats.add_source('subscriptions', _pub_socket.statistics)
 
     _poller = zmq.Poller()
     _poller.register(_rpc_socket, zmq.POLLIN)
+    _poller.register(_pipeline.results, zmq.POLLIN)
+    _poller.register(_heartbeat_socket, zmq.POLLIN)
+    _poller.register(_xpub_socket, zmq.POLLIN)
     logging.info("meddle version:      %s", '.'.join((str(x) for x in _own_version)))
     logging.info("using Python version %s", '.'.join((str(x) for x in sys.version_info)))
     logging.info("using ZeroMQ version %s", zmq.zmq_version())
     logging.info("using pyzmq version  %s", zmq.pyzmq_version())
     logging.info("meddle server listening on port %d, sending on port %d",
                  _port_rpc, _port_pub)
+    logging.info("running stages as %ses", _stage_mode)
 
-    _channels = load_channels('server-channels.db')
-    _all_tags = load_tags('server-tags.db')
-    _users = user_container()
-    _users.load('server-user.db')
-
-    refresh_channel_information(_channels, _all_tags, _all_tags==[])
+    _ranking = channel_ranking()
+    _ranking.rebuild(_channels)
+    _stats.add_source('users_online', lambda: len(_users.users_online()))
+    _last_alive = 0
+    _last_snapshot = time.time()
+    _last_stats_dump = time.time()
+    _last_search_id = 0
 
     while True:
 
         try:
             dead_users = _users.find_dead()
             _users.set_offline(dead_users)
-            if not dead_users == []:
+            if not dead_users == [] and _owns_users:
                 publish_user_list(_pub_socket, _users)
 
-            if _poller.poll(3000) == []:
+            if time.time() - _last_alive >= 1:
+                publish_alive(_pub_socket)
+                _last_alive = time.time()
+
+            if (options.stats_file and
+                    time.time() - _last_stats_dump >= options.stats_interval):
+                _stats.dump(options.stats_file)
+                _last_stats_dump = time.time()
+
+            if (options.snapshot_interval and
+                    time.time() - _last_snapshot >= options.snapshot_interval):
+                _start = time.time()
+                _pipeline.snapshot(snapshot_states(_users, _channels))
+                _stats.persist.add(time.time() - _start)
+                _last_snapshot = time.time()
+
+            _timeout = min([3., _last_alive + 1 - time.time()] +
+                           [t for t in (_users.next_expiry(),)
+                            if t is not None] +
+                           ([_last_stats_dump + options.stats_interval - time.time()]
+                            if options.stats_file else []) +
+                           ([_last_snapshot + options.snapshot_interval - time.time()]
+                            if options.snapshot_interval else []))
+            _poll_start = time.time()
+            _events = dict(_poller.poll(max(0, int(_timeout * 1000)) + 1))
+            _stats.polled(time.time() - _poll_start)
+            if _pipeline.results in _events:
+                if _pipeline.handle_results(_pub_socket):
+                    # everything is written
+                    _pipeline.join()
+                    if options.stats_file:
+                        _stats.dump(options.stats_file)
+                    time.sleep(1)
+                    sys.exit(0)
+            else:
+                _pipeline.check()
+            if _xpub_socket in _events:
+                _pub_socket.read_subscriptions()
+            if _heartbeat_socket in _events:
+                handle_heartbeats(_heartbeat_socket, _pub_socket, _users)
+            if _rpc_socket not in _events:
                 # logging.debug("waiting..")
                 continue
 
-            _message = _rpc_socket.recv_string()
+            _frames = _rpc_socket.recv_multipart()
+            _stats.received(_frames)
+            try:
+                _request = rpc_request(_rpc_socket, _frames, _stats)
+                _message = _request.recv_string()
+            except ValueError:
+                logging.warning("got malformed request with %d frames", len(_frames))
+                continue
+            _request.opcode = _message
             # logging.debug("got '%s' (%s)" % (_message, type(_message)))
 
             if _message == "hello":
-                _answer = json.loads(_rpc_socket.recv_string())
+                _answer = json.loads(_request.recv_string())
                 _name = _answer['name']
                 _version = tuple(_answer['version'])
                 logging.debug("hello from '%s' with client version %s" % (
                     _name, _version))
                 if _version < pymeddle_common.get_min_client_version():
-                    _rpc_socket.send_string(json.dumps({'accepted': False,
+                    _request.send_string(json.dumps({'accepted': False,
                                                         'version': _own_version}))
                 else:
                     _is_new, _id, _user = _users.find_or_create_name(_name)
+                    _encoding = pymeddle_wire.choose_encoding(_answer.get('encodings'))
 
-                    _rpc_socket.send_string(json.dumps({'accepted': True,
+                    _request.send_string(json.dumps({'accepted': True,
                                                         'id': _id,
                                                         'version': _own_version,
-                                                        'sub_port': _port_pub}))
+                                                        'sub_port': _port_pub,
+                                                        'heartbeat_port': _port_heartbeat,
+                                                        'encoding': _encoding}))
 
                     if _is_new:
                          # todo: send only update-info
                         publish_user_list(_pub_socket, _users)
 
+            elif _message == "shard_user":
+                # a user said hello to the first shard
+                _mirrored = json.loads(_request.recv_string())
+                _users.mirror(_mirrored['id'], _mirrored['name'])
+                _request.send_string('ok')
+
             elif _message.startswith("ping"):
                 # todo: handle users
-                _sender_id = int(_rpc_socket.recv_string())
+                _sender_id = int(_request.recv_string())
                 if _users.refresh(_sender_id):
-                    _rpc_socket.send_string('ok')
+                    _request.send_string('ok')
                 else:
                     logging.warn("user with id %d marked offline but sending",
                                  _sender_id)
-                    _rpc_socket.send_string('nok')
+                    _request.send_string('nok')
 
             elif _message == "create_channel":
-                _sender_id = int(_rpc_socket.recv_string())
-                _invited_users = json.loads(_rpc_socket.recv_string())
+                _sender_id = int(_request.recv_string())
+                _invited_users = json.loads(_request.recv_string())
                 _name = _users.get_name(_sender_id)
                 if not _name:
                     logging.warn("user with id %d marked offline but sending",
                                  _sender_id)
-                    _rpc_socket.send_string("nok")
+                    _request.send_string("nok")
                 else:
                     logging.debug("%s creates channel and invites '%s'",
                                   _sender_id, _invited_users)
-                    _channel_name = create_uid()
+                    _channel_name = create_uid(_shard)
                     # todo - check collisions
-                    _rpc_socket.send_string(_channel_name)
-                    _channels[_channel_name] = channel(_channel_name)
-                    _channels[_channel_name].participants.add(_name)
+                    _request.send_string(_channel_name)
+                    _ranking.add_channel(_channels, _channel_name, _name)
                     for _uid in [_users.get_id(u) for u in _invited_users]:
+                        if _uid is None:
+                            # never seen - would not get the notification anyway
+                            continue
                         notify_user(_pub_socket,
                                     _uid, ('join_channel', _channel_name))
                     # publish_channel_list(_pub_socket, _channels)
 
             elif _message == "get_channels":
                 try:
-                    _hint = json.loads(_rpc_socket.recv_string())
+                    _hint = json.loads(_request.recv_string())
                     _user = 'frans'
                     _user = _users.get_name(_hint['user'])
-                    _hot_channels = filter_channels(_channels, _all_tags, _user, _hint)
-                    _rpc_socket.send_string(
-                        json.dumps(
-                            {_name: _score for _name, _score in _hot_channels}))
+                    _version, _hot_channels = _ranking.filter_channels(
+                        _channels, _user, _hint)
+                    _hot_channels = {_name: _score for _name, _score in _hot_channels}
+                    if not _hint.get('versioned'):
+                        _request.send_string(json.dumps(_hot_channels))
+                    elif _hint.get('version') == _version:
+                        _request.send_string(json.dumps({'version': _version}))
+                    else:
+                        _request.send_string(json.dumps({'version': _version,
+                                                         'channels': _hot_channels}))
                 except Exception as ex:
                     logging.error("exception in get_channels(): %s", ex)
-                    _rpc_socket.send_string(json.dumps({}))
+                    _request.send_string(json.dumps({}))
 
 
             elif _message == "get_channel_info":
                 try:
-                    _request = json.loads(_rpc_socket.recv_string())
+                    _info_request = json.loads(_request.recv_string())
                     _result = [(n, _channels[n].friendly_name,
                                 list(_channels[n].participants))
-                               for n in _request['channels']]
-                    _rpc_socket.send_string(json.dumps(_result))
+                               for n in _info_request['channels']]
+                    _request.send_string(json.dumps(_result))
                 except:
-                    _rpc_socket.send_string(json.dumps({}))
+                    _request.send_string(json.dumps({}))
 
             elif _message == "get_users":
-                _rpc_socket.send_string(json.dumps(_users.users_online()))
+                _request.send_string(json.dumps(_users.users_online()))
+
+            elif _message == "get_user_names":
+                _ids = json.loads(_request.recv_string())
+                _request.send_string(json.dumps(_users.get_names(_ids)))
 
             elif _message == "get_active_tags":
-                _rpc_socket.send_string(json.dumps(_all_tags))
+                _pipeline.forward('tags', 'query', _request, [_message])
+
+            elif _message == "log_writer_stats":
+                _pipeline.forward('persist', 'query', _request, [_message])
+
+            elif _message == "stats":
+                _request.send_string(json.dumps(_stats.snapshot()))
+
+            elif _message == "get_tag_counts":
+                _request.send_string(json.dumps(_tag_versions.snapshot(_tag_counts)))
 
             elif _message.startswith("get_log"):
-                _channel = _rpc_socket.recv_string()
-                _rpc_socket.send_string(json.dumps(get_log(_channel)))
+                # get_log: channel, optional {'since_time': .., 'until_time': ..}
+                # get_log_page: channel, page
+                # - answered after everything published before is stored
+                _pipeline.forward('persist', 'query', _request,
+                                  [_message] + _request.remaining())
 
             elif _message == "search":
-                _search_term = json.loads(_rpc_socket.recv_string())
-                _rpc_socket.send_string(json.dumps({'ok':'True', 'id':0}))
+                _search_spec = json.loads(_request.recv_string())
+                try:
+                    _query = pymeddle_index.parse_query(_search_spec['term'])
+                except ValueError as ex:
+                    _request.send_string(json.dumps({'ok':'False', 'error':str(ex)}))
+                    continue
+                _last_search_id += 1
+                _search = {'id': _last_search_id,
+                           'user': _search_spec['user'],
+                           'query': _query,
+                           'channels': resolve_channels(_channels, _query['channels']),
+                           'limit': min(_search_spec.get('limit') or options.search_limit,
+                                        options.search_limit),
+                           # old clients expect one 'search_result'
+                           'stream': bool(_search_spec.get('stream'))}
                 logging.info("user %d wants us to search for '%s'",
-                             _search_term['user'], _search_term['term'])
-                _thread = Thread(target=lambda: start_search(
-                    _pub_socket, _search_term))
-                _thread.daemon = True
-                _thread.start()
+                             _search_spec['user'], _search_spec['term'])
+                # the index stage adds the candidates, the persistence stage
+                # runs the search and answers
+                _pipeline.forward('index', 'search', _request,
+                                  [json.dumps(_search)])
+
+            elif _message == "cancel_search":
+                # takes the same way as the search
+                _pipeline.forward('index', 'cancel_search', _request,
+                                  _request.remaining())
 
             elif _message.startswith("rename_channel"):
-                _rename_info = json.loads(_rpc_socket.recv_string())
+                _rename_info = json.loads(_request.recv_string())
                 if not ('cuid' in _rename_info and 'name' in _rename_info
                         and len(_rename_info['name'].strip())>3):
-                    _rpc_socket.send_string('nok')
-                    return
-                _rpc_socket.send_string('ok')
-                _cuid = _rename_info['cuid']
-                _new_friendlyname = _rename_info['name'].strip()
-                _channels[_cuid].friendly_name = _new_friendlyname
-                with open('_%s.log' % _cuid, 'a') as f:
-                    f.write("friendlyname=%s\n" % _new_friendlyname)
+                    _request.send_string('nok')
+                else:
+                    _request.send_string('ok')
+                    _cuid = _rename_info['cuid']
+                    _new_friendlyname = _rename_info['name'].strip()
+                    _channels[_cuid].friendly_name = _new_friendlyname
+                    _pipeline.send('persist', 'rename',
+                                   {'channel': _cuid, 'name': _new_friendlyname})
                 
             elif _message == "publish":
-                _sender_id = int(_rpc_socket.recv_string())
-                _channel = _rpc_socket.recv_string()
-                _text = _rpc_socket.recv_string()
+                _sender_id = int(_request.recv_string())
+                _channel = _request.recv_string()
+                _text = _request.recv_string()
                 _name = _users.get_name(_sender_id)
                 if not _name:
                     logging.warn("user with id %d marked offline but sending",
                                  _sender_id)
-                    _rpc_socket.send_string("nok")
+                    _request.send_string("nok")
+                # administrative commands work on any channel - behind a
+                # broker they reach shards which don't know the channel
+                elif _text == 'persist':
+                    _request.send_string('ok')
+                    _start = time.time()
+                    _pipeline.snapshot(snapshot_states(_users, _channels))
+                    _stats.persist.add(time.time() - _start)
+                    _last_snapshot = time.time()
+                elif _text == 'server shutdown':
+                    # answered when the stages wrote everything
+                    _pipeline.snapshot(snapshot_states(_users, _channels),
+                                       final=True)
+                    _pipeline.shutdown(_request)
+                elif _text == 'rebuild index':
+                    _request.send_string('ok')
+                    _pipeline.send('persist', 'rebuild', {})
+                    _pipeline.send('index', 'rebuild', {})
                 elif _channel not in _channels:
                     logging.warn("tried to send on channel %s which is currently not known",
                                  _channel)
-                    _rpc_socket.send_string("nok")
-                elif _text == 'persist':
-                    _rpc_socket.send_string('ok')
-                    persist(_users, _channels, _all_tags)
-                elif _text == 'server shutdown':
-                    persist(_users, _channels, _all_tags)
-                    _rpc_socket.send_string('ok')
-                    time.sleep(1)
-                    sys.exit(0)
+                    _request.send_string("nok")
                 else:
-                    _rpc_socket.send_string('ok')
+                    _request.send_string('ok')
                     # todo: handle wrong user
-                    if _channels[_channel].add_participant(_name, time.time()):
+                    if _ranking.add_participant(_channels, _channel, _name, time.time()):
                         # publish_channel_list(_pub_socket, _channels)
                         pass
                     _tags = handle_tags(_pub_socket, _channel, _name, _text)
-                    _channels[_channel].add_tags(_tags)
-                    if store_tags(_all_tags, _tags, _channel, _sender_id) > 0: #1<<2:
-                        publish_tags(_pub_socket, _all_tags)
-                    publish(_pub_socket, timestamp_str(), _name, _channel, _text)
+                    _ranking.add_tags(_channels, _channel, _tags)
+                    if _tags:
+                        for t in _tags:
+                            _tag_counts[t] = _tag_counts.get(t, 0) + 1
+                        publish_tags_delta(_pub_socket, _tag_versions.delta(_tags))
+                    _t = time.time()
+                    _seq = _positions.get(_channel, 0)
+                    _positions[_channel] = _seq + 1
+                    _timestamp = publish(_pub_socket, _t, _name, _sender_id,
+                                         _channel, _text, _seq,
+                                         pymeddle_wire.encodings)
+                    _entry = {'seq': _seq, 'timestamp': _timestamp,
+                              'time': _t, 'channel': _channel,
+                              'user': _name, 'text': _text, 'tags': _tags}
+                    _pipeline.send('persist', 'message', _entry)
+                    if _tags:
+                        _pipeline.send('tags', 'message', _entry)
+                    _pipeline.send('index', 'message', _entry)
+
+            else:
+                logging.warning("got unknown request '%s'", _message)
+                _request.opcode = 'unknown'
+                _request.send_string('nok')
 
         except Exception as ex:
             logging.error("something bad happened: %s", ex)
@@ -73,6 +73,7 @@ class chat_widget(QtGui.QWidget):
         self.parent_item = parent
         self._channel = cuid
         self._meddle_base = meddle_base
+        self._early_messages = []   # [(seq, name, text)] arrived before the history
         self.init_ui()
         self._lbl_chat_room.setText(self._meddle_base.get_friendly_name(cuid))
 
@@ -117,16 +118,34 @@ class chat_widget(QtGui.QWidget):
         self.setPalette(p)
         self.setAutoFillBackground(True)
 
+    def set_title(self, name):
+        self._lbl_chat_room.setText(name)
+
     def on_pb_exit_pressed(self):
         self.close_window.emit(self._channel)
 
     def on_txt_message_edit_returnPressed(self):
-        self._meddle_base.publish(self._channel, self._txt_message_edit.text())
+        self._meddle_base.publish_future(self._channel, self._txt_message_edit.text())
         self._txt_message_edit.setText("")
 
-    def on_message(self, name, text):
+    def on_message(self, seq, name, text):
+        """ @seq is the position of the message in the channel or -1 """
+        if self._early_messages is not None:
+            self._early_messages.append((seq, name, text))
+            return
         self._txt_messages.append_message(name, text)
 
+    def on_history(self, size, messages):
+        """ shows the history and then the messages which arrived while we
+            waited for it - except those which are part of the history
+            already, i.e. came before position @size """
+        for _, t, name, text in messages:
+            self._txt_messages.append_message(name, text)
+        _early, self._early_messages = self._early_messages or [], None
+        for seq, name, text in _early:
+            if seq < 0 or seq >= size:
+                self._txt_messages.append_message(name, text)
+
     def closeEvent(self, event):
         pass
 
@@ -277,7 +296,7 @@ class MeddleWindow(QtGui.QWidget):
     @QtCore.pyqtSlot()
     def _on_txt_search_returnPressed(self):
         _term = str(self._txt_search.text())
-        self.meddle_base.search(_term)
+        self.meddle_base.search_future(_term)
         logging.info(_term)
 
     def keyPressEvent(self, e):
@@ -291,12 +310,23 @@ class MeddleWindow(QtGui.QWidget):
     def _shutdown(self):
         self.close()
 
+    def _when_answered(self, future, slot, answer_type, *args):
+        """ calls @slot(*args, answer) on the UI thread once @future has the
+            answer - @args are Q_ARGs """
+        future.add_done_callback(lambda f: QtCore.QMetaObject.invokeMethod(
+                self, slot,
+                QtCore.Qt.QueuedConnection,
+                *(args + (QtCore.Q_ARG(answer_type, f.result()),))))
+
     def _update_widgets(self):
         self._update_window_title()
         if self.meddle_base.get_connection_status():
-            self._update_user_list(self.meddle_base.get_users())
-            self._update_channel_list(self.meddle_base.get_channels())
-            self._update_active_tags_list(self.meddle_base.get_active_tags())
+            self._when_answered(self.meddle_base.get_users_future(),
+                                "_meddle_on_user_update", list)
+            self._when_answered(self.meddle_base.get_channels_future(),
+                                "_on_channels_answered", list)
+            self._when_answered(self.meddle_base.get_active_tags_future(),
+                                "_meddle_on_tags_update", dict)
         else:
             self._update_user_list([])
             self._update_channel_list([])
@@ -340,7 +370,7 @@ class MeddleWindow(QtGui.QWidget):
         self._deactivate_edit_handling = False
         
     def _update_active_tags_list(self, tags):
-        _tags = sorted([(n, len(l)) for n, l in tags.items()],
+        _tags = sorted(tags.items(),
                        key=lambda x: x[1], reverse=True)[:10]
         self._lbl_hot_tags.setText(
             "   ".join(
@@ -349,8 +379,12 @@ class MeddleWindow(QtGui.QWidget):
     def _on_lst_users_doubleClicked(self, index):
         _user = str(self._lst_users.item(index.row()).text())
         # logging.debug("doubleclick on user %s" % _user)
-        _channel = self.meddle_base.create_channel([_user])
-        self.meddle_base.join_channel(_channel)
+        self._when_answered(self.meddle_base.create_channel_future([_user]),
+                            "_on_channel_created", str)
+
+    @QtCore.pyqtSlot(str)
+    def _on_channel_created(self, channel):
+        self.meddle_base.join_channel(str(channel))
 
     def _on_lst_channels_doubleClicked(self, index):
         _channel = str(self._lst_channels.item(index.row(), 0).text().split(':')[0])
@@ -366,9 +400,17 @@ class MeddleWindow(QtGui.QWidget):
             _fname = str(self._lst_channels.item(_row_idx , 1).text())
             if _fname == _cuid:
                 return
-            self.meddle_base.rename_channel(_cuid, _fname)
+            self._when_answered(self.meddle_base.rename_channel_future(_cuid, _fname),
+                                "_on_channel_renamed", str,
+                                QtCore.Q_ARG(str, _cuid), QtCore.Q_ARG(str, _fname))
         except:
             pass
+
+    @QtCore.pyqtSlot(str, str, str)
+    def _on_channel_renamed(self, cuid, name, answer):
+        _cuid = str(cuid)
+        if str(answer) == 'ok' and _cuid in self._chats:
+            self._chats[_cuid].set_title(str(name))
         
     def _on_lst_notifications_doubleClicked(self, index):
         _line = self._lst_notifications.item(index.row()).text()
@@ -384,10 +426,10 @@ class MeddleWindow(QtGui.QWidget):
                 'hey %s' % self.meddle_base.current_username(),
                 text+"\n\n\n\n")
 
-    @QtCore.pyqtSlot(str, str, str)
-    def _meddle_on_message(self, channel, name, text):
+    @QtCore.pyqtSlot(str, int, str, str)
+    def _meddle_on_message(self, channel, seq, name, text):
         _channel, _name, _text = (str(x) for x in (channel, name, text))
-        self._chats[_channel].on_message(_name, _text)
+        self._chats[_channel].on_message(seq, _name, _text)
         self._show_notification("%s on %s:\n%s" %(_name, _channel, _text))
 
     @QtCore.pyqtSlot(bool, list, list, str)
@@ -407,8 +449,9 @@ class MeddleWindow(QtGui.QWidget):
         _chat_window = chat_widget(_item1, self.meddle_base, _channel)
         _chat_window.close_window.connect(self._on_chat_window_close_window)
 
-        for t, name, text in self.meddle_base.get_log(_channel):
-            _chat_window.on_message(name, text)
+        self._when_answered(
+            self.meddle_base.get_history_future(_channel, limit=200).then(list),
+            "_on_history_answered", list, QtCore.Q_ARG(str, _channel))
 
         self._chats[_channel] = _chat_window
         self._lst_rooms.setItemWidget(_item1, _chat_window)
@@ -418,6 +461,13 @@ class MeddleWindow(QtGui.QWidget):
     def _on_chat_window_close_window(self, channel):
         self.meddle_base.leave_channel(str(channel))
 
+    @QtCore.pyqtSlot(str, list)
+    def _on_history_answered(self, channel, history):
+        _channel = str(channel)
+        if _channel in self._chats:
+            _size, _messages = history
+            self._chats[_channel].on_history(_size, _messages)
+
     @QtCore.pyqtSlot(str)
     def _meddle_on_leave_channel(self, channel):
         _channel = str(channel)
@@ -460,6 +510,17 @@ class MeddleWindow(QtGui.QWidget):
             _lb.addItem("%s: %s: %s" % (_fname, u, x))
         _lb.verticalScrollBar().setValue(_lb.verticalScrollBar().maximum())
 
+    @QtCore.pyqtSlot(dict)
+    def _meddle_on_search_done(self, info):
+        _lb = self._lst_notifications
+        _lb.addItem("search: %d results%s" % (
+            info['count'], " (more available)" if info['truncated'] else ""))
+        _lb.verticalScrollBar().setValue(_lb.verticalScrollBar().maximum())
+
+    @QtCore.pyqtSlot(list)
+    def _on_channels_answered(self, channels):
+        self._update_channel_list(channels)
+
     @QtCore.pyqtSlot(dict)
     def _meddle_on_channels_update(self, channels):
         self._update_channel_list(channels)
@@ -468,11 +529,12 @@ class MeddleWindow(QtGui.QWidget):
     def _meddle_on_tags_update(self, tags):
         self._update_active_tags_list(tags)
 
-    def meddle_on_message(self, channel, name, text):
+    def meddle_on_numbered_message(self, channel, seq, name, text):
         QtCore.QMetaObject.invokeMethod(
                 self, "_meddle_on_message",
                 QtCore.Qt.QueuedConnection,
                 QtCore.Q_ARG(str, channel),
+                QtCore.Q_ARG(int, -1 if seq is None else seq),
                 QtCore.Q_ARG(str, name),
                 QtCore.Q_ARG(str, text))
 
@@ -521,6 +583,12 @@ class MeddleWindow(QtGui.QWidget):
                 QtCore.Qt.QueuedConnection,
                 QtCore.Q_ARG(list, search_result))
 
+    def meddle_on_search_done(self, search_id, info):
+        QtCore.QMetaObject.invokeMethod(
+                self, "_meddle_on_search_done",
+                QtCore.Qt.QueuedConnection,
+                QtCore.Q_ARG(dict, info))
+
     def meddle_on_tags_update(self, tags):
         QtCore.QMetaObject.invokeMethod(
                 self, "_meddle_on_tags_update",
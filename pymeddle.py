@@ -27,7 +27,7 @@ except:
 
 import os
 import getpass
-from threading import Thread, Lock
+from threading import Thread, Lock, Event
 import logging
 from optparse import OptionParser
 import json
@@ -35,6 +35,23 @@ import time
 import ast
 import socket
 import pymeddle_common
+import pymeddle_history
+import pymeddle_wire
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+def timestamp_to_time(timestamp):
+    """ '%Y%m%d%H%M%S%f' as sent by the server -> seconds since epoch """
+    try:
+        return time.mktime(time.strptime(timestamp, '%Y%m%d%H%M%S%f'))
+    except (TypeError, ValueError):
+        return 0.
 
 def system_username():
     # todo: format (spaces, etc)
@@ -51,9 +68,205 @@ def find_first_available_server(options):
     else:
         return 'scibernetic.de'
 
+class rpc_future:
+    """ the answer to a request which is on its way. Waiting for it with
+        result() blocks - callbacks added with add_done_callback() get the
+        future as soon as the answer is there, on the thread of the
+        rpc_client. They must not wait for other answers themselves """
+
+    def __init__(self):
+        self._event = Event()
+        self._mutex = Lock()
+        self._callbacks = []
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """ returns the answer - waits at most @timeout seconds for it """
+        if not self._event.wait(timeout):
+            raise RuntimeError("no answer within %.1fs" % timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        """ returns the exception the request failed with or None """
+        self._event.wait()
+        return self._exception
+
+    def add_done_callback(self, callback):
+        """ calls @callback(future) once the answer is there - right away
+            if it is already """
+        with self._mutex:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        self._call(callback)
+
+    def then(self, function):
+        """ returns a rpc_future for function(answer) - or for the answer of
+            the rpc_future function(answer) returns """
+        _next = rpc_future()
+        def chain(future):
+            try:
+                _value = function(future.result())
+            except Exception as ex:
+                _next.set_exception(ex)
+                return
+            if isinstance(_value, rpc_future):
+                _value.add_done_callback(_next._copy)
+            else:
+                _next.set_result(_value)
+        self.add_done_callback(chain)
+        return _next
+
+    def set_result(self, result):
+        self._resolve(result, None)
+
+    def set_exception(self, exception):
+        self._resolve(None, exception)
+
+    def _copy(self, future):
+        self._resolve(future._result, future._exception)
+
+    def _resolve(self, result, exception):
+        with self._mutex:
+            if self._event.is_set():
+                return
+            self._result = result
+            self._exception = exception
+            self._event.set()
+            _callbacks, self._callbacks = self._callbacks, []
+        for c in _callbacks:
+            self._call(c)
+
+    def _call(self, callback):
+        try:
+            callback(self)
+        except Exception as ex:
+            logging.error("exception in rpc callback: %s", ex)
+
+
+def resolved_future(result):
+    """ returns a rpc_future which already has @result """
+    _future = rpc_future()
+    _future.set_result(result)
+    return _future
+
+
+def asyncio_future(future, loop=None):
+    """ returns an asyncio future resolved with the rpc_future @future on
+        @loop (default: the current event loop) - to await answers """
+    if asyncio is None:
+        raise RuntimeError("asyncio needs Python 3.4 or newer")
+    _loop = loop or asyncio.get_event_loop()
+    _result = _loop.create_future()
+    def copy(f):
+        if _result.done():
+            # cancelled meanwhile
+            return
+        if f._exception is not None:
+            _result.set_exception(f._exception)
+        else:
+            _result.set_result(f._result)
+    future.add_done_callback(lambda f: _loop.call_soon_threadsafe(copy, f))
+    return _result
+
+
+class rpc_client:
+    """ sends requests over one DEALER socket without waiting for the
+        answers of the ones before. Every request gets an id frame in front
+        of the empty delimiter - the server sends this envelope back with
+        the answer, so answers can arrive in any order.
+
+        Only the thread of the rpc_client touches the DEALER socket, callers
+        hand their requests over through an inproc socket """
+
+    # answers taking longer make us think we lost the server
+    timeout = 1.
+
+    def __init__(self, context, address, on_status=None):
+        """ @on_status(bool) is called when the server starts or stops
+            answering """
+        self._context = context
+        self._address = address
+        self._on_status = on_status
+        self._mutex = Lock()
+        self._last_id = 0
+        self._pending = {}      # {request id: (rpc_future, raw, time sent)}
+        _inbox = 'inproc://pymeddle-rpc-%x' % id(self)
+        self._inbox = context.socket(zmq.PULL)
+        self._inbox.bind(_inbox)
+        self._outbox = context.socket(zmq.PUSH)
+        self._outbox.connect(_inbox)
+        _thread = Thread(target=self._run)
+        _thread.daemon = True
+        _thread.start()
+
+    def request(self, frames, raw=False):
+        """ sends @frames (bytes) and returns a rpc_future for the answer -
+            as string or as bytes if @raw is set """
+        _future = rpc_future()
+        with self._mutex:
+            self._last_id += 1
+            _id = str(self._last_id).encode()
+            self._pending[_id] = (_future, raw, time.time())
+            self._outbox.send_multipart([_id] + list(frames))
+        return _future
+
+    def pending(self):
+        """ returns the number of requests waiting for an answer """
+        return len(self._pending)
+
+    def _run(self):
+        _socket = self._context.socket(zmq.DEALER)
+        _socket.connect(self._address)
+        _poller = zmq.Poller()
+        _poller.register(self._inbox, zmq.POLLIN)
+        _poller.register(_socket, zmq.POLLIN)
+        _last_answer = time.time()
+        while True:
+            _events = dict(_poller.poll(int(self.timeout * 1000)))
+            if self._inbox in _events:
+                while self._inbox.poll(0):
+                    _frames = self._inbox.recv_multipart()
+                    _socket.send_multipart([_frames[0], b''] + _frames[1:])
+            if _socket in _events:
+                while _socket.poll(0):
+                    self._answered(_socket.recv_multipart())
+                _last_answer = time.time()
+                self._set_status(True)
+            with self._mutex:
+                _oldest = min([t for _, _, t in self._pending.values()] or [None])
+            if (_oldest is not None and
+                    time.time() - max(_oldest, _last_answer) >= self.timeout):
+                logging.warn("timeout!")
+                self._set_status(False)
+
+    def _answered(self, frames):
+        if len(frames) != 3 or frames[1] != b'':
+            logging.warning("got malformed answer with %d frames", len(frames))
+            return
+        with self._mutex:
+            _request = self._pending.pop(frames[0], None)
+        if _request is None:
+            logging.warning("got answer to unknown request %s", frames[0])
+            return
+        _future, _raw, _ = _request
+        _future.set_result(frames[2] if _raw else frames[2].decode('utf-8'))
+
+    def _set_status(self, status):
+        if self._on_status is not None:
+            self._on_status(status)
+
+
 class base:
 
-    def __init__(self, handler):
+    def __init__(self, handler, args=None):
+        """ @args are the command line arguments to use instead of sys.argv """
         usage = "usage: %prog [options] <start|stop|restart|quit>"
         parser = OptionParser(usage=usage)
 
@@ -63,11 +276,15 @@ class base:
         parser.add_option("-s", "--server", dest="servername",
                           metavar="SERVER-IP",
                           help="meddle server domain or address")
-        parser.add_option("-p", "--port", dest="serverport",
+        parser.add_option("-p", "--port", dest="serverport", type="int",
                           metavar="PORT-NR",
                           help="meddle server tcp port")
+        parser.add_option("--history-cache", dest="history_cache",
+                          metavar="DIRECTORY",
+                          help="where to cache channel history "
+                               "(default: ~/.meddle-history/SERVER-PORT)")
 
-        (options, args) = parser.parse_args()
+        (options, args) = parser.parse_args(args)
 
         _meddle_default_config_filename = os.path.join(
             pymeddle_common.meddle_directory(), '.meddle-default')
@@ -87,6 +304,13 @@ class base:
         self._perstitent_settings = {}
         self._perstitent_settings['tags'] = []
         self._channel_friendly_names = {}
+        self._tag_counts = {}
+        self._tags_version = None   # (generation, version)
+        self._tags_resync = None    # [delta, ..] arriving during a resync
+        # snapshots arrive on the rpc_client thread, deltas get applied on
+        # the callback thread
+        self._mutex_tags = Lock()
+        self._hot_channels = (None, {})   # (version, {cuid: score})
 
         try:
             self._perstitent_settings.update(
@@ -122,45 +346,72 @@ class base:
         else:
             self._servername = find_first_available_server(self._perstitent_settings)
         self._serverport = options.serverport if options.serverport else 32100
-        self._mutex_rpc_socket = Lock()
+        self._history = pymeddle_history.history_cache(
+            options.history_cache or os.path.join(
+                pymeddle_common.system_user_directory(), '.meddle-history',
+                '%s-%d' % (self._servername, self._serverport)))
+        self._rpc = None
+        self._heartbeat_port = None
+        self._encoding = 'json'
+        self._user_names = {}   # {id: name} for binary encoded messages
+        self._user_name_requests = {}   # {id: rpc_future for the name}
+        self._next_seq = {}     # {cuid: sequence number of the next message}
+        self._waiting = {}      # {cuid: [rpc_future for [(seq, time, name, text), ..]]}
+        # handler calls which had to wait for answers - made one after the
+        # other by _run_callbacks() so neither the receive loop nor the
+        # rpc_client thread has to wait
+        self._callbacks = Queue()
+        self._mutex_seq = Lock()
+        self._last_server_message = 0
         self._connection_status = None
         self._version = pymeddle_common.get_version()
 
+    # every <name>_future() method returns a rpc_future instead of waiting
+    # for the answer like <name>() does - see also async_base
+
     def publish(self, channel, text):
-        with self._mutex_rpc_socket:
-            self._rpc_socket.send_multipart(
-                tuple(str(x).encode('utf-8') for x in (
-                    "publish", self._my_id, channel, text)))
-            answer = self._rpc_socket.recv_string()
-            if answer != 'ok':
-                logging.warn("we got '%s' as reply to publish", answer)
+        return self.publish_future(channel, text).result()
+
+    def publish_future(self, channel, text):
+        return self._request_future(
+            ("publish", self._my_id, channel, text)).then(self._published)
+
+    def _published(self, answer):
+        if answer != 'ok':
+            logging.warn("we got '%s' as reply to publish", answer)
         return answer
 
     def create_channel(self, invited_users=[]):
+        return self.create_channel_future(invited_users).result()
+
+    def create_channel_future(self, invited_users=[]):
         if type(invited_users) in (list, tuple):
             _invited_users = [str(l) for l in invited_users]
         else:
             _invited_users = [str(invited_users)]
-        with self._mutex_rpc_socket:
-            self._rpc_socket.send_multipart(
-                ["create_channel".encode(),
-                 str(self._my_id).encode(),
-                 json.dumps(_invited_users).encode()])
-            return self._rpc_socket.recv_string()
+        return self._request_future(
+            ("create_channel", self._my_id, json.dumps(_invited_users)))
 
     def join_channel(self, channel):
         if not channel in self._subscriptions:
             self._subscriptions.append(channel)
+            with self._mutex_seq:
+                self._next_seq.pop(channel, None)
             self._handler.meddle_on_joined_channel(channel)
             logging.info("talking on channel '%s'" % channel)
-            self._sub_socket.setsockopt(zmq.SUBSCRIBE, channel.encode('utf-8'))
+            self._sub_socket.setsockopt(zmq.SUBSCRIBE, self._channel_topic(channel))
 
     def leave_channel(self, channel):
         if channel in self._subscriptions:
             self._subscriptions.remove(channel)
             self._handler.meddle_on_leave_channel(channel)
             logging.info("leaving channel '%s'" % channel)
-            self._sub_socket.setsockopt(zmq.UNSUBSCRIBE, channel.encode('utf-8'))
+            self._sub_socket.setsockopt(zmq.UNSUBSCRIBE, self._channel_topic(channel))
+
+    def _channel_topic(self, channel):
+        if self._encoding == 'binary':
+            return pymeddle_wire.binary_topic(channel)
+        return channel.encode('utf-8')
 
     def connect(self):
         self._set_connection_status(False)
@@ -188,21 +439,48 @@ class base:
     def get_tags(self):
         return self._perstitent_settings['tags']
 
+    def ping(self):
+        return self._request(['ping', self._my_id])
+
+    def get_server_stats(self):
+        """ returns the runtime statistics of the server """
+        return self.get_server_stats_future().result()
+
+    def get_server_stats_future(self):
+        return self._request_future("stats").then(json.loads)
+
     def get_users(self):
-        answer = self._request("get_users")
-        return json.loads(answer)
+        return self.get_users_future().result()
+
+    def get_users_future(self):
+        return self._request_future("get_users").then(json.loads)
 
     def get_channels(self):
-        answer = self._request(
+        return self.get_channels_future().result()
+
+    def get_channels_future(self):
+        return self._request_future(
             ("get_channels",
              json.dumps({'user':self._my_id,
                          'count':4,
-                         'tags':self._perstitent_settings['tags']})))
-        _relevant_channels = json.loads(answer)
+                         'tags':self._perstitent_settings['tags'],
+                         'versioned': True,
+                         'version': self._hot_channels[0]}))).then(
+                self._hot_channels_answered)
+
+    def _hot_channels_answered(self, answer):
+        _answer = json.loads(answer)
+        if 'channels' in _answer:
+            self._hot_channels = (_answer['version'], _answer['channels'])
+        _relevant_channels = dict(self._hot_channels[1])
         for c in self._subscriptions:
             _relevant_channels[c] = 1000
-        answer = self._request(("get_channel_info",
-                                json.dumps({'channels':_relevant_channels})))
+        return self._request_future(
+            ("get_channel_info",
+             json.dumps({'channels':_relevant_channels}))).then(
+                self._channel_info_answered)
+
+    def _channel_info_answered(self, answer):
         _my_channels = json.loads(answer)
         logging.info("channels: %s" % _my_channels)
         for _cuid, _fname, _ in _my_channels:
@@ -210,9 +488,62 @@ class base:
         return _my_channels
 
     def get_active_tags(self):
-        answer = self._request("get_active_tags")
-        _tags = json.loads(answer)
-        return _tags
+        """ returns {tag: number of mentions} """
+        return self.get_active_tags_future().result()
+
+    def get_active_tags_future(self):
+        return self._request_future("get_tag_counts").then(self._tag_counts_answered)
+
+    def _tag_counts_answered(self, answer):
+        """ takes over a snapshot - unless the deltas applied while it was
+            on its way made our counts newer - and returns the counts """
+        _snapshot = json.loads(answer)
+        _generation, _version = _snapshot['generation'], _snapshot['version']
+        with self._mutex_tags:
+            if (self._tags_version is None or
+                    self._tags_version[0] != _generation or
+                    self._tags_version[1] < _version):
+                self._tag_counts = _snapshot['tags']
+                self._tags_version = (_generation, _version)
+            return dict(self._tag_counts)
+
+    def _apply_tags_delta(self, delta):
+        """ runs on the callback thread (see _run_callbacks()) """
+        _generation, _version = delta['generation'], delta['version']
+        with self._mutex_tags:
+            if self._tags_resync is not None:
+                # applied on top of the snapshot we wait for
+                self._tags_resync.append(delta)
+                return
+            _counts = None
+            if self._tags_version is not None and self._tags_version[0] == _generation:
+                if _version <= self._tags_version[1]:
+                    # already contained in the last snapshot
+                    return
+                if _version == self._tags_version[1] + 1:
+                    for t, n in delta['tags'].items():
+                        self._tag_counts[t] = self._tag_counts.get(t, 0) + n
+                    self._tags_version = (_generation, _version)
+                    _counts = dict(self._tag_counts)
+            if _counts is None:
+                logging.info("missed tag updates (have %s, got %s) - resync",
+                             self._tags_version, (_generation, _version))
+                self._tags_resync = [delta]
+        if _counts is not None:
+            self._handler.meddle_on_tags_update(_counts)
+            return
+        self._request_future("get_tag_counts").add_done_callback(
+            lambda f: self._callbacks.put(lambda: self._tags_resynced(f)))
+
+    def _tags_resynced(self, future):
+        """ runs on the callback thread like _apply_tags_delta(), so no delta
+            can come in between """
+        with self._mutex_tags:
+            _deltas, self._tags_resync = self._tags_resync, None
+        self._handler.meddle_on_tags_update(
+            self._tag_counts_answered(future.result()))
+        for d in _deltas:
+            self._apply_tags_delta(d)
 
     def get_friendly_name(self, cuid):
         if cuid in self._channel_friendly_names:
@@ -220,21 +551,154 @@ class base:
         else:
             return cuid
 
-    def search(self, search_term):
-        answer = self._request(("search", json.dumps({'user': self._my_id,
-                                                      'term': search_term})))
-        print(answer)
-
-    def get_log(self, channel):
-        answer = self._request(("get_log", channel))
+    def search(self, search_term, limit=None):
+        """ starts a search and returns {'ok', 'id'}. Besides words
+            @search_term can contain user:NAME, #tag, channel:NAME,
+            since:TIME and until:TIME (e.g. 2014-03-01 or 12h). Words
+            match whole words - or, if no message contains a word, any
+            text containing it ('hell' finds 'hello' unless somebody wrote
+            'hell'). Results
+            arrive newest first in chunks via meddle_on_search_result(),
+            followed by meddle_on_search_done(id, {'count', 'truncated'}) """
+        return self.search_future(search_term, limit).result()
+
+    def search_future(self, search_term, limit=None):
+        _spec = {'user': self._my_id, 'term': search_term, 'stream': True}
+        if limit is not None:
+            _spec['limit'] = limit
+        return self._request_future(("search", json.dumps(_spec))).then(
+            self._search_answered)
+
+    def _search_answered(self, answer):
+        logging.debug("search: %s", answer)
         return json.loads(answer)
 
+    def cancel_search(self, search_id):
+        """ stops a search started with search() - chunks already on their
+            way may still arrive """
+        return self.cancel_search_future(search_id).result()
+
+    def cancel_search_future(self, search_id):
+        return self._request_future(
+            ("cancel_search", json.dumps({'user': self._my_id,
+                                          'id': search_id}))).then(
+                lambda answer: json.loads(answer)['ok'] == 'True')
+
+    def get_log(self, channel, since_time=None, until_time=None):
+        """ returns [(time, name, text), ..] for all messages of @channel or
+            only those between @since_time and @until_time """
+        return self.get_log_future(channel, since_time, until_time).result()
+
+    def get_log_future(self, channel, since_time=None, until_time=None):
+        if since_time is None and until_time is None:
+            _request = ("get_log", channel)
+        else:
+            _request = ("get_log", channel,
+                        json.dumps({'since_time': since_time,
+                                    'until_time': until_time}))
+        return self._request_future(_request).then(json.loads)
+
+    def get_log_page(self, channel, since=None, before=None, limit=None):
+        """ returns (size, [(position, time, name, text), ..]) with the
+            messages of @channel in [since, before), at most @limit of them.
+            without @since the newest messages are returned """
+        return self.get_log_page_future(channel, since, before, limit).result()
+
+    def get_log_page_future(self, channel, since=None, before=None, limit=None):
+        _page = {'since': since, 'before': before, 'limit': limit}
+        if self._encoding == 'binary':
+            _page['encoding'] = 'binary'
+            return self._request_future(
+                ("get_log_page", channel, json.dumps(_page)),
+                raw=True).then(pymeddle_wire.unpack_page)
+        return self._request_future(
+            ("get_log_page", channel, json.dumps(_page))).then(
+                self._log_page_answered)
+
+    def _log_page_answered(self, answer):
+        _page = json.loads(answer)
+        return _page['size'], _page['messages']
+
+    def get_history(self, channel, limit=200):
+        """ returns (size, [(position, time, name, text), ..]) with the
+            newest @limit messages of @channel. Messages we have seen before
+            come from the history cache, only newer ones are requested """
+        return self.get_history_future(channel, limit).result()
+
+    def get_history_future(self, channel, limit=200):
+        _end = self._history.end(channel)
+        if _end is None:
+            return self._reload_history(channel, limit)
+        return self.get_log_page_future(channel, since=_end, limit=limit).then(
+            lambda page: self._history_answered(channel, limit, _end, page))
+
+    def _history_answered(self, channel, limit, end, page):
+        _size, _messages = page
+        if _size < end:
+            logging.warning("server knows less of channel %s than we do - "
+                            "drop cached history", channel)
+            self._history.clear(channel)
+        elif end + len(_messages) == _size:
+            self._history.append(channel, _messages)
+            self._seen(channel, _size)
+            return _size, self._history.messages(channel, limit)
+        # too much missing
+        return self._reload_history(channel, limit)
+
+    def _reload_history(self, channel, limit):
+        return self.get_log_page_future(channel, limit=limit).then(
+            lambda page: self._history_reloaded(channel, limit, page))
+
+    def _history_reloaded(self, channel, limit, page):
+        _size, _messages = page
+        self._history.replace(channel, _messages)
+        self._seen(channel, _size)
+        return _size, self._history.messages(channel, limit)
+
+    def _seen(self, channel, size):
+        """ the first @size messages of @channel have been handed out - so
+            published ones with a lower sequence number are duplicates """
+        with self._mutex_seq:
+            if self._next_seq.get(channel, 0) < size:
+                self._next_seq[channel] = size
+
+    def get_user_name(self, user_id):
+        """ returns the name of the user with id @user_id """
+        return self.get_user_name_future(user_id).result()
+
+    def get_user_name_future(self, user_id):
+        """ names we know are there right away, a name which is already
+            requested isn't requested again """
+        if user_id in self._user_names:
+            return resolved_future(self._user_names[user_id])
+        _future = self._user_name_requests.get(user_id)
+        if _future is None:
+            _future = self._request_future(
+                ("get_user_names", json.dumps([user_id]))).then(
+                    lambda answer: self._user_names_answered(user_id, answer))
+            self._user_name_requests[user_id] = _future
+        return _future
+
+    def _user_names_answered(self, user_id, answer):
+        for i, n in json.loads(answer).items():
+            self._user_names[int(i)] = n
+        self._user_name_requests.pop(user_id, None)
+        return self._user_names.get(user_id, str(user_id))
+
     def rename_channel(self, cuid, name):
+        self.rename_channel_future(cuid, name).result()
+
+    def rename_channel_future(self, cuid, name):
         logging.info("rename %s to '%s'" % (cuid, name))
-        answer = self._request(("rename_channel", json.dumps({'cuid': cuid,
-                                                              'name': name})))
+        return self._request_future(
+            ("rename_channel", json.dumps({'cuid': cuid,
+                                           'name': name}))).then(
+                self._renamed)
+
+    def _renamed(self, answer):
         if not answer == 'ok':
             logging.warning("answer was %s" % answer)
+        return answer
 
 
     def get_connection_status(self):
@@ -256,21 +720,16 @@ class base:
     def username_is_preliminary(self):
         return self._preliminary_username
 
-    def _request(self, text):
-        with self._mutex_rpc_socket:
-            if type(text) in (list, tuple):
-                self._rpc_socket.send_multipart([str(i).encode() for i in text])
-            else:
-                self._rpc_socket.send_string(text)
-
-            poller = zmq.Poller()
-            poller.register(self._rpc_socket, zmq.POLLIN)
-            while poller.poll(1000) == []:
-                logging.warn("timeout!")
-                self._set_connection_status(False)
+    def _request(self, text, raw=False):
+        """ returns the answer as string or as bytes if @raw is set """
+        return self._request_future(text, raw).result()
 
-            self._set_connection_status(True)
-            return self._rpc_socket.recv_string()
+    def _request_future(self, text, raw=False):
+        """ sends a request without waiting and returns a rpc_future for
+            the answer (see _request()) """
+        if type(text) in (list, tuple):
+            return self._rpc.request([str(i).encode('utf-8') for i in text], raw)
+        return self._rpc.request([text.encode('utf-8')], raw)
 
     def _set_connection_status(self, status):
         if status != self._connection_status:
@@ -278,24 +737,43 @@ class base:
             self._handler.meddle_on_connection_established(status)
 
     def _hello(self):
-        _answer = self._request(("hello",
-                                 json.dumps({'name':    self._username,
-                                             'version': self._version})))
-        _answer = json.loads(_answer)
+        self._hello_answered(self._hello_future().result())
+
+    def _hello_future(self):
+        return self._request_future(
+            ("hello", json.dumps({'name':      self._username,
+                                  'version':   self._version,
+                                  'encodings': pymeddle_wire.encodings})))
+
+    def _hello_answered(self, answer):
+        _answer = json.loads(answer)
         if 'accepted' in _answer and _answer['accepted']:
             self._my_id = _answer['id']
+            self._heartbeat_port = _answer.get('heartbeat_port')
+            # old servers do not negotiate and speak JSON only
+            self._switch_encoding(_answer.get('encoding', 'json'))
             logging.info("server: calls us '%s', has version %s (own: %s)",
                          self._my_id, _answer['version'], self._version)
         else:
             self._handler.meddle_on_version_check(
                 False, _answer['version'], self._version, 'mismatch')
 
+    def _switch_encoding(self, encoding):
+        if encoding == self._encoding:
+            return
+        logging.info("use %s encoding", encoding)
+        for c in self._subscriptions:
+            self._sub_socket.setsockopt(zmq.UNSUBSCRIBE, self._channel_topic(c))
+        self._encoding = encoding
+        for c in self._subscriptions:
+            self._sub_socket.setsockopt(zmq.SUBSCRIBE, self._channel_topic(c))
+
     def _rpc_thread(self):
 
         _rpc_server_address = "tcp://%s:%d" % (self._servername, self._serverport)
         logging.info("connect to %s" % _rpc_server_address)
-        self._rpc_socket = self.context.socket(zmq.REQ)
-        self._rpc_socket.connect(_rpc_server_address)
+        self._rpc = rpc_client(self.context, _rpc_server_address,
+                               self._set_connection_status)
 
         self._sub_socket = self.context.socket(zmq.SUB)
         self._sub_socket.connect("tcp://%s:%d" % (self._servername, self._serverport + 1))
@@ -306,27 +784,61 @@ class base:
         if True:
             self._hello()
 
+        _thread = Thread(target=lambda: self._run_callbacks())
+        _thread.daemon = True
+        _thread.start()
+
         _thread = Thread(target=lambda: self._receive_messages())
         _thread.daemon = True
         _thread.start()
 
+        if self._heartbeat_port is None:
+            # old server: heartbeats are ping requests
+            while True:
+                time.sleep(2)
+                answer = self.ping()
+                if answer != 'ok':
+                    logging.warn("we got '%s' as reply to ping, let's say hello again..", answer)
+                    self._hello()
+
+        # heartbeats go to their own socket and are never answered - the
+        # server publishes 'server_alive' every second instead and asks
+        # us to say hello again if it thinks we are offline
+        _heartbeat_socket = self.context.socket(zmq.PUSH)
+        _heartbeat_socket.setsockopt(zmq.SNDHWM, 1)
+        _heartbeat_socket.setsockopt(zmq.LINGER, 0)
+        _heartbeat_socket.connect("tcp://%s:%d" % (self._servername, self._heartbeat_port))
         while True:
+            try:
+                _heartbeat_socket.send(str(self._my_id).encode(), zmq.NOBLOCK)
+            except zmq.Again:
+                pass
+            self._set_connection_status(time.time() - self._last_server_message < 5)
             time.sleep(2)
-            answer = self._request(['ping', self._my_id])
-            if answer != 'ok':
-                logging.warn("we got '%s' as reply to ping, let's say hello again..", answer)
-                self._hello()
 
     def _receive_messages(self):
         self._sub_socket.setsockopt(zmq.SUBSCRIBE, 'channels_update'.encode('utf-8'))
         self._sub_socket.setsockopt(zmq.SUBSCRIBE, 'user_update'.encode('utf-8'))
-        self._sub_socket.setsockopt(zmq.SUBSCRIBE, 'tags_update'.encode('utf-8'))
+        self._sub_socket.setsockopt(zmq.SUBSCRIBE, 'tags_delta'.encode('utf-8'))
         self._sub_socket.setsockopt(zmq.SUBSCRIBE, ('notify%s' % self._my_id).encode('utf-8'))
+        self._sub_socket.setsockopt(zmq.SUBSCRIBE, 'server_alive'.encode('utf-8'))
         #self._sub_socket.setsockopt_string(zmq.SUBSCRIBE, "")
 
         while True:
-            message = self._sub_socket.recv_string()
-            if message.startswith("tag#"):
+            _topic = self._sub_socket.recv()
+            self._last_server_message = time.time()
+            if pymeddle_wire.is_binary_topic(_topic):
+                _channel = pymeddle_wire.channel_of(_topic)
+                _seq, _user_id, _time, _text = pymeddle_wire.unpack_message(
+                    self._sub_socket.recv())
+                self._on_channel_message(
+                    _channel, _seq, _time, self.get_user_name_future(_user_id),
+                    _text)
+                continue
+            message = _topic.decode('utf-8')
+            if message == "server_alive":
+                pass
+            elif message.startswith("tag#"):
                 _tag = message
                 _channel = self._sub_socket.recv_string()
                 _user = self._sub_socket.recv_string()
@@ -338,9 +850,24 @@ class base:
                 if _opcode == 'join_channel':
                     _channel = self._sub_socket.recv_string()
                     self.join_channel(_channel)
+                elif _opcode == 'hello_again':
+                    logging.warn("server thinks we're offline, let's say hello again..")
+                    # messages keep coming while we wait for the answer
+                    self._hello_future().add_done_callback(
+                        lambda f: self._callbacks.put(
+                            lambda: self._hello_answered(f.result())))
                 elif _opcode == 'search_result':
                     _search_result = json.loads(self._sub_socket.recv_string())
                     self._handler.meddle_on_search_result(_search_result)
+                elif _opcode == 'search_chunk':
+                    _search_id = int(self._sub_socket.recv_string())
+                    _search_result = json.loads(self._sub_socket.recv_string())
+                    self._handler.meddle_on_search_result(_search_result)
+                elif _opcode == 'search_done':
+                    _search_id = int(self._sub_socket.recv_string())
+                    _info = json.loads(self._sub_socket.recv_string())
+                    if hasattr(self._handler, 'meddle_on_search_done'):
+                        self._handler.meddle_on_search_done(_search_id, _info)
                 else:
                     logging.info("got strange '%s'", _opcode)
             elif message == "channels_update":
@@ -349,9 +876,9 @@ class base:
             elif message == "user_update":
                 _extra_info = self._sub_socket.recv_string()
                 self._handler.meddle_on_user_update(json.loads(_extra_info))
-            elif message == "tags_update":
-                _tags = json.loads(self._sub_socket.recv_string())
-                self._handler.meddle_on_tags_update(_tags)
+            elif message == "tags_delta":
+                _delta = json.loads(self._sub_socket.recv_string())
+                self._callbacks.put(lambda d=_delta: self._apply_tags_delta(d))
             else:
                 _channel = message
                 _msg = json.loads(self._sub_socket.recv_string())
@@ -360,7 +887,113 @@ class base:
                 _time = _msg['time']
                 logging.info("%s: incoming message on %s %s: '%s'",
                              _time, _channel, _name, _text)
-                self._handler.meddle_on_message(_channel, _name, _text)
+                # servers before 0.12 do not send sequence numbers
+                self._on_channel_message(_channel, _msg.get('seq'),
+                                         timestamp_to_time(_time), _name, _text)
+
+    def _on_channel_message(self, channel, seq, t, name, text):
+        """ hands a published message to the handler - after the messages
+            of @channel we missed since the last one, which get requested.
+            @name can be a rpc_future for the name of the sender. Nothing
+            waits for these answers here: the messages of a channel queue
+            up in _waiting and _deliver() hands them out in order """
+        if seq is None:
+            self._notify_message(channel, None, name, text)
+            return
+        with self._mutex_seq:
+            _expected = self._next_seq.get(channel)
+            if _expected is not None and seq < _expected:
+                # already seen, e.g. with get_history()
+                return
+            self._next_seq[channel] = seq + 1
+        if _expected is not None and seq > _expected:
+            logging.warning("missed messages %d to %d of channel %s - request them",
+                            _expected, seq - 1, channel)
+            _missed = self._missed_messages(channel, _expected, seq)
+        else:
+            _missed = resolved_future([])
+        _name = name if isinstance(name, rpc_future) else resolved_future(name)
+        _ready = _missed.then(lambda messages: _name.then(
+            lambda n: [tuple(m) for m in messages] + [(seq, t, n, text)]))
+        with self._mutex_seq:
+            self._waiting.setdefault(channel, []).append(_ready)
+        _ready.add_done_callback(
+            lambda f: self._callbacks.put(lambda: self._deliver(channel)))
+
+    def _missed_messages(self, channel, since, before):
+        """ returns a rpc_future for the messages of @channel in
+            [since, before) - an empty list if we can't get them """
+        _missed = rpc_future()
+        def answered(future):
+            try:
+                _missed.set_result(future.result()[1])
+            except Exception as ex:
+                logging.error("could not get missed messages: %s", ex)
+                _missed.set_result([])
+        self.get_log_page_future(channel, since=since, before=before
+                                 ).add_done_callback(answered)
+        return _missed
+
+    def _deliver(self, channel):
+        """ hands out the messages of @channel which are complete and not
+            waiting behind incomplete ones """
+        while True:
+            with self._mutex_seq:
+                _waiting = self._waiting.get(channel)
+                if not _waiting or not _waiting[0].done():
+                    return
+                _ready = _waiting.pop(0)
+                if not _waiting:
+                    del self._waiting[channel]
+            if _ready.exception() is not None:
+                logging.error("could not deliver message of channel %s: %s",
+                              channel, _ready.exception())
+                continue
+            _messages = _ready.result()
+            self._history.extend(channel, _messages)
+            for s, _, n, x in _messages:
+                self._notify_message(channel, s, n, x)
+
+    def _notify_message(self, channel, seq, name, text):
+        """ handlers which want the position of a message in its channel
+            (None from old servers), e.g. to tell it from one they got with
+            get_history(), implement meddle_on_numbered_message() """
+        if hasattr(self._handler, 'meddle_on_numbered_message'):
+            self._handler.meddle_on_numbered_message(channel, seq, name, text)
+        else:
+            self._handler.meddle_on_message(channel, name, text)
+
+    def _run_callbacks(self):
+        while True:
+            _function = self._callbacks.get()
+            try:
+                _function()
+            except Exception as ex:
+                logging.error("exception in callback: %s", ex)
+
+
+class async_base:
+    """ asyncio front end of a base: every <name>_future() method of base is
+        a method <name>() here returning an awaitable, e.g.
+
+            users = await async_base(meddle).get_users()
+
+        requests sent one after another without awaiting the answers in
+        between are on their way at the same time """
+
+    def __init__(self, base, loop=None):
+        """ @loop: event loop the answers get delivered to (default: the
+            current one when a request is sent) """
+        self._base = base
+        self._loop = loop
+
+    def __getattr__(self, name):
+        _function = getattr(self._base, name + '_future', None)
+        if _function is None:
+            raise AttributeError(name)
+        def call(*args, **kwargs):
+            return asyncio_future(_function(*args, **kwargs), self._loop)
+        return call
 
 
 def main():
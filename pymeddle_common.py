@@ -3,6 +3,7 @@
 
 import json
 import os
+import zlib
 
 def meddle_directory():
     if os.path.isdir(os.path.dirname(__file__)):
@@ -22,3 +23,7 @@ def get_version():
 
 def get_min_client_version():
     return tuple(get_version_info()['min_client'])
+
+def shard_of(cuid, count):
+    """ returns the number of the shard (of @count) channel @cuid lives on """
+    return (zlib.crc32(cuid.encode('utf-8')) & 0xffffffff) % count
@@ -0,0 +1,150 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+""" on-disk cache of channel history for pymeddle clients
+
+    one file '<cuid>.jsonl' per channel with one JSON list
+    [position, time, name, text] per line. A channel's cache always holds a
+    contiguous range of positions ending with the newest message we know -
+    so only messages behind it have to be requested from the server
+"""
+
+import json
+import logging
+import os
+from threading import Lock
+
+
+def _replace(source, target):
+    try:
+        os.replace(source, target)
+    except AttributeError:
+        # Python 2
+        if os.path.exists(target):
+            os.remove(target)
+        os.rename(source, target)
+
+
+class history_cache:
+
+    def __init__(self, directory, max_messages=1000):
+        self.directory = directory
+        self.max_messages = max_messages
+        self._mutex = Lock()
+        self._messages = {}     # {cuid: [[position, time, name, text], ..]}
+
+    def end(self, channel):
+        """ returns the position behind the newest cached message of
+            @channel or None if nothing is cached """
+        with self._mutex:
+            _messages = self._load(channel)
+            return _messages[-1][0] + 1 if _messages else None
+
+    def messages(self, channel, limit=None):
+        """ returns [(position, time, name, text), ..] with the newest
+            @limit cached messages of @channel """
+        with self._mutex:
+            _messages = self._load(channel)
+            if limit is not None:
+                _messages = _messages[-limit:] if limit else []
+            return [tuple(m) for m in _messages]
+
+    def append(self, channel, messages):
+        """ adds [(position, time, name, text), ..] following the cached
+            messages of @channel - anything not contiguous replaces them """
+        self._add(channel, messages, True)
+
+    def extend(self, channel, messages):
+        """ like append() but only takes @messages if they follow the
+            cached ones - returns whether they did """
+        return self._add(channel, messages, False)
+
+    def replace(self, channel, messages):
+        with self._mutex:
+            self._write(channel, messages)
+
+    def clear(self, channel):
+        with self._mutex:
+            self._messages[channel] = []
+            try:
+                os.remove(self._filename(channel))
+            except OSError:
+                pass
+
+    def _add(self, channel, messages, replace):
+        if not messages:
+            return False
+        with self._mutex:
+            _messages = self._load(channel)
+            if _messages:
+                # skip what we have already
+                messages = [m for m in messages if m[0] > _messages[-1][0]]
+                if not messages:
+                    return True
+            if not _messages or messages[0][0] != _messages[-1][0] + 1:
+                if replace:
+                    self._write(channel, messages)
+                return replace
+            _messages.extend(list(m) for m in messages)
+            if len(_messages) > 2 * self.max_messages:
+                # rewriting on every append would be too expensive
+                self._write(channel, _messages)
+            else:
+                self._append_lines(channel, messages)
+            return True
+
+    def _filename(self, channel):
+        return os.path.join(self.directory, '%s.jsonl' % channel)
+
+    def _load(self, channel):
+        if channel in self._messages:
+            return self._messages[channel]
+        _messages = []
+        _broken = False
+        try:
+            with open(self._filename(channel)) as f:
+                for l in f:
+                    try:
+                        _m = json.loads(l)
+                    except ValueError:
+                        # e.g. interrupted while appending
+                        _broken = True
+                        break
+                    if _messages and _m[0] != _messages[-1][0] + 1:
+                        _broken = True
+                        break
+                    _messages.append(_m)
+        except (IOError, OSError):
+            pass
+        self._messages[channel] = _messages
+        if _broken:
+            logging.warning("history cache of channel %s is broken - keep "
+                            "%d messages", channel, len(_messages))
+            self._write(channel, _messages)
+        return _messages
+
+    def _write(self, channel, messages):
+        _messages = [list(m) for m in messages[-self.max_messages:]]
+        self._messages[channel] = _messages
+        try:
+            self._makedirs()
+            _filename = self._filename(channel)
+            with open(_filename + '.tmp', 'w') as f:
+                for m in _messages:
+                    f.write(json.dumps(m) + '\n')
+            _replace(_filename + '.tmp', _filename)
+        except (IOError, OSError) as ex:
+            logging.warning("could not write history cache: %s", ex)
+
+    def _append_lines(self, channel, messages):
+        try:
+            self._makedirs()
+            with open(self._filename(channel), 'a') as f:
+                for m in messages:
+                    f.write(json.dumps(list(m)) + '\n')
+        except (IOError, OSError) as ex:
+            logging.warning("could not write history cache: %s", ex)
+
+    def _makedirs(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
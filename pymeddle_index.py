@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import datetime
+import logging
+import re
+import time
+from collections import namedtuple
+
+_word_pattern = re.compile(r'\w+', re.UNICODE)
+
+# a tag starts behind whitespace or one of these and ends before them
+_tag_delimiters = r'''\s.,;?!:'"'''
+# the lookahead lets the scan skip quickly to where a token can start
+_special_pattern = re.compile(r'''(?=[\#@hfw])(?:
+      (?P<url>\b(?:https?://|ftp://|www\.)[^\s<>"']*[^\s<>"'.,;:!?)\]])
+    | (?<![^%s])(?P<tag>\#[^%s]+)
+    | (?<!\w)@(?P<mention>\w+))''' % (_tag_delimiters, _tag_delimiters),
+                              re.UNICODE | re.VERBOSE | re.IGNORECASE)
+_special_markers = ('#', '@', '://', 'www.')
+
+message_tokens = namedtuple('message_tokens', ('tags', 'mentions', 'urls', 'words'))
+
+def tokenize(text):
+    """ returns the message_tokens of @text: its lower case #tags (as often
+        as they occur), @mentioned names and URLs as written and all lower
+        case words, including those inside tags, mentions and URLs.
+
+        The words come from one scan of the whole text. Tags, mentions and
+        URLs need a second scan, but only for texts which can contain them """
+    _lower = text.lower()
+    _tokens = message_tokens([], [], [], _word_pattern.findall(_lower))
+    if not any(m in _lower for m in _special_markers):
+        return _tokens
+    for m in _special_pattern.finditer(text):
+        if m.lastgroup == 'tag':
+            _tokens.tags.append(m.group('tag').lower())
+        else:
+            getattr(_tokens, m.lastgroup + 's').append(m.group(m.lastgroup))
+    return _tokens
+
+def words(text):
+    """ returns the lower case words contained in @text """
+    return _word_pattern.findall(text.lower())
+
+def extract_tags(text):
+    """ returns only the tags tokenize() finds in @text """
+    if '#' not in text:
+        return []
+    return [m.group('tag').lower() for m in _special_pattern.finditer(text)
+            if m.lastgroup == 'tag']
+
+_relative_time = re.compile(r'^(\d+(?:\.\d+)?)([mhdw])$')
+_time_units = {'m': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+_time_formats = ('%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S')
+
+def parse_time(value, now=None):
+    """ returns the timestamp for @value which is either a time span
+        back from now ('30m', '12h', '7d', '2w') or a local date/time
+        ('2016-05-01', '2016-05-01T12:00') """
+    _match = _relative_time.match(value)
+    if _match:
+        return ((time.time() if now is None else now) -
+                float(_match.group(1)) * _time_units[_match.group(2)])
+    for f in _time_formats:
+        try:
+            return time.mktime(datetime.datetime.strptime(value, f).timetuple())
+        except ValueError:
+            pass
+    raise ValueError("can't understand time '%s'" % value)
+
+def parse_query(term, now=None):
+    """ splits a search term into free text and filters:
+            user:<name>         written by <name> (several: any of them)
+            channel:<cuid>      in channel <cuid> or with that friendly name
+            #tag                mentions #tag (several: all of them)
+            since:<time>        not older than <time> (see parse_time())
+            until:<time>        not newer than <time>
+        returns {'text', 'tags', 'users', 'channels', 'since', 'until'} """
+    _query = {'text': [], 'tags': [], 'users': [], 'channels': [],
+              'since': None, 'until': None}
+    for w in term.split():
+        _key, _, _value = w.partition(':')
+        if _key == 'user' and _value:
+            _query['users'].append(_value)
+        elif _key == 'channel' and _value:
+            _query['channels'].append(_value)
+        elif _key in ('since', 'until') and _value:
+            _query[_key] = parse_time(_value, now)
+        elif len(w) > 1 and w[0] == '#':
+            _query['tags'].append(w.lower())
+        else:
+            _query['text'].append(w.lower())
+    _query['text'] = ' '.join(_query['text'])
+    return _query
+
+
+class search_index:
+    """ inverted index over all channel logs
+
+        every message is identified by its channel uid and its position
+        inside the channel log (the same position search results and
+        get_log_page() report).
+        words, tags and users map to lists of [cuid, position] pairs.
+    """
+
+    def __init__(self):
+        self._words = {}    # {word: [[cuid, pos], ..]}
+        self._tags = {}     # {tag: [[cuid, pos], ..]}
+        self._users = {}    # {user: [[cuid, pos], ..]}
+        self._sizes = {}    # {cuid: number of indexed messages}
+
+    def __eq__(self, other):
+        return (self._sizes == other._sizes and
+                self._words == other._words and
+                self._tags == other._tags and
+                self._users == other._users)
+
+    def clear(self):
+        self._words.clear()
+        self._tags.clear()
+        self._users.clear()
+        self._sizes.clear()
+
+    def size(self, cuid):
+        return self._sizes.get(cuid, 0)
+
+    def knows_channels(self, cuids):
+        return all(c in self._sizes for c in cuids)
+
+    def add(self, cuid, user, tokens):
+        """ adds the next message of channel @cuid given as its
+            message_tokens (see tokenize()) and returns its position """
+        _pos = self._sizes.get(cuid, 0)
+        self._sizes[cuid] = _pos + 1
+        _ref = [cuid, _pos]
+        for w in set(tokens.words):
+            self._words.setdefault(w, []).append(_ref)
+        for t in set(tokens.tags):
+            self._tags.setdefault(t, []).append(_ref)
+        self._users.setdefault(user, []).append(_ref)
+        return _pos
+
+    def add_channel(self, cuid, entries):
+        """ indexes a whole channel log given as list of (time, user, text) """
+        self._sizes.setdefault(cuid, 0)
+        for _, u, x in entries:
+            self.add(cuid, u, tokenize(x))
+
+    def candidates(self, query):
+        """ returns the set of (cuid, position) tuples of all messages which
+            contain every word and tag and were written by one of the users
+            of @query (see parse_query()) - or None if the query does not
+            restrict any of these.
+            A word which is in no message at all doesn't restrict anything:
+            it can still be part of a longer one ('hell' of 'hello') and
+            the messages left get checked for the text anyway """
+        _postings = ([self._words[w] for w in words(query['text'])
+                      if w in self._words] +
+                     [self._tags.get(t, []) for t in query['tags']])
+        _result = None
+        if query['users']:
+            _result = set()
+            for u in query['users']:
+                _result.update((c, p) for c, p in self._users.get(u, []))
+        _postings.sort(key=len)
+        for l in _postings:
+            if _result is None:
+                _result = set((c, p) for c, p in l)
+            else:
+                _result &= set((c, p) for c, p in l)
+            if not _result:
+                break
+        return _result
+
+    def snapshot(self):
+        """ returns the JSON compatible state saved by save() """
+        return {'sizes': self._sizes,
+                'words': self._words,
+                'tags': self._tags,
+                'users': self._users}
+
+    def save(self, storage):
+        storage.save_state('index', self.snapshot())
+
+    def load(self, storage):
+        _data = storage.load_state('index')
+        if _data is None:
+            logging.debug("no search index stored - start with empty search index")
+            self.clear()
+            return self
+        try:
+            self._sizes = _data['sizes']
+            self._words = _data['words']
+            self._tags = _data['tags']
+            self._users = _data['users']
+        except KeyError:
+            logging.warning("stored search index is broken - start with empty index")
+            self.clear()
+        return self
@@ -0,0 +1,582 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" channel log files
+
+    every channel has a text log '_<cuid>.log' with one line per message
+    ("<timestamp>: <cuid>: <user>: <text>") or rename ("friendlyname=<name>")
+    and a sidecar offset index '_<cuid>.idx' which holds the byte offset of
+    every message line as array of unsigned 64 bit integers.
+
+    when the log gets too big or too old it is rotated: its content moves
+    into the compressed segment '_<cuid>.<number>.seg' and the log starts
+    empty again. A segment starts with a header (see segment) telling the
+    position and time range of the messages it contains, so readers can
+    skip segments without decompressing them.
+
+    the position of a message counts all messages of the channel - the
+    message at index i of the offset index has the position
+    base_position() + i.
+"""
+
+import glob
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict, namedtuple
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+_offset_size = array('Q').itemsize
+
+compressions = ('zlib', 'lzma')
+
+# magic, format version, compression, first position, message count,
+# first time, last time, uncompressed size, crc32 of uncompressed data
+_segment_header = struct.Struct('!4sBBQIddQI')
+_segment_magic = b'MSEG'
+
+segment = namedtuple('segment', ('filename', 'number', 'compression',
+                                 'first_pos', 'count', 'first_time',
+                                 'last_time', 'raw_size', 'crc'))
+
+# rotation replaces the log of a channel while workers read it
+_lock = threading.RLock()
+_segments = {}              # {cuid: [segment, ..]} oldest first
+_segment_data = OrderedDict()   # {filename: uncompressed data}, LRU
+_segment_data_max = 8
+
+def log_filename(cuid):
+    return '_%s.log' % cuid
+
+def index_filename(cuid):
+    return '_%s.idx' % cuid
+
+def segment_filename(cuid, number):
+    return '_%s.%06d.seg' % (cuid, number)
+
+def from_timestamp(time_string):
+    try:
+        x = time.strptime(time_string,'%Y%m%d%H%M%S%f')
+        return time.mktime(x)
+    except:
+        return 0
+
+def find_logs():
+    _ret = []
+    for i in glob.glob('_*.log'):
+        _ret.append(i[1:-4])
+    return _ret
+
+def parse_line(l):
+    """ returns (time, user, text) for a message line or None """
+    if l.startswith('friendlyname='):
+        return None
+    _t = from_timestamp(l[: l.find(':')].strip())
+    l = l[l.find(':')+1:]
+    _c = l[: l.find(':')].strip()
+    l = l[l.find(':')+1:]
+    _p = l[: l.find(':')].strip()
+    _x = l[l.find(':')+1:].strip()
+    return (_t, _p, _x)
+
+def log_state(channel):
+    """ returns (size, mtime) of the log of @channel """
+    _stat = os.stat(log_filename(channel))
+    return _stat.st_size, _stat.st_mtime
+
+def parse_lines(data, friendlyname=None, since_time=None, until_time=None):
+    """ returns [(time, user, text), ..] for the message lines in @data
+        within the given time range. The last rename goes to friendlyname[0] """
+    _result = []
+    for l in data.decode('utf-8', 'replace').split('\n'):
+        if l == '':
+            continue
+        if l.startswith('friendlyname='):
+            if friendlyname is not None:
+                friendlyname[0] = l[len('friendlyname='):]
+            continue
+        _m = parse_line(l)
+        if ((since_time is None or _m[0] >= since_time) and
+                (until_time is None or _m[0] <= until_time)):
+            _result.append(_m)
+    return _result
+
+def read_segment_header(filename):
+    with open(filename, 'rb') as f:
+        _fields = _segment_header.unpack(f.read(_segment_header.size))
+    if _fields[0] != _segment_magic:
+        raise ValueError("'%s' is not a log segment" % filename)
+    _number = int(filename.rsplit('.', 2)[1])
+    return segment(filename, _number, compressions[_fields[2]], *_fields[3:])
+
+def segments(channel):
+    """ returns the segments of @channel, oldest first """
+    with _lock:
+        if channel not in _segments:
+            _found = []
+            for f in glob.glob('_%s.*.seg' % channel):
+                try:
+                    _found.append(read_segment_header(f))
+                except (IOError, ValueError, struct.error) as ex:
+                    logging.error("skip broken log segment '%s': %s", f, ex)
+            _segments[channel] = sorted(_found, key=lambda x: x.number)
+        return _segments[channel]
+
+def base_position(channel):
+    """ number of messages in the segments of @channel """
+    _segments = segments(channel)
+    return _segments[-1].first_pos + _segments[-1].count if _segments else 0
+
+def read_segment(seg):
+    """ returns the uncompressed content of @seg """
+    with _lock:
+        if seg.filename in _segment_data:
+            _segment_data.move_to_end(seg.filename)
+            return _segment_data[seg.filename]
+    with open(seg.filename, 'rb') as f:
+        f.seek(_segment_header.size)
+        _data = f.read()
+    _data = (lzma.decompress(_data) if seg.compression == 'lzma'
+             else zlib.decompress(_data))
+    with _lock:
+        _segment_data[seg.filename] = _data
+        while len(_segment_data) > _segment_data_max:
+            _segment_data.popitem(last=False)
+    return _data
+
+def rotate(channel, compression='zlib'):
+    """ moves the content of the log of @channel into a new compressed
+        segment. The log must not be open for writing """
+    with _lock:
+        _offsets = read_offsets(channel)
+        if len(_offsets) == 0:
+            return False
+        with open(log_filename(channel), 'rb') as f:
+            _data = f.read()
+        _first = parse_line(_data[_offsets[0]:_data.index(b'\n', _offsets[0])]
+                            .decode('utf-8', 'replace'))
+        _last = parse_line(_data[_offsets[-1]:_data.index(b'\n', _offsets[-1])]
+                           .decode('utf-8', 'replace'))
+        _segments = segments(channel)
+        _number = _segments[-1].number + 1 if _segments else 0
+        _compressed = (lzma.compress(_data) if compression == 'lzma'
+                       else zlib.compress(_data, 6))
+        _seg = segment(segment_filename(channel, _number), _number, compression,
+                       base_position(channel), len(_offsets), _first[0], _last[0],
+                       len(_data), zlib.crc32(_data) & 0xffffffff)
+        with open(_seg.filename + '.tmp', 'wb') as f:
+            f.write(_segment_header.pack(
+                _segment_magic, 1, compressions.index(compression),
+                *_seg[3:]))
+            f.write(_compressed)
+        os.rename(_seg.filename + '.tmp', _seg.filename)
+        # the log is still complete - a crash here gets repaired by
+        # update_offset_index()
+        _segments.append(_seg)
+        open(log_filename(channel), 'wb').close()
+        open(index_filename(channel), 'wb').close()
+    logging.info("rotated %d messages of channel '%s' into '%s' (%d -> %d bytes)",
+                 _seg.count, channel, _seg.filename, len(_data), len(_compressed))
+    return True
+
+def _repair_rotation(channel):
+    """ removes the content of an interrupted rotation from the log """
+    _segments = segments(channel)
+    if not _segments:
+        return
+    _last = _segments[-1]
+    try:
+        with open(log_filename(channel), 'rb') as f:
+            _data = f.read()
+    except IOError:
+        return
+    if (len(_data) >= _last.raw_size and
+            zlib.crc32(_data[:_last.raw_size]) & 0xffffffff == _last.crc):
+        logging.warning("log of channel '%s' still contains segment '%s' - remove it",
+                        channel, _last.filename)
+        with open(log_filename(channel), 'wb') as f:
+            f.write(_data[_last.raw_size:])
+        if os.path.exists(index_filename(channel)):
+            os.remove(index_filename(channel))
+
+def raw_data(channel, since_time=None, until_time=None):
+    """ returns the uncompressed content of all segments of @channel
+        overlapping the given time range followed by the content of its log """
+    _result = []
+    with _lock:
+        for seg in segments(channel):
+            if ((since_time is not None and seg.last_time < since_time) or
+                    (until_time is not None and seg.first_time > until_time)):
+                continue
+            _result.append(read_segment(seg))
+        try:
+            with open(log_filename(channel), 'rb') as f:
+                _data = f.read()
+            _result.append(_data[:_data.rfind(b'\n') + 1])
+        except IOError as ex:
+            logging.warning("could not open '%s' %s", log_filename(channel), ex)
+    return _result
+
+def data_after(channel, base, offset):
+    """ returns everything written to @channel after byte @offset of the log
+        which started at position @base - possibly rotated by now - or None
+        if there has never been such a log """
+    with _lock:
+        _data = []
+        _found = base == base_position(channel)
+        for seg in segments(channel):
+            if seg.first_pos == base and seg.count > 0:
+                _found = True
+                _data.append(read_segment(seg)[offset:])
+            elif _found:
+                _data.append(read_segment(seg))
+        if not _found:
+            return None
+        with open(log_filename(channel), 'rb') as f:
+            if base == base_position(channel):
+                f.seek(offset)
+            _data.append(f.read())
+    return b''.join(_data)
+
+def get_log(channel, friendlyname=None, since_time=None, until_time=None):
+    """ returns [(time, user, text), ..] for all messages of @channel in the
+        given time range. Segments outside the time range are not read """
+    _return = []
+    _friendlyname = [None]
+    for _data in raw_data(channel, since_time, until_time):
+        _return.extend(parse_lines(_data, _friendlyname, since_time, until_time))
+
+    if friendlyname is not None and _friendlyname[0] is not None:
+        friendlyname[0] = _friendlyname[0]
+
+    return _return
+
+def read_offsets(channel):
+    _offsets = array('Q')
+    try:
+        with open(index_filename(channel), 'rb') as f:
+            _data = f.read()
+        _offsets.frombytes(_data[:len(_data) - len(_data) % _offset_size])
+    except IOError:
+        pass
+    return _offsets
+
+def update_offset_index(channel):
+    """ brings the offset index of @channel up to date with its log by
+        scanning only the part of the log which is not indexed yet """
+    _repair_rotation(channel)
+    _offsets = read_offsets(channel)
+    _rewrite = not os.path.exists(index_filename(channel))
+    _new = array('Q')
+    try:
+        if len(_offsets) > 0 and _offsets[-1] >= os.path.getsize(log_filename(channel)):
+            logging.warning("offset index of '%s' does not match its log - rebuild",
+                            channel)
+            _offsets = array('Q')
+            _rewrite = True
+        with open(log_filename(channel), 'rb') as f:
+            if len(_offsets) > 0:
+                f.seek(_offsets[-1])
+                f.readline()
+            while True:
+                _offset = f.tell()
+                l = f.readline()
+                if not l:
+                    break
+                if not l.endswith(b'\n'):
+                    logging.warning("incomplete last line in log of '%s'", channel)
+                    break
+                if not l.startswith(b'friendlyname='):
+                    _new.append(_offset)
+    except (IOError, OSError) as ex:
+        logging.warning("could not index log of '%s': %s", channel, ex)
+        return len(_offsets)
+
+    if _rewrite or len(_new) > 0:
+        with open(index_filename(channel), 'wb') as f:
+            (_offsets + _new).tofile(f)
+    if len(_new) > 0:
+        logging.info("indexed %d new messages of channel '%s'", len(_new), channel)
+    return len(_offsets) + len(_new)
+
+def page_range(size, since=None, before=None, limit=None):
+    """ returns [first, end) positions of a page out of @size messages.
+        without @since the page is taken from the end (newest messages) """
+    _first = 0 if since is None else max(0, min(since, size))
+    _end = size if before is None else max(_first, min(before, size))
+    if limit is not None and _end - _first > limit:
+        if since is None:
+            _first = _end - limit
+        else:
+            _end = _first + limit
+    return _first, _end
+
+def _segment_messages(seg, first, end):
+    """ returns [(position, time, user, text), ..] for the positions in
+        [first, end) out of @seg """
+    _result = []
+    for i, m in enumerate(parse_lines(read_segment(seg))):
+        _pos = seg.first_pos + i
+        if first <= _pos < end:
+            _result.append((_pos,) + m)
+    return _result
+
+def read_messages(channel, since=None, before=None, limit=None):
+    """ returns (size, [(position, time, user, text), ..]) for the requested
+        page of @channel, reading only the needed segments and part of the log """
+    with _lock:
+        _base = base_position(channel)
+        _offsets = read_offsets(channel)
+        _size = _base + len(_offsets)
+        _first, _end = page_range(_size, since, before, limit)
+        _result = []
+        if _first >= _end:
+            return _size, _result
+        for seg in segments(channel):
+            if seg.first_pos < _end and seg.first_pos + seg.count > _first:
+                _result.extend(_segment_messages(seg, _first, _end))
+        if _end <= _base:
+            return _size, _result
+        _log_first = max(_first, _base) - _base
+        _log_end = _end - _base
+        with open(log_filename(channel), 'rb') as f:
+            f.seek(_offsets[_log_first])
+            if _log_end < len(_offsets):
+                _data = f.read(_offsets[_log_end] - _offsets[_log_first])
+            else:
+                _data = f.read()
+    _pos = _log_first + _base
+    for l in _data.decode('utf-8', 'replace').split('\n'):
+        if l == '':
+            continue
+        _m = parse_line(l)
+        if _m is None:
+            continue
+        if _pos >= _end:
+            break
+        _result.append((_pos,) + _m)
+        _pos += 1
+    return _size, _result
+
+def time_positions(channel, since_time=None, until_time=None):
+    """ returns [first, end) positions which contain all messages of @channel
+        in the given time range. Only segments are skipped, so the range
+        may contain more messages """
+    with _lock:
+        _first = 0
+        _end = base_position(channel) + len(read_offsets(channel))
+        for seg in segments(channel):
+            if since_time is not None and seg.last_time < since_time:
+                _first = seg.first_pos + seg.count
+            if until_time is not None and seg.first_time > until_time:
+                _end = min(_end, seg.first_pos)
+    return _first, max(_first, _end)
+
+def read_positions(channel, positions):
+    """ returns [(position, time, user, text), ..] for the given positions """
+    _positions = sorted(positions)
+    _result = []
+    with _lock:
+        _base = base_position(channel)
+        for seg in segments(channel):
+            _wanted = set(p for p in _positions
+                          if seg.first_pos <= p < seg.first_pos + seg.count)
+            if _wanted:
+                _result.extend(m for m in _segment_messages(
+                    seg, min(_wanted), max(_wanted) + 1) if m[0] in _wanted)
+        _offsets = read_offsets(channel)
+        with open(log_filename(channel), 'rb') as f:
+            for p in _positions:
+                if p < _base or p - _base >= len(_offsets):
+                    continue
+                f.seek(_offsets[p - _base])
+                _m = parse_line(f.readline().decode('utf-8', 'replace'))
+                if _m is not None:
+                    _result.append((p,) + _m)
+    return _result
+
+
+class log_writer:
+    """ appends to the channel logs and their offset indices
+
+        the logs of the @max_open most recently used channels are kept open
+        and written buffered. When the buffers get written (and fsync'ed
+        if @sync is set) depends on @policy:
+            'always':   after every message
+            'interval': at the latest @interval seconds after a message
+            'idle':     when the server has nothing else to do (or when
+                        @max_pending messages are waiting)
+        readers have to flush() a channel before reading its log files.
+
+        a log gets rotated into a segment compressed with @compression when
+        it grows beyond @rotate_size bytes or when its first message is
+        older than @rotate_age seconds (0 disables either)
+    """
+
+    policies = ('always', 'interval', 'idle')
+
+    def __init__(self, policy='interval', interval=0.05, max_open=64,
+                 sync=False, max_pending=1000, rotate_size=0, rotate_age=0,
+                 compression='zlib'):
+        if policy not in self.policies:
+            raise ValueError("unknown flush policy '%s'" % policy)
+        if compression not in compressions or (compression == 'lzma' and not lzma):
+            raise ValueError("compression '%s' is not available" % compression)
+        self.policy = policy
+        self.interval = interval
+        self.max_open = max_open
+        self.sync = sync
+        self.max_pending = max_pending
+        self.rotate_size = rotate_size
+        self.rotate_age = rotate_age
+        self.compression = compression
+        self._started = {}            # {cuid: time of the first message in the log}
+        self._files = OrderedDict()   # {cuid: (log file, index file)}
+        self._dirty = set()
+        self._pending = 0
+        self._pending_since = None
+        self.counters = {'messages':         0,
+                         'bytes':            0,
+                         'flushes':          0,
+                         'fsyncs':           0,
+                         'opened':           0,
+                         'evicted':          0,
+                         'max_batch':        0,
+                         'max_unflushed_ms': 0.,
+                         'rotations':        0}
+
+    def statistics(self):
+        _result = dict(self.counters)
+        _result.update({'policy':   self.policy,
+                        'interval': self.interval,
+                        'sync':     self.sync,
+                        'open':     len(self._files),
+                        'pending':  self._pending})
+        return _result
+
+    def append_message(self, timestamp, channel, participant, text):
+        """ returns the position of the new message in the channel """
+        if self.rotate_age:
+            _started = self._log_started(channel)
+            if _started is not None and time.time() - _started >= self.rotate_age:
+                self.rotate(channel)
+            if self._started.get(channel) is None:
+                self._started[channel] = time.time()
+        _log, _index = self._open(channel)
+        _offset = _log.tell()
+        _position = base_position(channel) + _index.tell() // _offset_size
+        _line = ("%s: %s: %s: %s\n" % (
+            timestamp, channel, participant, text)).encode('utf-8')
+        _log.write(_line)
+        _index.write(array('Q', (_offset,)).tobytes())
+        self.counters['messages'] += 1
+        self._written(channel, len(_line))
+        if self.rotate_size and _offset + len(_line) >= self.rotate_size:
+            self.rotate(channel)
+        return _position
+
+    def rotate(self, channel):
+        if channel in self._files:
+            self.flush(channel)
+            self._close(channel)
+        if rotate(channel, self.compression):
+            self.counters['rotations'] += 1
+        self._started.pop(channel, None)
+
+    def _log_started(self, channel):
+        if channel not in self._started:
+            self._started[channel] = None
+            self.flush(channel)
+            _offsets = read_offsets(channel)
+            if len(_offsets) > 0:
+                with open(log_filename(channel), 'rb') as f:
+                    f.seek(_offsets[0])
+                    self._started[channel] = parse_line(
+                        f.readline().decode('utf-8', 'replace'))[0]
+        return self._started[channel]
+
+    def append_friendly_name(self, channel, name):
+        _log, _ = self._open(channel)
+        _line = ("friendlyname=%s\n" % name).encode('utf-8')
+        _log.write(_line)
+        self._written(channel, len(_line))
+
+    def timeout(self):
+        """ seconds until the next flush is due or None. With the 'idle'
+            policy a flush is due as soon as nothing else is waiting """
+        if self._pending == 0 or self.policy == 'always':
+            return None
+        if self.policy == 'idle':
+            return 0.
+        return max(0., self._pending_since + self.interval - time.time())
+
+    def tick(self, idle=False):
+        """ to be called regularly, @idle tells there is no work waiting """
+        if self._pending == 0:
+            return
+        if ((self.policy == 'idle' and idle) or
+                (self.policy == 'interval' and self.timeout() == 0.)):
+            self.flush()
+
+    def flush(self, channel=None):
+        """ writes the buffers of @channel (or of all channels) to disk """
+        _channels = list(self._dirty) if channel is None else (
+            [channel] if channel in self._dirty else [])
+        for c in _channels:
+            for f in self._files[c]:
+                f.flush()
+                if self.sync:
+                    os.fsync(f.fileno())
+                    self.counters['fsyncs'] += 1
+            self._dirty.discard(c)
+        if not _channels:
+            return
+        self.counters['flushes'] += 1
+        if not self._dirty:
+            self.counters['max_batch'] = max(self.counters['max_batch'],
+                                             self._pending)
+            self.counters['max_unflushed_ms'] = max(
+                self.counters['max_unflushed_ms'],
+                (time.time() - self._pending_since) * 1000.)
+            self._pending = 0
+            self._pending_since = None
+
+    def close(self):
+        self.flush()
+        for c in list(self._files.keys()):
+            self._close(c)
+
+    def _written(self, channel, size):
+        self.counters['bytes'] += size
+        self._dirty.add(channel)
+        self._pending += 1
+        if self._pending_since is None:
+            self._pending_since = time.time()
+        if self.policy == 'always' or self._pending >= self.max_pending:
+            self.flush()
+
+    def _open(self, channel):
+        if channel in self._files:
+            self._files.move_to_end(channel)
+            return self._files[channel]
+        while len(self._files) >= self.max_open:
+            _oldest = next(iter(self._files))
+            self.flush(_oldest)
+            self._close(_oldest)
+            self.counters['evicted'] += 1
+        self._files[channel] = (open(log_filename(channel), 'ab'),
+                                open(index_filename(channel), 'ab'))
+        self.counters['opened'] += 1
+        return self._files[channel]
+
+    def _close(self, channel):
+        for f in self._files.pop(channel):
+            f.close()
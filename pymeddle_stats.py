@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" runtime statistics of the meddle server
+
+    counts requests per opcode together with a latency histogram, the bytes
+    going through the request socket, messages published per topic class,
+    running background jobs and how long the main loop was blocked by
+    starting snapshots of the persistent data. Additional sources
+    (e.g. queue depths or subscriptions) can be registered and are
+    evaluated on snapshot()
+"""
+
+import json
+import time
+from array import array
+from threading import Lock
+
+import zmq
+
+# topics which are published as they are - all others are channel ids
+_plain_topics = ('user_update', 'channels_update', 'tags_delta', 'server_alive')
+
+def topic_class(topic):
+    if topic.startswith(b'tag#'):
+        return 'tag'
+    if topic.startswith(b'notify'):
+        return 'notify'
+    if topic.startswith(b'\x01'):
+        return 'channel_binary'
+    _topic = topic.decode('utf-8', 'replace')
+    return _topic if _topic in _plain_topics else 'channel'
+
+
+class latency_histogram:
+    """ counts durations in buckets of powers of two microseconds - bucket
+        n holds durations from 2**(n-1) to 2**n microseconds """
+
+    size = 32
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self.buckets = array('I', [0] * self.size)
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+        _us = int(duration * 1000000)
+        self.buckets[min(self.size - 1, _us.bit_length())] += 1
+
+    def percentile(self, p):
+        """ upper bound of the bucket containing the @p percentile in ms """
+        if self.count == 0:
+            return None
+        _rank = p * self.count
+        _seen = 0
+        for n, c in enumerate(self.buckets):
+            _seen += c
+            if _seen >= _rank and c > 0:
+                return min((1 << n) / 1000., self.max * 1000.)
+        return self.max * 1000.
+
+    def summary(self):
+        return {'count':   self.count,
+                'mean_ms': 1000. * self.total / self.count if self.count else None,
+                'p50_ms':  self.percentile(.50),
+                'p99_ms':  self.percentile(.99),
+                'p999_ms': self.percentile(.999),
+                'max_ms':  1000. * self.max,
+                'total_s': self.total,
+                'buckets': self.buckets.tolist()}
+
+
+class running_job:
+    """ context manager counting a job in server_statistics.jobs """
+
+    def __init__(self, stats, name):
+        self._stats = stats
+        self._name = name
+
+    def __enter__(self):
+        self._stats.job_started(self._name)
+
+    def __exit__(self, *args):
+        self._stats.job_finished(self._name)
+
+
+class server_statistics:
+
+    def __init__(self):
+        self._mutex = Lock()
+        self.started = time.time()
+        self.requests = {}      # {opcode: latency_histogram}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.published = {}     # {topic class: [messages, bytes]}
+        self.jobs = {}          # {name: {'running', 'max_running', 'total'}}
+        self.persist = latency_histogram()  # main loop blocked by snapshots
+        self.loop = {'iterations': 0, 'idle_s': 0.}
+        self._sources = {}      # {name: function returning JSON data}
+
+    def add_source(self, name, function):
+        self._sources[name] = function
+
+    def received(self, frames):
+        self.bytes_in += sum(len(f) for f in frames)
+
+    def answered(self, opcode, duration, size):
+        self.bytes_out += size
+        if opcode not in self.requests:
+            self.requests[opcode] = latency_histogram()
+        self.requests[opcode].add(duration)
+
+    def sent(self, topic, size):
+        # PUB messages are sent from threads, too
+        with self._mutex:
+            _class = topic_class(topic)
+            if _class not in self.published:
+                self.published[_class] = [0, 0]
+            self.published[_class][0] += 1
+            self.published[_class][1] += size
+
+    def running(self, name):
+        return running_job(self, name)
+
+    def job_started(self, name):
+        with self._mutex:
+            if name not in self.jobs:
+                self.jobs[name] = {'running': 0, 'max_running': 0, 'total': 0}
+            _job = self.jobs[name]
+            _job['running'] += 1
+            _job['total'] += 1
+            _job['max_running'] = max(_job['max_running'], _job['running'])
+
+    def job_finished(self, name):
+        with self._mutex:
+            self.jobs[name]['running'] -= 1
+
+    def polled(self, idle):
+        """ the main loop waited @idle seconds for something to do """
+        self.loop['iterations'] += 1
+        self.loop['idle_s'] += idle
+
+    def snapshot(self):
+        _now = time.time()
+        with self._mutex:
+            _published = {c: {'messages': m, 'bytes': b}
+                          for c, (m, b) in self.published.items()}
+            _jobs = {n: dict(j) for n, j in self.jobs.items()}
+        _result = {'time':      _now,
+                   'uptime':    _now - self.started,
+                   'requests':  {o: h.summary() for o, h in self.requests.items()},
+                   'bytes_in':  self.bytes_in,
+                   'bytes_out': self.bytes_out,
+                   'published': _published,
+                   'jobs':      _jobs,
+                   'persist':   self.persist.summary(),
+                   'loop':      dict(self.loop,
+                                     busy_ratio=1. - self.loop['idle_s'] /
+                                                max(_now - self.started, 1e-6))}
+        for name, function in self._sources.items():
+            _result[name] = function()
+        return _result
+
+    def dump(self, filename):
+        """ appends a snapshot as one line of JSON to @filename """
+        with open(filename, 'a') as f:
+            f.write(json.dumps(self.snapshot()) + '\n')
+
+
+class counting_socket:
+    """ wraps a PUB socket and counts what is sent through it.
+
+        An XPUB socket with XPUB_VERBOSER set tells about every subscription
+        and unsubscription - read_subscriptions() keeps track of them and
+        messages nobody subscribed to are dropped without sending. Callers
+        can ask wanted() before they even create a message """
+
+    def __init__(self, socket, stats):
+        self._socket = socket
+        self._stats = stats
+        self._tracking = socket.type == zmq.XPUB
+        self._subscriptions = {}    # {topic prefix: number of subscribers}
+        self._skipped = {}          # {topic class: messages}
+
+    def read_subscriptions(self):
+        """ handles all subscription messages waiting on the XPUB socket """
+        while self._socket.poll(0):
+            _message = self._socket.recv()
+            if not _message:
+                continue
+            _topic = _message[1:]
+            _count = self._subscriptions.get(_topic, 0)
+            if _message[:1] == b'\x01':
+                self._subscriptions[_topic] = _count + 1
+            elif _count > 1:
+                self._subscriptions[_topic] = _count - 1
+            else:
+                self._subscriptions.pop(_topic, None)
+
+    def wanted(self, topic):
+        """ tells whether anybody subscribed to @topic (subscriptions are
+            prefixes like on the subscriber side) - if not the message
+            counts as skipped """
+        if not self._tracking:
+            return True
+        _subscriptions = self._subscriptions
+        for i in range(len(topic) + 1):
+            if topic[:i] in _subscriptions:
+                return True
+        _class = topic_class(topic)
+        self._skipped[_class] = self._skipped.get(_class, 0) + 1
+        return False
+
+    def subscribers(self):
+        """ returns {topic: number of subscribers} """
+        return {t.decode('utf-8', 'replace'): c
+                for t, c in self._subscriptions.items()}
+
+    def statistics(self):
+        _classes = {}
+        for t, c in self._subscriptions.items():
+            _class = _classes.setdefault(topic_class(t),
+                                         {'topics': 0, 'subscribers': 0})
+            _class['topics'] += 1
+            _class['subscribers'] += c
+        return {'tracking': self._tracking,
+                'classes':  _classes,
+                'topics':   self.subscribers(),
+                'skipped':  dict(self._skipped)}
+
+    def send_multipart(self, frames):
+        _frames = list(frames)
+        if not self.wanted(_frames[0]):
+            return None
+        self._stats.sent(_frames[0], sum(len(f) for f in _frames))
+        return self._socket.send_multipart(_frames)
+
+    def __getattr__(self, name):
+        return getattr(self._socket, name)
@@ -0,0 +1,478 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" persistent storage of the meddle server
+
+    the channel messages and everything the server persists (users, channels,
+    tag statistics, search index and the replay checkpoint) go through one of
+    two interchangeable backends:
+
+    file_storage:   the channel logs of pymeddle_logs plus one JSON file
+                    'server-<name>.db' per state (the original layout)
+    sqlite_storage: one SQLite database in WAL mode
+
+    states are handed over as JSON compatible data. A checkpoint holds an
+    opaque token per channel only the backend which created it understands.
+    save_states() writes a whole snapshot of states and may run in another
+    thread or - after after_fork() - in a forked process.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import pymeddle_index
+import pymeddle_logs
+
+try:
+    FileNotFoundError
+except NameError:
+    FileNotFoundError = IOError
+
+backends = ('files', 'sqlite')
+
+def create_storage(backend, database='server.sqlite', policy='interval',
+                   interval=0.05, max_open=64, sync=False, rotate_size=0,
+                   rotate_age=0, compression='zlib'):
+    """ rotation only applies to the 'files' backend """
+    if backend == 'files':
+        return file_storage(policy, interval, max_open, sync, rotate_size,
+                            rotate_age, compression)
+    if backend == 'sqlite':
+        return sqlite_storage(database, policy, interval, sync)
+    raise ValueError("unknown storage backend '%s'" % backend)
+
+
+class file_storage:
+    """ channel logs and JSON files in the current directory """
+
+    name = 'files'
+
+    def __init__(self, policy='interval', interval=0.05, max_open=64, sync=False,
+                 rotate_size=0, rotate_age=0, compression='zlib'):
+        self._writer = pymeddle_logs.log_writer(
+            policy=policy, interval=interval, max_open=max_open, sync=sync,
+            rotate_size=rotate_size, rotate_age=rotate_age,
+            compression=compression)
+
+    def append_message(self, timestamp, channel, user, text):
+        """ returns the position of the new message in the channel """
+        return self._writer.append_message(timestamp, channel, user, text)
+
+    def append_friendly_name(self, channel, name):
+        self._writer.append_friendly_name(channel, name)
+
+    def timeout(self):
+        return self._writer.timeout()
+
+    def tick(self, idle=False):
+        self._writer.tick(idle)
+
+    def flush(self, channel=None):
+        self._writer.flush(channel)
+
+    def close(self):
+        self._writer.close()
+
+    def statistics(self):
+        return dict(self._writer.statistics(), backend=self.name)
+
+    def prepare(self):
+        """ brings the offset indices up to date with the logs """
+        for c in pymeddle_logs.find_logs():
+            pymeddle_logs.update_offset_index(c)
+
+    def channel_ids(self):
+        return pymeddle_logs.find_logs()
+
+    def get_log(self, channel, since_time=None, until_time=None):
+        return pymeddle_logs.get_log(channel, None, since_time, until_time)
+
+    def read_messages(self, channel, since=None, before=None, limit=None):
+        return pymeddle_logs.read_messages(channel, since, before, limit)
+
+    def read_positions(self, channel, positions):
+        return pymeddle_logs.read_positions(channel, positions)
+
+    def time_positions(self, channel, since_time=None, until_time=None):
+        return pymeddle_logs.time_positions(channel, since_time, until_time)
+
+    def events(self, channel):
+        """ yields ('message', timestamp, user, text) and ('name', name) in
+            the order they have been written """
+        for _data in pymeddle_logs.raw_data(channel):
+            for l in _data.decode('utf-8', 'replace').split('\n'):
+                if l == '':
+                    continue
+                if l.startswith('friendlyname='):
+                    yield ('name', l[len('friendlyname='):])
+                    continue
+                _timestamp, _, _user, _text = [x.strip() for x in l.split(':', 3)]
+                yield ('message', _timestamp, _user, _text)
+
+    def checkpoint(self):
+        _checkpoint = {}
+        for c in pymeddle_logs.find_logs():
+            _size, _mtime = pymeddle_logs.log_state(c)
+            _checkpoint[c] = {'base': pymeddle_logs.base_position(c),
+                              'offset': _size, 'mtime': _mtime}
+        return _checkpoint
+
+    def replay(self, channel, token):
+        """ returns ([(time, user, text), ..], friendly name or None) written
+            to @channel after the checkpoint @token (everything for None) """
+        _friendlyname = [None]
+        if token is None:
+            _messages = pymeddle_logs.get_log(channel, _friendlyname)
+            return _messages, _friendlyname[0]
+        # the log the checkpoint refers to may have been rotated since
+        _base = token.get('base', 0)
+        if _base == pymeddle_logs.base_position(channel):
+            _size, _mtime = pymeddle_logs.log_state(channel)
+            if _size < token['offset']:
+                logging.warning("log of channel '%s' is shorter than its checkpoint - "
+                                "restart with --rebuild", channel)
+                return [], None
+            if _size == token['offset']:
+                if _mtime != token['mtime']:
+                    logging.warning("log of channel '%s' has been modified since "
+                                    "the last checkpoint - restart with --rebuild",
+                                    channel)
+                return [], None
+        _data = pymeddle_logs.data_after(channel, _base, token['offset'])
+        if _data is None:
+            logging.warning("segments of channel '%s' do not match its checkpoint - "
+                            "restart with --rebuild", channel)
+            return [], None
+        return pymeddle_logs.parse_lines(_data, _friendlyname), _friendlyname[0]
+
+    def load_state(self, name):
+        """ returns the data stored as state @name or None """
+        _filename = 'server-%s.db' % name
+        try:
+            with open(_filename) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            logging.debug("file '%s' was not found", _filename)
+        except ValueError:
+            logging.warning("file '%s' is broken - ignore it", _filename)
+        return None
+
+    def save_state(self, name, data):
+        """ replaces state @name atomically and returns its size in bytes """
+        _filename = 'server-%s.db' % name
+        _data = json.dumps(data)
+        with open(_filename + '.tmp', 'w') as f:
+            f.write(_data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(_filename + '.tmp', _filename)
+        return len(_data)
+
+    def save_states(self, states):
+        """ saves [(name, data), ..] one after another and returns the size
+            in bytes - messages have to be flushed by the caller """
+        return sum(self.save_state(n, d) for n, d in states)
+
+    def after_fork(self):
+        pass
+
+
+class sqlite_storage:
+    """ messages and states in one SQLite database
+
+        messages get committed following the same policies as the logs of
+        pymeddle_logs.log_writer. Only the thread which created the storage
+        writes, all other threads read through their own connection.
+    """
+
+    name = 'sqlite'
+    policies = pymeddle_logs.log_writer.policies
+
+    _schema = (
+        "CREATE TABLE IF NOT EXISTS messages ("
+        "    id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        "    channel TEXT NOT NULL,"
+        "    pos INTEGER,"      # NULL for renames
+        "    timestamp TEXT,"
+        "    time REAL,"
+        "    user TEXT,"
+        "    text TEXT NOT NULL)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS messages_position ON messages (channel, pos)",
+        "CREATE INDEX IF NOT EXISTS messages_time ON messages (channel, time)",
+        "CREATE INDEX IF NOT EXISTS messages_user ON messages (user)",
+        "CREATE TABLE IF NOT EXISTS message_tags ("
+        "    message INTEGER NOT NULL REFERENCES messages (id),"
+        "    tag TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS message_tags_tag ON message_tags (tag)",
+        "CREATE TABLE IF NOT EXISTS users (name TEXT PRIMARY KEY, id INTEGER, data TEXT)",
+        "CREATE TABLE IF NOT EXISTS channels (cuid TEXT PRIMARY KEY, friendly_name TEXT, data TEXT)",
+        "CREATE TABLE IF NOT EXISTS tags (tag TEXT PRIMARY KEY, count INTEGER, data TEXT)",
+        "CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, data TEXT)")
+
+    # states stored with one row per record:
+    # {state: (table, key of the records inside the state or None, column)}
+    _record_states = {'user':     ('users', 'user_data', 'id'),
+                      'channels': ('channels', None, 'friendly_name'),
+                      'tags':     ('tags', None, 'count')}
+
+    def __init__(self, filename='server.sqlite', policy='interval',
+                 interval=0.05, sync=False, max_pending=1000):
+        if policy not in self.policies:
+            raise ValueError("unknown flush policy '%s'" % policy)
+        self.filename = filename
+        self.policy = policy
+        self.interval = interval
+        self.sync = sync
+        self.max_pending = max_pending
+        self._local = threading.local()
+        self._connection = self._connect()
+        self._local.connection = self._connection
+        for statement in self._schema:
+            self._connection.execute(statement)
+        self._connection.commit()
+        self._sizes = dict(self._connection.execute(
+            "SELECT channel, MAX(pos) + 1 FROM messages WHERE pos IS NOT NULL "
+            "GROUP BY channel"))
+        self._pending = 0
+        self._pending_since = None
+        self.counters = {'messages':         0,
+                         'bytes':            0,
+                         'flushes':          0,
+                         'max_batch':        0,
+                         'max_unflushed_ms': 0.}
+
+    def _connect(self):
+        _connection = sqlite3.connect(self.filename)
+        _connection.execute("PRAGMA journal_mode=WAL")
+        _connection.execute("PRAGMA synchronous=%s" % ('FULL' if self.sync else 'NORMAL'))
+        return _connection
+
+    def _reader(self):
+        """ connection of the current thread - the writing connection for
+            the thread which created the storage """
+        if not hasattr(self._local, 'connection'):
+            self._local.connection = self._connect()
+        return self._local.connection
+
+    def append_message(self, timestamp, channel, user, text):
+        _pos = self._sizes.get(channel, 0)
+        _cursor = self._connection.execute(
+            "INSERT INTO messages (channel, pos, timestamp, time, user, text) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (channel, _pos, timestamp, pymeddle_logs.from_timestamp(timestamp),
+             user, text))
+        self._connection.executemany(
+            "INSERT INTO message_tags (message, tag) VALUES (?, ?)",
+            [(_cursor.lastrowid, t) for t in set(pymeddle_index.extract_tags(text))])
+        self._sizes[channel] = _pos + 1
+        self.counters['messages'] += 1
+        self._written(len(text))
+        return _pos
+
+    def append_friendly_name(self, channel, name):
+        self._connection.execute(
+            "INSERT INTO messages (channel, text) VALUES (?, ?)", (channel, name))
+        self._written(len(name))
+
+    def timeout(self):
+        """ seconds until the next commit is due or None """
+        if self._pending == 0 or self.policy == 'always':
+            return None
+        if self.policy == 'idle':
+            return 0.
+        return max(0., self._pending_since + self.interval - time.time())
+
+    def tick(self, idle=False):
+        if self._pending == 0:
+            return
+        if ((self.policy == 'idle' and idle) or
+                (self.policy == 'interval' and self.timeout() == 0.)):
+            self.flush()
+
+    def flush(self, channel=None):
+        """ commits everything written so far - there is only one
+            transaction for all channels """
+        if self._pending == 0:
+            return
+        self._connection.commit()
+        self.counters['flushes'] += 1
+        self.counters['max_batch'] = max(self.counters['max_batch'], self._pending)
+        self.counters['max_unflushed_ms'] = max(
+            self.counters['max_unflushed_ms'],
+            (time.time() - self._pending_since) * 1000.)
+        self._pending = 0
+        self._pending_since = None
+
+    def close(self):
+        self.flush()
+        self._connection.close()
+
+    def statistics(self):
+        _result = dict(self.counters)
+        _result.update({'backend':  self.name,
+                        'database': self.filename,
+                        'policy':   self.policy,
+                        'interval': self.interval,
+                        'sync':     self.sync,
+                        'pending':  self._pending})
+        return _result
+
+    def _written(self, size):
+        self.counters['bytes'] += size
+        self._pending += 1
+        if self._pending_since is None:
+            self._pending_since = time.time()
+        if self.policy == 'always' or self._pending >= self.max_pending:
+            self.flush()
+
+    def prepare(self):
+        """ nothing to do - the database is always consistent """
+        pass
+
+    def channel_ids(self):
+        return [c for c, in self._reader().execute(
+            "SELECT DISTINCT channel FROM messages")]
+
+    def get_log(self, channel, since_time=None, until_time=None):
+        return [tuple(r) for r in self._reader().execute(
+            "SELECT time, user, text FROM messages "
+            "WHERE channel = ? AND pos IS NOT NULL AND time >= ? AND time <= ? "
+            "ORDER BY pos",
+            (channel,
+             float('-inf') if since_time is None else since_time,
+             float('inf') if until_time is None else until_time))]
+
+    def read_messages(self, channel, since=None, before=None, limit=None):
+        _connection = self._reader()
+        _size = _connection.execute(
+            "SELECT MAX(pos) + 1 FROM messages WHERE channel = ?",
+            (channel,)).fetchone()[0] or 0
+        _first, _end = pymeddle_logs.page_range(_size, since, before, limit)
+        return _size, [tuple(r) for r in _connection.execute(
+            "SELECT pos, time, user, text FROM messages "
+            "WHERE channel = ? AND pos >= ? AND pos < ? ORDER BY pos",
+            (channel, _first, _end))]
+
+    def time_positions(self, channel, since_time=None, until_time=None):
+        """ returns [first, end) positions of the messages of @channel in the
+            given time range """
+        _first, _last = self._reader().execute(
+            "SELECT MIN(pos), MAX(pos) FROM messages "
+            "WHERE channel = ? AND pos IS NOT NULL AND time >= ? AND time <= ?",
+            (channel,
+             float('-inf') if since_time is None else since_time,
+             float('inf') if until_time is None else until_time)).fetchone()
+        if _first is None:
+            return 0, 0
+        return _first, _last + 1
+
+    def read_positions(self, channel, positions):
+        _connection = self._reader()
+        _positions = sorted(positions)
+        _result = []
+        # stay below the limit of variables per statement
+        for i in range(0, len(_positions), 500):
+            _chunk = _positions[i:i + 500]
+            _result.extend(tuple(r) for r in _connection.execute(
+                "SELECT pos, time, user, text FROM messages "
+                "WHERE channel = ? AND pos IN (%s) ORDER BY pos"
+                % ', '.join('?' * len(_chunk)), [channel] + _chunk))
+        return _result
+
+    def events(self, channel):
+        """ yields ('message', timestamp, user, text) and ('name', name) in
+            the order they have been written """
+        for _pos, _timestamp, _user, _text in self._reader().execute(
+                "SELECT pos, timestamp, user, text FROM messages "
+                "WHERE channel = ? ORDER BY id", (channel,)):
+            if _pos is None:
+                yield ('name', _text)
+            else:
+                yield ('message', _timestamp, _user, _text)
+
+    def checkpoint(self):
+        return dict(self._reader().execute(
+            "SELECT channel, MAX(id) FROM messages GROUP BY channel"))
+
+    def replay(self, channel, token):
+        """ returns ([(time, user, text), ..], friendly name or None) written
+            to @channel after the checkpoint @token (everything for None) """
+        _connection = self._reader()
+        if token is not None:
+            _last = _connection.execute(
+                "SELECT MAX(id) FROM messages WHERE channel = ?",
+                (channel,)).fetchone()[0] or 0
+            if _last < token:
+                logging.warning("channel '%s' has less messages than its checkpoint - "
+                                "restart with --rebuild", channel)
+                return [], None
+        _messages = []
+        _friendlyname = None
+        for _pos, _time, _user, _text in _connection.execute(
+                "SELECT pos, time, user, text FROM messages "
+                "WHERE channel = ? AND id > ? ORDER BY id", (channel, token or 0)):
+            if _pos is None:
+                _friendlyname = _text
+            else:
+                _messages.append((_time, _user, _text))
+        return _messages, _friendlyname
+
+    def load_state(self, name):
+        """ returns the data stored as state @name or None """
+        _connection = self._reader()
+        _row = _connection.execute(
+            "SELECT data FROM state WHERE name = ?", (name,)).fetchone()
+        _data = json.loads(_row[0]) if _row else None
+        if name not in self._record_states:
+            return _data
+        _table, _key, _ = self._record_states[name]
+        _records = {r[0]: json.loads(r[2]) for r in _connection.execute(
+            "SELECT * FROM %s" % _table)}
+        if _key is None:
+            return _records or None
+        if _data is not None:
+            _data[_key] = _records
+        return _data
+
+    def save_state(self, name, data):
+        """ replaces state @name and returns its size in bytes """
+        self.flush()
+        return self.save_states([(name, data)])
+
+    def save_states(self, states):
+        """ saves [(name, data), ..] in one transaction and returns the size
+            in bytes - messages have to be flushed by the caller """
+        _size = 0
+        _connection = self._reader()
+        with _connection:
+            for name, data in states:
+                _size += self._save_state(_connection, name, data)
+        return _size
+
+    def _save_state(self, connection, name, data):
+        _size = 0
+        if name in self._record_states:
+            _table, _key, _column = self._record_states[name]
+            _records = [(k, d.get(_column) if isinstance(d, dict) else None, json.dumps(d))
+                        for k, d in (data[_key] if _key else data).items()]
+            connection.execute("DELETE FROM %s" % _table)
+            connection.executemany("INSERT INTO %s VALUES (?, ?, ?)" % _table, _records)
+            _size += sum(len(r[2]) for r in _records)
+            data = {k: v for k, v in data.items() if k != _key} if _key else None
+        if data is not None:
+            _data = json.dumps(data)
+            connection.execute(
+                "INSERT OR REPLACE INTO state (name, data) VALUES (?, ?)", (name, _data))
+            _size += len(_data)
+        return _size
+
+    def after_fork(self):
+        """ SQLite connections must not be used across fork() - a forked
+            process opens its own. The inherited one is kept, closing it
+            would disturb the parent """
+        self._inherited = self._connection
+        self._local = threading.local()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+from array import array
+
+
+class time_buckets:
+    """ ring of @count counters covering @width seconds each. Only the last
+        @count periods are kept - older mentions drop out of the ring """
+
+    def __init__(self, width, count, json=None):
+        self.width = width
+        self.counts = array('I', [0] * count)
+        self.last = 0   # number of the newest period (time // width)
+        if json:
+            self.counts = array('I', json['counts'])
+            self.last = json['last']
+
+    def __eq__(self, other):
+        return self.last == other.last and self.counts == other.counts
+
+    def to_JSON(self):
+        return {'counts': self.counts.tolist(), 'last': self.last}
+
+    def add(self, t):
+        _period = int(t // self.width)
+        _size = len(self.counts)
+        if _period > self.last:
+            for p in range(max(self.last + 1, _period - _size + 1), _period + 1):
+                self.counts[p % _size] = 0
+            self.last = _period
+        elif _period <= self.last - _size:
+            return
+        self.counts[_period % _size] += 1
+
+    def values(self, now=None):
+        """ returns the counters oldest first, ending with the current period """
+        _period = int((time.time() if now is None else now) // self.width)
+        _size = len(self.counts)
+        return [self.counts[p % _size] if self.last - _size < p <= self.last else 0
+                for p in range(_period - _size + 1, _period + 1)]
+
+
+class tag_counter:
+
+    def __init__(self, json=None):
+        self.count = 0
+        self.channels = {}  # {cuid: count}
+        self.users = {}     # {name: count}
+        self.hours = time_buckets(3600, 48)
+        self.days = time_buckets(86400, 60)
+        if json:
+            self.count = json['count']
+            self.channels = json['channels']
+            self.users = json['users']
+            self.hours = time_buckets(3600, 48, json['hours'])
+            self.days = time_buckets(86400, 60, json['days'])
+
+    def __eq__(self, other):
+        return (self.count == other.count and
+                self.channels == other.channels and
+                self.users == other.users and
+                self.hours == other.hours and
+                self.days == other.days)
+
+    def to_JSON(self):
+        return {'count': self.count,
+                'channels': self.channels,
+                'users': self.users,
+                'hours': self.hours.to_JSON(),
+                'days': self.days.to_JSON()}
+
+    def summary(self, now=None):
+        return {'count': self.count,
+                'channels': dict(self.channels),
+                'users': dict(self.users),
+                'hours': self.hours.values(now),
+                'days': self.days.values(now)}
+
+
+class tag_statistics:
+    """ per tag mention counters in total, per channel, per user and for the
+        last 48 hours and 60 days. Every single mention can additionally be
+        written to a raw event log """
+
+    def __init__(self, event_log=None):
+        self._tags = {}     # {tag: tag_counter}
+        self._event_log = open(event_log, 'a') if event_log else None
+
+    def __eq__(self, other):
+        return self._tags == other._tags
+
+    def __len__(self):
+        return len(self._tags)
+
+    def clear(self):
+        self._tags.clear()
+
+    def add(self, tags, channel, user, t=None, record=True):
+        """ counts one mention of every tag in @tags and returns
+            0: no changes,
+            1<<2: minor tagging (same channel and user),
+            1<<4: new tag on user,
+            1<<8: new tag on channel,
+            1<<16: new tag
+            @record=False keeps replayed history out of the event log """
+        _result = 0
+        _t = time.time() if t is None else t
+        for tag in tags:
+            if tag not in self._tags:
+                _result += 1<<16
+                self._tags[tag] = tag_counter()
+            _counter = self._tags[tag]
+            if channel not in _counter.channels:
+                _result += 1<<8
+            if user not in _counter.users:
+                _result += 1<<4
+            _counter.count += 1
+            _counter.channels[channel] = _counter.channels.get(channel, 0) + 1
+            _counter.users[user] = _counter.users.get(user, 0) + 1
+            _counter.hours.add(_t)
+            _counter.days.add(_t)
+            _result += 1<<2
+            if self._event_log and record:
+                self._event_log.write("%f %s %s %s\n" % (_t, channel, user, tag))
+        return _result
+
+    def counts(self):
+        """ returns {tag: number of mentions} """
+        return {t: c.count for t, c in self._tags.items()}
+
+    def summary(self):
+        _now = time.time()
+        return {t: c.summary(_now) for t, c in self._tags.items()}
+
+    def flush(self):
+        if self._event_log:
+            self._event_log.flush()
+
+    def snapshot(self):
+        """ returns the JSON compatible state saved by save() """
+        return {t: c.to_JSON() for t, c in self._tags.items()}
+
+    def save(self, storage):
+        self.flush()
+        storage.save_state('tags', self.snapshot())
+
+    def load(self, storage):
+        self._tags.clear()
+        _data = storage.load_state('tags')
+        if _data is None:
+            return self
+        for tag, c in _data.items():
+            if isinstance(c, list):
+                # old format: list of (time, channel, user) per mention
+                for _t, _channel, _user in c:
+                    self.add([tag], _channel, _user, _t, record=False)
+            else:
+                self._tags[tag] = tag_counter(c)
+        logging.debug("loaded statistics for %d tags", len(self._tags))
+        return self
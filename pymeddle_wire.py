@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" encodings of published messages and log pages
+
+    'json':   the original encoding - every message is a JSON object with
+              user name, timestamp string, text and sequence number,
+              published on the channel id as topic
+    'binary': compact length-prefixed encoding, negotiated on hello.
+              Messages are published on topic b'\\x01' + channel id and
+              carry the numeric user id instead of the user name:
+
+                  message: uint32 sequence number, uint32 user id,
+                           float64 time, utf-8 text
+                  page:    uint32 size, uint32 count, uint16 number of names,
+                           names as strings, then per message
+                           uint32 position, float64 time, uint16 name index,
+                           text as string
+                  string:  uint32 length, utf-8 bytes
+
+    the sequence number of a message is its position in the channel log -
+    so a client which misses numbers can request exactly these messages
+    with get_log_page
+
+    all numbers are in network byte order
+"""
+
+import struct
+
+# in order of preference
+encodings = ('binary', 'json')
+
+_message_header = struct.Struct('!IId')
+_page_header = struct.Struct('!IIH')
+_page_entry = struct.Struct('!IdH')
+_length = struct.Struct('!I')
+
+def choose_encoding(offered):
+    """ returns the first of our encodings the other side offers """
+    for e in encodings:
+        if e in (offered or ()):
+            return e
+    return 'json'
+
+def binary_topic(channel):
+    return b'\x01' + channel.encode('utf-8')
+
+def is_binary_topic(topic):
+    return topic[:1] == b'\x01'
+
+def channel_of(topic):
+    return topic[1:].decode('utf-8')
+
+def pack_string(text):
+    _data = text.encode('utf-8')
+    return _length.pack(len(_data)) + _data
+
+def unpack_string(data, offset):
+    """ returns (string, offset behind it) """
+    _size, = _length.unpack_from(data, offset)
+    _start = offset + _length.size
+    return data[_start:_start + _size].decode('utf-8'), _start + _size
+
+def pack_message(seq, user_id, t, text):
+    return _message_header.pack(seq, user_id, t) + text.encode('utf-8')
+
+def unpack_message(data):
+    """ returns (sequence number, user id, time, text) """
+    _seq, _user_id, _t = _message_header.unpack_from(data)
+    return _seq, _user_id, _t, data[_message_header.size:].decode('utf-8')
+
+def pack_page(size, messages):
+    """ @messages: [(position, time, user name, text), ..] """
+    _names = {}
+    _entries = []
+    for p, t, u, x in messages:
+        if u not in _names:
+            _names[u] = len(_names)
+        _entries.append(_page_entry.pack(p, t, _names[u]) + pack_string(x))
+    return b''.join(
+        [_page_header.pack(size, len(messages), len(_names))] +
+        [pack_string(n) for n, _ in sorted(_names.items(), key=lambda x: x[1])] +
+        _entries)
+
+def unpack_page(data):
+    """ returns (size, [(position, time, user name, text), ..]) """
+    _size, _count, _name_count = _page_header.unpack_from(data)
+    _offset = _page_header.size
+    _names = []
+    for _ in range(_name_count):
+        _name, _offset = unpack_string(data, _offset)
+        _names.append(_name)
+    _messages = []
+    for _ in range(_count):
+        _p, _t, _n = _page_entry.unpack_from(data, _offset)
+        _text, _offset = unpack_string(data, _offset + _page_entry.size)
+        _messages.append((_p, _t, _names[_n], _text))
+    return _size, _messages
@@ -0,0 +1,42 @@
+import pymeddle_history
+
+
+def _messages(first, end):
+    return [(p, 1500000000. + p, 'alice', 'message %d' % p)
+            for p in range(first, end)]
+
+
+def test_append_and_persist(tmp_path):
+    _cache = pymeddle_history.history_cache(str(tmp_path))
+    assert _cache.end('c') is None
+    _cache.append('c', _messages(0, 3))
+    _cache.append('c', _messages(2, 5))
+    assert _cache.end('c') == 5
+    assert _cache.messages('c', 2) == _messages(3, 5)
+    _reloaded = pymeddle_history.history_cache(str(tmp_path))
+    assert _reloaded.messages('c') == _messages(0, 5)
+
+
+def test_gap_replaces_or_is_refused(tmp_path):
+    _cache = pymeddle_history.history_cache(str(tmp_path))
+    _cache.append('c', _messages(0, 3))
+    assert not _cache.extend('c', _messages(5, 7))
+    assert _cache.messages('c') == _messages(0, 3)
+    _cache.append('c', _messages(5, 7))
+    assert _cache.messages('c') == _messages(5, 7)
+
+
+def test_keeps_max_messages(tmp_path):
+    _cache = pymeddle_history.history_cache(str(tmp_path), max_messages=3)
+    _cache.replace('c', _messages(0, 10))
+    assert _cache.messages('c') == _messages(7, 10)
+    _cache.clear('c')
+    assert pymeddle_history.history_cache(str(tmp_path)).end('c') is None
+
+
+def test_broken_cache_keeps_contiguous_part(tmp_path):
+    _cache = pymeddle_history.history_cache(str(tmp_path))
+    _cache.append('c', _messages(0, 3))
+    with open(str(tmp_path / 'c.jsonl'), 'a') as f:
+        f.write('[3, 1500000003.0, "alice", "interrup')
+    assert pymeddle_history.history_cache(str(tmp_path)).messages('c') == _messages(0, 3)
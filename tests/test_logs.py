@@ -0,0 +1,81 @@
+import os
+import shutil
+
+import pytest
+
+import pymeddle_logs
+
+
+@pytest.fixture
+def logdir(tmp_path, monkeypatch):
+    """ the logs live in the working directory """
+    monkeypatch.chdir(tmp_path)
+    pymeddle_logs._segments.clear()
+    pymeddle_logs._segment_data.clear()
+    yield tmp_path
+    pymeddle_logs._segments.clear()
+    pymeddle_logs._segment_data.clear()
+
+
+def _write(channel, first, end):
+    _writer = pymeddle_logs.log_writer(policy='always')
+    for i in range(first, end):
+        _writer.append_message('20170101120000%06d' % i, channel, 'alice',
+                               'message %d' % i)
+    _writer.close()
+
+
+def _texts(channel, **kwargs):
+    _size, _messages = pymeddle_logs.read_messages(channel, **kwargs)
+    return _size, [(m[0], m[3]) for m in _messages]
+
+
+def test_page_range():
+    assert pymeddle_logs.page_range(10) == (0, 10)
+    assert pymeddle_logs.page_range(10, limit=3) == (7, 10)
+    assert pymeddle_logs.page_range(10, since=2, limit=3) == (2, 5)
+    assert pymeddle_logs.page_range(10, before=5, limit=3) == (2, 5)
+    assert pymeddle_logs.page_range(10, since=8, before=20) == (8, 10)
+    assert pymeddle_logs.page_range(10, since=12) == (10, 10)
+    assert pymeddle_logs.page_range(10, since=6, before=4) == (6, 6)
+
+
+def test_read_across_rotation(logdir):
+    _write('c', 0, 3)
+    assert pymeddle_logs.rotate('c')
+    _write('c', 3, 5)
+    assert pymeddle_logs.base_position('c') == 3
+    assert _texts('c') == (5, [(i, 'message %d' % i) for i in range(5)])
+    assert _texts('c', since=2, limit=2) == (5, [(2, 'message 2'), (3, 'message 3')])
+    assert _texts('c', limit=1) == (5, [(4, 'message 4')])
+    assert [m[2] for m in pymeddle_logs.get_log('c')] == [
+        'message %d' % i for i in range(5)]
+    # a fresh process finds the segment on disk
+    pymeddle_logs._segments.clear()
+    pymeddle_logs._segment_data.clear()
+    assert _texts('c', before=3) == (5, [(i, 'message %d' % i) for i in range(3)])
+
+
+def test_rotate_empty_log(logdir):
+    _write('c', 0, 0)
+    assert not pymeddle_logs.rotate('c')
+    assert pymeddle_logs.segments('c') == []
+
+
+def test_repair_interrupted_rotation(logdir):
+    _write('c', 0, 3)
+    shutil.copy(pymeddle_logs.log_filename('c'), 'log.bak')
+    shutil.copy(pymeddle_logs.index_filename('c'), 'idx.bak')
+    assert pymeddle_logs.rotate('c')
+    # crash after the segment got renamed but before the log was truncated
+    shutil.copy('log.bak', pymeddle_logs.log_filename('c'))
+    shutil.copy('idx.bak', pymeddle_logs.index_filename('c'))
+    pymeddle_logs._segments.clear()
+    _write('c', 3, 4)
+
+    assert pymeddle_logs.update_offset_index('c') == 1
+    assert os.path.getsize(pymeddle_logs.log_filename('c')) < os.path.getsize('log.bak')
+    assert _texts('c') == (4, [(i, 'message %d' % i) for i in range(4)])
+    # repairing again changes nothing
+    assert pymeddle_logs.update_offset_index('c') == 1
+    assert _texts('c') == (4, [(i, 'message %d' % i) for i in range(4)])
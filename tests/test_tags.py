@@ -0,0 +1,43 @@
+import json
+
+import pymeddle_tags
+
+
+def test_buckets_count_per_period():
+    _buckets = pymeddle_tags.time_buckets(10, 4)
+    for t in (1000, 1005, 1012, 1039):
+        _buckets.add(t)
+    assert _buckets.values(1039) == [2, 1, 0, 1]
+
+
+def test_buckets_expire_old_periods():
+    _buckets = pymeddle_tags.time_buckets(10, 4)
+    _buckets.add(1000)
+    _buckets.add(1010)
+    # reading later shifts the window without touching the ring
+    assert _buckets.values(1025) == [0, 1, 1, 0]
+    assert _buckets.values(1045) == [1, 0, 0, 0]
+    assert _buckets.values(1055) == [0, 0, 0, 0]
+    # adding later clears the periods which dropped out
+    _buckets.add(1030)
+    assert _buckets.values(1030) == [1, 1, 0, 1]
+    _buckets.add(1100)
+    assert _buckets.values(1100) == [0, 0, 0, 1]
+
+
+def test_buckets_ignore_too_old_mentions():
+    _buckets = pymeddle_tags.time_buckets(10, 4)
+    _buckets.add(1050)
+    _buckets.add(1010)
+    _buckets.add(1020)
+    assert _buckets.values(1050) == [1, 0, 0, 1]
+
+
+def test_buckets_json_round_trip():
+    _buckets = pymeddle_tags.time_buckets(10, 4)
+    for t in (1000, 1011, 1012):
+        _buckets.add(t)
+    _copy = pymeddle_tags.time_buckets(
+        10, 4, json.loads(json.dumps(_buckets.to_JSON())))
+    assert _copy == _buckets
+    assert _copy.values(1012) == _buckets.values(1012)
@@ -0,0 +1,53 @@
+import importlib.util
+import os
+import time
+
+import pytest
+
+_spec = importlib.util.spec_from_file_location(
+    'meddle_server', os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), 'meddle-server.py'))
+meddle_server = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(meddle_server)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    _now = [1000.]
+    monkeypatch.setattr(time, 'time', lambda: _now[0])
+    return _now
+
+
+def test_users_expire_after_timeout(clock):
+    _users = meddle_server.user_container(timeout=5)
+    _, _alice, _ = _users.find_or_create_name('alice')
+    clock[0] = 1002.5
+    _, _bob, _ = _users.find_or_create_name('bob')
+    clock[0] = 1005.
+    assert _users.find_dead() == []
+    clock[0] = 1006.
+    assert _users.find_dead() == [_alice]
+    clock[0] = 1008.
+    assert _users.find_dead() == [_bob]
+    assert _users.find_dead() == []
+
+
+def test_refresh_postpones_expiry(clock):
+    _users = meddle_server.user_container(timeout=5)
+    _, _alice, _ = _users.find_or_create_name('alice')
+    clock[0] = 1004.
+    assert _users.refresh(_alice)
+    clock[0] = 1006.
+    assert _users.find_dead() == []
+    clock[0] = 1010.
+    assert _users.find_dead() == [_alice]
+
+
+def test_late_call_finds_all_timed_out_users(clock):
+    _users = meddle_server.user_container(timeout=2)
+    _ids = [_users.find_or_create_name(n)[1] for n in ('a', 'b', 'c')]
+    _users.set_offline([_ids[1]])
+    # far more seconds than the wheel has slots
+    clock[0] = 1100.
+    assert sorted(_users.find_dead()) == [_ids[0], _ids[2]]
+    assert _users.next_expiry() is None
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+import pymeddle_wire
+
+
+def test_string_round_trip():
+    _data = pymeddle_wire.pack_string(u'hällo ☃') + pymeddle_wire.pack_string(u'')
+    _first, _offset = pymeddle_wire.unpack_string(_data, 0)
+    _second, _offset = pymeddle_wire.unpack_string(_data, _offset)
+    assert (_first, _second, _offset) == (u'hällo ☃', u'', len(_data))
+
+
+def test_message_round_trip():
+    _data = pymeddle_wire.pack_message(42, 7, 1500000000.25, u'grüße #tag')
+    assert pymeddle_wire.unpack_message(_data) == (42, 7, 1500000000.25, u'grüße #tag')
+
+
+def test_page_round_trip():
+    _messages = [(3, 1500000000.5, u'alice', u'one'),
+                 (4, 1500000001.0, u'bøb', u'two: with colon')]
+    assert pymeddle_wire.unpack_page(pymeddle_wire.pack_page(10, _messages)) == (
+        10, _messages)
+    assert pymeddle_wire.unpack_page(pymeddle_wire.pack_page(0, [])) == (0, [])
+
+
+def test_choose_encoding():
+    assert pymeddle_wire.choose_encoding(['binary', 'json']) == 'binary'
+    assert pymeddle_wire.choose_encoding(['json']) == 'json'
+    assert pymeddle_wire.choose_encoding(None) == 'json'